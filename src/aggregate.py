@@ -0,0 +1,123 @@
+import argparse
+import os
+
+import constants
+import evaluate
+from compare.comparison_result import ComparisonResult
+from utils import file_utils
+from workflow import ensemble
+
+
+def get_final_plan(query_results_folder_path: str, aggregator: str, save: bool) -> list:
+    """
+    Returns the relevant objects of the final plan of a query of the LLM Ensemble workflow
+    with an aggregator (the stored choice of the chooser, or the final plan of a local
+    aggregator, stored or aggregated from the stored plans), or None if the responses of
+    the query are missing.
+    """
+    try:
+        if aggregator == ensemble.AGGREGATOR_CHOOSER:
+            final_plan = file_utils.load_json(
+                evaluate.get_ensemble_chosen_plan_file_path(query_results_folder_path))
+            return final_plan.get("relevant_objects") if isinstance(final_plan, dict) else None
+        final_plan = evaluate.load_ensemble_aggregate_plan(query_results_folder_path, aggregator)
+    except (FileNotFoundError, KeyError, ValueError):
+        return None
+    if save:
+        file_utils.save_dict_to_json_file(final_plan,
+                                          os.path.join(query_results_folder_path,
+                                                       ensemble.get_aggregate_file_name(aggregator)))
+    return final_plan["relevant_objects"]
+
+
+def compare_aggregators(args):
+    # Responses of other encodings or pruned maps are in their own results folder, and
+    # responses with adaptive sampling in their own method folder
+    constants.set_map_encoding(args.map_encoding)
+    constants.set_map_pruning(args.prune_maps)
+    constants.set_adaptive_ensemble(args.adaptive_ensemble)
+
+    semantic_map_basenames = sorted(evaluate.load_semantic_maps_basenames())[:args.number_maps]
+    queries_ids = evaluate.load_queries_ids()
+    human_results = evaluate.load_human_results(semantic_map_basenames)
+    llm_provider_name = constants.LLM_REGISTRY.get_provider_name(args.llm)
+
+    comparison_results = {aggregator: ComparisonResult(n_samples=0) for aggregator in args.aggregators}
+    n_missing = {aggregator: 0 for aggregator in args.aggregators}
+    for semantic_map_basename in semantic_map_basenames:
+        for query_id in queries_ids:
+            query_results_folder_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
+                                                     args.mode,
+                                                     constants.get_method_folder(constants.METHOD_ENSEMBLE),
+                                                     llm_provider_name,
+                                                     semantic_map_basename,
+                                                     query_id)
+            human_result = human_results[semantic_map_basename][query_id]
+            for aggregator in args.aggregators:
+                relevant_objects = get_final_plan(query_results_folder_path, aggregator, args.save)
+                if relevant_objects is None:
+                    n_missing[aggregator] += 1
+                    continue
+                comparison_results[aggregator] += evaluate.compare_human_ai_results(relevant_objects,
+                                                                                   human_result)
+
+    print(f"{'aggregator':<12}{'queries':>8}{'missing':>8}{'top 1':>8}{'top 2':>8}{'top 3':>8}{'top any':>8}")
+    for aggregator, comparison_result in comparison_results.items():
+        if comparison_result.get_n_samples() == 0:
+            print(f"{aggregator:<12}{0:>8}{n_missing[aggregator]:>8}")
+            continue
+        print(f"{aggregator:<12}{comparison_result.get_n_samples():>8}{n_missing[aggregator]:>8}"
+              f"{comparison_result.get_top_1_rate():>8.1%}{comparison_result.get_top_2_rate():>8.1%}"
+              f"{comparison_result.get_top_3_rate():>8.1%}{comparison_result.get_top_any_rate():>8.1%}")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Compares the accuracy of the chooser LLM and the local aggregators of the LLM Ensemble workflow over the stored plans, with no LLM call")
+
+    parser.add_argument("-n", "--number-maps",
+                        help="Number of semantic maps whose responses will be aggregated. Semantic maps are processed in alphabetical order.",
+                        type=int,
+                        default=10)
+
+    parser.add_argument("--mode",
+                        help="Semantic maps input mode to LLMs, with uncertainty or not.",
+                        type=str,
+                        choices=[constants.MODE_CERTAINTY,
+                                 constants.MODE_UNCERTAINTY],
+                        default=constants.MODE_CERTAINTY)
+
+    parser.add_argument("-l", "--llm",
+                        help="LLM of the LLM Ensemble workflow (the chooser LLM).",
+                        type=str,
+                        choices=constants.LLM_REGISTRY.get_constants(),
+                        default=constants.LLM_GEMINI_1_5_PRO)
+
+    parser.add_argument("-a", "--aggregators",
+                        help="Aggregators to compare.",
+                        type=str,
+                        nargs="+",
+                        choices=constants.ENSEMBLE_AGGREGATORS,
+                        default=constants.ENSEMBLE_AGGREGATORS)
+
+    parser.add_argument("--save",
+                        help="Save the final plan of every local aggregator next to the plans (aggregate_<aggregator>.json).",
+                        action="store_true")
+
+    parser.add_argument("--map-encoding",
+                        help="Encoding of the semantic maps with which the responses were obtained.",
+                        type=str,
+                        choices=constants.MAP_ENCODINGS,
+                        default=constants.MAP_ENCODING)
+
+    parser.add_argument("--prune-maps",
+                        help="Aggregate the responses obtained with pruned semantic maps.",
+                        action="store_true")
+
+    parser.add_argument("--adaptive-ensemble",
+                        help="Aggregate the responses obtained with adaptive sampling.",
+                        action="store_true")
+
+    args = parser.parse_args()
+
+    compare_aggregators(args)
@@ -0,0 +1,273 @@
+import argparse
+import copy
+import os
+import shutil
+import tempfile
+import time
+
+import constants
+import main
+from llm import telemetry, tracing
+from llm.fake_provider import LATENCY_DISTRIBUTIONS, FakeLlmProvider
+from llm.retry_policy import ProviderCallError
+from voxelad import preprocess
+from workflow import executor
+
+
+def benchmark_method(args, method: str, pre_processed_semantic_maps: list, queries: list) -> dict:
+    # New provider for every method, so the statistics are not mixed
+    llm_provider = constants.create_fake_provider(latency_distribution=args.latency_distribution,
+                                                  latency_mean=args.latency_mean,
+                                                  latency_stddev=args.latency_stddev,
+                                                  failure_rate=args.failure_rate,
+                                                  malformed_json_rate=args.malformed_json_rate,
+                                                  seed=args.seed,
+                                                  max_samples_per_call=args.max_samples_per_call,
+                                                  plan_agreement_rate=args.plan_agreement_rate,
+                                                  correction_fixpoint_rate=args.correction_fixpoint_rate,
+                                                  corrected_pass_rate=args.corrected_pass_rate)
+    llm_provider.set_streaming(args.streaming)
+    llm_provider.set_context_caching(args.context_caching)
+    # Latency by stage, only kept in memory
+    method_telemetry = telemetry.Telemetry()
+    llm_provider.set_telemetry(method_telemetry)
+
+    coroutines = [coroutine
+                  for semantic_map in pre_processed_semantic_maps
+                  for coroutine in main.plan_queries(method, args.mode, semantic_map, llm_provider,
+                                                     queries, args.reflection_iterations, args.batch_size)]
+    n_queries = len(pre_processed_semantic_maps) * len(queries)
+
+    start_time = time.time()
+    with tracing.span(method, "run"):
+        executor.run(executor.gather_with_concurrency(coroutines,
+                                                      max_concurrency=args.max_concurrency,
+                                                      desc=f"Benchmarking {method}...",
+                                                      skipped_errors=(ProviderCallError,),
+                                                      max_calls=args.max_calls),
+                     max_workers=main.get_max_workers(args.max_concurrency, [method], args.max_calls))
+    end_time = time.time()
+
+    method_telemetry.print_summary()
+
+    statistics = llm_provider.get_statistics()
+    wall_time = end_time - start_time
+    return {
+        "method": method,
+        "queries": n_queries,
+        "calls": statistics["fake_calls"],
+        "wall_time": wall_time,
+        "queries_per_second": n_queries / wall_time,
+        "calls_per_second": statistics["fake_calls"] / wall_time,
+        # Average number of calls waiting for the (fake) provider at the same time
+        "calls_in_flight": statistics["fake_latency_time"] / wall_time,
+        "json_repaired": statistics["json_repaired"],
+        "json_failed": statistics["json_failed"],
+        "input_tokens": statistics["input_tokens"],
+        "output_tokens": statistics["output_tokens"],
+        "cached_input_tokens": statistics["cached_input_tokens"],
+    }
+
+
+def benchmark(args):
+    constants.set_map_encoding(args.map_encoding)
+    constants.set_map_pruning(args.prune_maps)
+    constants.set_convergence_policy(args.early_exit, args.convergence_score)
+    constants.set_adaptive_ensemble(args.adaptive_ensemble, args.agreement_threshold, args.min_samples)
+    constants.set_ensemble_aggregator(args.aggregator)
+    # Load and pre-process semantic maps and queries
+    semantic_maps = main.load_semantic_maps()[:args.number_maps]
+    queries = main.load_queries()[:args.number_queries]
+    pre_processed_semantic_maps = [
+        (s_m_b, preprocess.preprocess_semantic_map(copy.deepcopy(s_m_o),
+                                                   class_uncertainty=(args.mode == constants.MODE_UNCERTAINTY)))
+        for s_m_b, s_m_o in semantic_maps]
+
+    # Responses are written to a temporary folder, so the real results are not touched
+    results_folder_path = tempfile.mkdtemp(prefix="llm_benchmark_")
+    constants.LLM_RESULTS_FOLDER_PATH = results_folder_path
+    constants.set_plan_sharing(args.share_plans, os.path.join(results_folder_path, "shared_plans"))
+
+    # The methods are benchmarked one after the other, in the same trace
+    tracer = main.create_tracer(args.trace_file)
+    try:
+        results = [benchmark_method(args, method, pre_processed_semantic_maps, queries)
+                   for method in args.methods]
+    finally:
+        shutil.rmtree(results_folder_path, ignore_errors=True)
+    main.export_trace(tracer, args.trace_file)
+    main.print_pruning_statistics()
+    main.print_convergence_statistics()
+    main.print_ensemble_statistics()
+    main.print_plan_sharing_statistics()
+
+    print(f"{'method':<24}{'queries':>8}{'calls':>8}{'wall (s)':>10}"
+          f"{'query/s':>9}{'call/s':>8}{'in flight':>10}{'repaired':>9}{'failed':>7}"
+          f"{'in tokens':>11}{'cached':>11}{'out tokens':>11}")
+    for result in results:
+        print(f"{result['method']:<24}{result['queries']:>8}{result['calls']:>8}"
+              f"{result['wall_time']:>10.2f}{result['queries_per_second']:>9.2f}"
+              f"{result['calls_per_second']:>8.2f}{result['calls_in_flight']:>10.2f}"
+              f"{result['json_repaired']:>9}{result['json_failed']:>7}"
+              f"{result['input_tokens']:>11}{result['cached_input_tokens']:>11}{result['output_tokens']:>11}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the throughput of the agentic workflows with a fake LLM provider (no network nor credentials required)")
+
+    parser.add_argument("-n", "--number-maps",
+                        help="Number of semantic maps on which the queries will be planned.",
+                        type=int,
+                        default=2)
+
+    parser.add_argument("-q", "--number-queries",
+                        help="Number of queries planned on every semantic map.",
+                        type=int,
+                        default=None)
+
+    parser.add_argument("--mode",
+                        help="Semantic maps input mode to LLMs, with uncertainty or not.",
+                        type=str,
+                        choices=[constants.MODE_CERTAINTY,
+                                 constants.MODE_UNCERTAINTY],
+                        default=constants.MODE_CERTAINTY)
+
+    parser.add_argument("--methods",
+                        help="Agentic workflows to benchmark.",
+                        type=str,
+                        nargs="+",
+                        choices=constants.METHODS,
+                        default=constants.METHODS)
+
+    parser.add_argument("-i", "--reflection-iterations",
+                        help="Number of reflection iterations",
+                        type=int,
+                        default=2)
+
+    parser.add_argument("-c", "--max-concurrency",
+                        help="Maximum number of queries processed concurrently.",
+                        type=int,
+                        default=8)
+
+    parser.add_argument("--max-calls",
+                        help="Maximum number of LLM calls in flight, pipelining the queries (see run_matrix.py).",
+                        type=int,
+                        default=None)
+
+    parser.add_argument("--latency-distribution",
+                        help="Distribution of the latency of the fake LLM calls.",
+                        type=str,
+                        choices=LATENCY_DISTRIBUTIONS,
+                        default=constants.FAKE_LLM_SETTINGS["latency_distribution"])
+
+    parser.add_argument("--latency-mean",
+                        help="Mean latency of the fake LLM calls in seconds.",
+                        type=float,
+                        default=0.2)
+
+    parser.add_argument("--latency-stddev",
+                        help="Standard deviation of the latency of the fake LLM calls in seconds.",
+                        type=float,
+                        default=0.1)
+
+    parser.add_argument("--failure-rate",
+                        help="Probability of a fake LLM call failing with a transient error.",
+                        type=float,
+                        default=0.0)
+
+    parser.add_argument("--malformed-json-rate",
+                        help="Probability of a fake JSON response being malformed.",
+                        type=float,
+                        default=0.0)
+
+    parser.add_argument("--seed",
+                        help="Seed of the fake latencies and injected errors.",
+                        type=int,
+                        default=0)
+
+    parser.add_argument("--max-samples-per-call",
+                        help="Maximum number of samples (e.g. ensemble plans) generated by a single fake LLM call, 1 for one call per sample.",
+                        type=int,
+                        default=FakeLlmProvider.MAX_SAMPLES_PER_CALL)
+
+    parser.add_argument("--plan-agreement-rate",
+                        help="Probability of a sample of a fake plan (e.g. an ensemble planner) being the same plan as the first sample.",
+                        type=float,
+                        default=constants.FAKE_LLM_SETTINGS["plan_agreement_rate"])
+
+    parser.add_argument("--correction-fixpoint-rate",
+                        help="Probability of a fake correction keeping the relevant objects of the plan it corrects.",
+                        type=float,
+                        default=constants.FAKE_LLM_SETTINGS["correction_fixpoint_rate"])
+
+    parser.add_argument("--corrected-pass-rate",
+                        help="Probability of a fake reflection on a corrected plan scoring every section 9 or more.",
+                        type=float,
+                        default=constants.FAKE_LLM_SETTINGS["corrected_pass_rate"])
+
+    parser.add_argument("--early-exit",
+                        help="Stop the reflection iterations of a query when the critic is satisfied or a correction does not change the plan.",
+                        action="store_true")
+
+    parser.add_argument("--convergence-score",
+                        help="Minimum score (out of 10) of every section of a reflection to stop with --early-exit.",
+                        type=float,
+                        default=9)
+
+    parser.add_argument("--aggregator",
+                        help="Final step of the LLM Ensemble workflow: the chooser LLM call or a local aggregator of the plans.",
+                        type=str,
+                        choices=constants.ENSEMBLE_AGGREGATORS,
+                        default=constants.ENSEMBLE_AGGREGATOR)
+
+    parser.add_argument("--share-plans",
+                        help="Share the first plan of every query between the Base, Self-Reflection and LLM Ensemble workflows.",
+                        action="store_true")
+
+    parser.add_argument("--adaptive-ensemble",
+                        help="Sample the ensemble planners incrementally until they agree, skipping the chooser if they are unanimous.",
+                        action="store_true")
+
+    parser.add_argument("--agreement-threshold",
+                        help="Fraction of the plans with the same ranked relevant objects at which --adaptive-ensemble stops sampling.",
+                        type=float,
+                        default=0.6)
+
+    parser.add_argument("--min-samples",
+                        help="Plans sampled at once by --adaptive-ensemble before measuring their agreement.",
+                        type=int,
+                        default=3)
+
+    parser.add_argument("-b", "--batch-size",
+                        help="Number of queries planned in a single LLM call in the base workflow.",
+                        type=int,
+                        default=1)
+
+    parser.add_argument("--streaming",
+                        help="Stream JSON responses.",
+                        action="store_true")
+
+    parser.add_argument("--map-encoding",
+                        help="Encoding of the semantic maps in the prompts.",
+                        type=str,
+                        choices=constants.MAP_ENCODINGS,
+                        default=constants.MAP_ENCODING)
+
+    parser.add_argument("--prune-maps",
+                        help="Prune the semantic map of every query to the objects relevant to it and their neighbours.",
+                        action="store_true")
+
+    parser.add_argument("--context-caching",
+                        help="Cache the prompt prefix with the semantic map (only the cached tokens are accounted).",
+                        action="store_true")
+
+    parser.add_argument("--trace-file",
+                        help="Chrome trace JSON file to which the spans of the benchmark are written. Tracing is disabled by default.",
+                        type=str,
+                        default=None)
+
+    args = parser.parse_args()
+
+    benchmark(args)
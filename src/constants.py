@@ -2,8 +2,10 @@ import os
 
 from dotenv import load_dotenv
 
-from llm.google_gemini_provider import GoogleGeminiProvider
-from llm.openai_gpt_provider import OpenAiGptProvider
+from llm.provider_registry import ProviderRegistry
+from llm.rate_limiter import RateLimiter
+from voxelad import pruning, serialization
+from workflow import convergence, ensemble, plan_store
 
 load_dotenv()
 
@@ -14,6 +16,10 @@ GOOGLE_GEMINI_PROJECT_LOCATION = "us-central1"
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# Optional base URLs of the APIs (e.g. the local stand-in server, see serve_stand_in.py)
+GOOGLE_GEMINI_BASE_URL = os.getenv("GOOGLE_GEMINI_BASE_URL")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+
 # Paths
 SEMANTIC_MAPS_FOLDER_PATH = "data/semantic_maps/"
 DATA_FOLDER_PATH = "data/"
@@ -22,6 +28,9 @@ GROUND_TRUTH_FOLDER_PATH = "data/responses"
 QUERIES_FILE_PATH = "data/queries.yaml"
 
 LLM_RESULTS_FOLDER_PATH = "results/llm_results"
+LLM_CACHE_FOLDER_PATH = "results/llm_cache"
+TELEMETRY_FOLDER_PATH = "results/telemetry"
+SHARED_PLANS_FOLDER_PATH = "results/shared_plans"
 
 # Code constants
 MODE_CERTAINTY = "certainty"
@@ -34,17 +43,146 @@ METHOD_ENSEMBLE = "ensemble"
 METHODS = [METHOD_BASE, METHOD_SELF_REFLECTION,
            METHOD_MULTIAGENT_REFLECTION, METHOD_ENSEMBLE]
 
+# Encodings of the semantic maps in the prompts
+MAP_ENCODINGS = serialization.ENCODINGS
+# Encoding of the current run (see `set_map_encoding`)
+MAP_ENCODING = serialization.ENCODING_JSON
+
+
+def set_map_encoding(map_encoding: str):
+    """
+    Sets the encoding of the semantic maps in the prompts. Responses obtained with other
+    encodings than JSON are saved in their own results folder (e.g.
+    "results/llm_results_table"), so they are not mixed with the original ones.
+    """
+    global MAP_ENCODING, LLM_RESULTS_FOLDER_PATH
+    if map_encoding != serialization.ENCODING_JSON:
+        LLM_RESULTS_FOLDER_PATH = f"{LLM_RESULTS_FOLDER_PATH}_{map_encoding}"
+    MAP_ENCODING = map_encoding
+
+
+# Pruner of the semantic maps of the current run, None if the whole maps are sent (see
+# `set_map_pruning`)
+MAP_PRUNER = None
+
+
+def set_map_pruning(enabled: bool):
+    """
+    Enables the query-aware pruning of the semantic maps in the prompts. Responses
+    obtained with pruned maps are saved in their own results folder (e.g.
+    "results/llm_results_pruned").
+    """
+    global MAP_PRUNER, LLM_RESULTS_FOLDER_PATH
+    if not enabled:
+        MAP_PRUNER = None
+        return
+    MAP_PRUNER = pruning.MapPruner()
+    LLM_RESULTS_FOLDER_PATH = f"{LLM_RESULTS_FOLDER_PATH}_pruned"
+
+
+# Convergence policy of the reflection workflows of the current run, None if every
+# reflection iteration is run (see `set_convergence_policy`)
+CONVERGENCE_POLICY = None
+
+
+def set_convergence_policy(enabled: bool, score_threshold: float = 9):
+    """
+    Enables the early exit of the reflection iterations of the reflection workflows (see
+    `ConvergencePolicy`). Responses of the reflection workflows obtained with early exit
+    are saved in their own method folders, by score threshold (e.g.
+    "self_reflection_early_exit_9", see `get_method_folder`).
+    """
+    global CONVERGENCE_POLICY
+    if not enabled:
+        CONVERGENCE_POLICY = None
+        return
+    CONVERGENCE_POLICY = convergence.ConvergencePolicy(score_threshold=score_threshold)
+
+
+def get_method_folder(method: str) -> str:
+    """
+    Returns the name of the results folder of a workflow in the current run: the name of
+    the method, with a suffix if the responses of the workflow depend on a policy of the
+    run (e.g. "self_reflection_early_exit_9" with early exit, "ensemble_adaptive" with
+    adaptive sampling), so they are not mixed with the original ones.
+    """
+    if CONVERGENCE_POLICY is not None and method in (METHOD_SELF_REFLECTION, METHOD_MULTIAGENT_REFLECTION):
+        if CONVERGENCE_POLICY.score_threshold is None:
+            return f"{method}_early_exit"
+        return f"{method}_early_exit_{CONVERGENCE_POLICY.score_threshold:g}"
+    if ADAPTIVE_ENSEMBLE is not None and method == METHOD_ENSEMBLE:
+        return f"{method}_adaptive"
+    return method
+
+
+# Fields of a plan (response of the planner prompts)
+PLAN_KEYS = ["inferred_query", "query_achievable", "relevant_objects", "explanation"]
+
+# Number of planners in the LLM Ensemble workflow
+ENSEMBLE_SIZE = 6
+
+# Final step of the LLM Ensemble workflow: the chooser LLM call or a local aggregator
+# of the plans (see `set_ensemble_aggregator`)
+ENSEMBLE_AGGREGATORS = [ensemble.AGGREGATOR_CHOOSER] + list(ensemble.AGGREGATORS)
+ENSEMBLE_AGGREGATOR = ensemble.AGGREGATOR_CHOOSER
+
+
+def set_ensemble_aggregator(aggregator: str):
+    """
+    Sets the final step of the LLM Ensemble workflow. Local aggregators write the final
+    plan ("aggregate_<aggregator>.json") next to the plans, instead of the choice of the
+    chooser LLM.
+    """
+    global ENSEMBLE_AGGREGATOR
+    ENSEMBLE_AGGREGATOR = aggregator
+
+
+# Adaptive sampling policy of the LLM Ensemble workflow of the current run, None if every
+# planner is sampled (see `set_adaptive_ensemble`)
+ADAPTIVE_ENSEMBLE = None
+
+
+def set_adaptive_ensemble(enabled: bool, agreement_threshold: float = 0.6, min_samples: int = 3):
+    """
+    Enables the adaptive sampling of the planners of the LLM Ensemble workflow (see
+    `AdaptiveEnsemblePolicy`). Responses of the LLM Ensemble workflow obtained with
+    adaptive sampling are saved in their own method folder ("ensemble_adaptive", see
+    `get_method_folder`).
+    """
+    global ADAPTIVE_ENSEMBLE
+    if not enabled:
+        ADAPTIVE_ENSEMBLE = None
+        return
+    ADAPTIVE_ENSEMBLE = ensemble.AdaptiveEnsemblePolicy(agreement_threshold=agreement_threshold,
+                                                        min_samples=min_samples,
+                                                        max_samples=ENSEMBLE_SIZE)
+
+
+# Store of the first plans shared by the workflows of the current run, None if every
+# workflow generates its own (see `set_plan_sharing`)
+PLAN_STORE = None
+
+
+def set_plan_sharing(enabled: bool, folder_path: str = SHARED_PLANS_FOLDER_PATH):
+    """
+    Enables the sharing of the first plan of the queries between the Base,
+    Self-Reflection and LLM Ensemble workflows (see `PlanStore`). Shared plans are kept
+    in their own folder, and the plans reused by every workflow are saved in the run
+    metadata of its results folder ("run_metadata.json").
+    """
+    global PLAN_STORE
+    PLAN_STORE = plan_store.PlanStore(folder_path) if enabled else None
+
+
 LLM_GEMINI_1_0_PRO = "g10p"
 LLM_GEMINI_1_5_PRO = "g15p"
+LLM_GPT_3_5_TURBO = "gpt35t"
+LLM_GPT_4_O = "gpt4o"
+LLM_FAKE = "fake"
 
 
 def get_llm_provider_name_from_constant(constant_value: str):
-    if constant_value == LLM_GEMINI_1_0_PRO:
-        return "Google_gemini-1.0-pro"
-    elif constant_value == LLM_GEMINI_1_5_PRO:
-        return "Google_gemini-1.5-pro"
-    else:
-        raise ValueError(f"Constant value {constant_value} not known")
+    return LLM_REGISTRY.get_provider_name(constant_value)
 
 
 METRIC_TOP_1 = "top_1"
@@ -69,23 +207,92 @@ EVALUATION_TABLE_WORKFLOWS_GENERAL = "table_workflows_general"
 EVALUATION_CHART_COMPLEXITY = "chart_complexity"
 EVALUATION_REFLECTION_ERRORS = "reflection_errors"
 
-# LLM models
-GEMINI_1_0_PRO = GoogleGeminiProvider(credentials_file=GOOGLE_GEMINI_CREDENTIALS_FILENAME,
-                                      project_id=GOOGLE_GEMINI_PROJECT_ID,
-                                      project_location=GOOGLE_GEMINI_PROJECT_LOCATION,
-                                      model_name=GoogleGeminiProvider.GEMINI_1_0_PRO)
+# LLM rate limits (requests and tokens per minute), by provider name.
+# Default quotas of a new account, they should be adjusted to the real quota of the account
+LLM_RATE_LIMITS = {
+    "Google_gemini-1.0-pro": {"requests_per_minute": 300, "tokens_per_minute": None},
+    "Google_gemini-1.5-pro": {"requests_per_minute": 60, "tokens_per_minute": None},
+    "OpenAI_gpt-3.5-turbo": {"requests_per_minute": 3500, "tokens_per_minute": 200000},
+    "OpenAI_gpt-4o": {"requests_per_minute": 500, "tokens_per_minute": 30000},
+}
+
+
+# LLM token prices (USD per million input, cached input and output tokens), by provider
+# name. List prices of the standard tier, used to estimate the cost of the runs (the
+# storage of the Gemini cached contents is not included)
+LLM_TOKEN_PRICES = {
+    "Google_gemini-1.0-pro": {"input": 0.5, "output": 1.5},
+    "Google_gemini-1.5-pro": {"input": 3.5, "cached_input": 0.875, "output": 10.5},
+    "OpenAI_gpt-3.5-turbo": {"input": 0.5, "output": 1.5},
+    "OpenAI_gpt-4o": {"input": 5.0, "cached_input": 2.5, "output": 15.0},
+}
+
+
+def create_rate_limiter(provider_name: str):
+    if provider_name not in LLM_RATE_LIMITS:
+        return None
+    return RateLimiter(**LLM_RATE_LIMITS[provider_name])
+
+
+# LLM models (built on first use)
+def create_gemini_provider(model_name: str):
+    from llm.google_gemini_provider import GoogleGeminiProvider
+    llm_provider = GoogleGeminiProvider(credentials_file=GOOGLE_GEMINI_CREDENTIALS_FILENAME,
+                                        project_id=GOOGLE_GEMINI_PROJECT_ID,
+                                        project_location=GOOGLE_GEMINI_PROJECT_LOCATION,
+                                        model_name=model_name,
+                                        base_url=GOOGLE_GEMINI_BASE_URL)
+    llm_provider.set_rate_limiter(
+        create_rate_limiter(llm_provider.get_provider_name()))
+    llm_provider.set_token_prices(
+        LLM_TOKEN_PRICES.get(llm_provider.get_provider_name()))
+    return llm_provider
+
+
+def create_openai_provider(model_name: str):
+    from llm.openai_gpt_provider import OpenAiGptProvider
+    llm_provider = OpenAiGptProvider(openai_api_key=OPENAI_API_KEY,
+                                     model_name=model_name,
+                                     max_output_tokens=4096,
+                                     base_url=OPENAI_BASE_URL)
+    llm_provider.set_rate_limiter(
+        create_rate_limiter(llm_provider.get_provider_name()))
+    llm_provider.set_token_prices(
+        LLM_TOKEN_PRICES.get(llm_provider.get_provider_name()))
+    return llm_provider
+
+
+# Fake LLM (no network nor credentials), to run and benchmark the workflows offline
+FAKE_LLM_SETTINGS = {
+    "latency_distribution": "lognormal",
+    "latency_mean": 2.0,
+    "latency_stddev": 1.0,
+    "failure_rate": 0.0,
+    "malformed_json_rate": 0.0,
+    # Convergence of the workflows (see FakeLlmProvider)
+    "plan_agreement_rate": 0.5,
+    "correction_fixpoint_rate": 0.5,
+    "corrected_pass_rate": 0.5,
+}
+
 
-GEMINI_1_5_PRO = GoogleGeminiProvider(credentials_file=GOOGLE_GEMINI_CREDENTIALS_FILENAME,
-                                      project_id=GOOGLE_GEMINI_PROJECT_ID,
-                                      project_location=GOOGLE_GEMINI_PROJECT_LOCATION,
-                                      model_name=GoogleGeminiProvider.GEMINI_1_5_PRO)
+def create_fake_provider(**settings):
+    from llm.fake_provider import FakeLlmProvider
+    return FakeLlmProvider(**(FAKE_LLM_SETTINGS | settings))
 
-CHAT_GPT_3_5_TURBO = OpenAiGptProvider(openai_api_key=OPENAI_API_KEY,
-                                       model_name=OpenAiGptProvider.GPT_3_5_TURBO,
-                                       max_output_tokens=4096)
 
-CHAT_GPT_4_O = OpenAiGptProvider(openai_api_key=OPENAI_API_KEY,
-                                 model_name=OpenAiGptProvider.GPT_4_O,
-                                 max_output_tokens=4096)
+LLM_REGISTRY = ProviderRegistry()
+LLM_REGISTRY.register(LLM_GEMINI_1_0_PRO, "Google_gemini-1.0-pro",
+                      lambda: create_gemini_provider("gemini-1.0-pro"))
+LLM_REGISTRY.register(LLM_GEMINI_1_5_PRO, "Google_gemini-1.5-pro",
+                      lambda: create_gemini_provider("gemini-1.5-pro"))
+LLM_REGISTRY.register(LLM_GPT_3_5_TURBO, "OpenAI_gpt-3.5-turbo",
+                      lambda: create_openai_provider("gpt-3.5-turbo"))
+LLM_REGISTRY.register(LLM_GPT_4_O, "OpenAI_gpt-4o",
+                      lambda: create_openai_provider("gpt-4o"))
+LLM_REGISTRY.register(LLM_FAKE, "Fake_fake",
+                      create_fake_provider)
 
-LLM_PROVIDERS = [GEMINI_1_0_PRO, GEMINI_1_5_PRO]
+# LLMs evaluated in the paper
+LLM_PROVIDER_NAMES = [LLM_REGISTRY.get_provider_name(LLM_GEMINI_1_0_PRO),
+                      LLM_REGISTRY.get_provider_name(LLM_GEMINI_1_5_PRO)]
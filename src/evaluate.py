@@ -2,6 +2,7 @@
 
 import argparse
 import os
+import re
 
 import pandas as pd
 import tqdm
@@ -12,7 +13,9 @@ from results import chart_semantic_map_complexity, table_workflows_comparison
 from results.table_workflows_general_comparison import (
     TableWorkflowsGeneralComparisonGenerator,
 )
-from utils import file_utils
+from utils import file_utils, text_utils
+from voxelad import preprocess
+from workflow import ensemble
 
 
 def load_semantic_maps_basenames():
@@ -41,6 +44,67 @@ def load_queries_ids():
     return queries_ids
 
 
+def get_ensemble_chosen_plan_file_path(query_results_folder_path: str) -> str:
+    """
+    Returns the path of the plan chosen by the chooser LLM of the LLM Ensemble workflow
+    for a query.
+    """
+    # Get choice
+    choice_file_paths = file_utils.find_matching_files(
+        query_results_folder_path, r"choice_\d+\.json")
+
+    if len(choice_file_paths) == 0:
+        raise ValueError(
+            "Not found 'choice_x.json' file")
+
+    choice_file_path = choice_file_paths[0]
+
+    # Get chosen response
+    choice = file_utils.load_json(choice_file_path)
+    chosen_response_idx = int(
+        choice["chosen_response"])
+
+    final_plan_file_paths = file_utils.find_matching_files(
+        query_results_folder_path, fr"plan_[a-zA-Z0-9\.\-_]+_{chosen_response_idx}\.json")
+
+    if len(final_plan_file_paths) == 0:
+        raise ValueError(
+            "Not found 'plan_x_y.json' file")
+
+    return final_plan_file_paths[0]
+
+
+def load_ensemble_plan_responses(query_results_folder_path: str) -> list:
+    """
+    Loads the plans of the planners of the LLM Ensemble workflow of a query
+    ("plan_<provider>_<index>.json"), ordered by planner index.
+    """
+    plan_file_paths = file_utils.find_matching_files(
+        query_results_folder_path, r"plan_[a-zA-Z0-9\.\-_]+_\d+\.json")
+    plan_file_paths.sort(key=lambda plan_file_path: int(
+        re.search(r"_(\d+)\.json$", plan_file_path).group(1)))
+    return [text_utils.dict_to_json_str(file_utils.load_json(plan_file_path))
+            for plan_file_path in plan_file_paths]
+
+
+def load_ensemble_aggregate_plan(query_results_folder_path: str, aggregator: str) -> dict:
+    """
+    Loads the final plan of a local aggregator of the LLM Ensemble workflow for a query
+    ("aggregate_<aggregator>.json", written by the run), or aggregates the stored plans
+    if the run used another final step (e.g. the chooser).
+    """
+    aggregate_file_path = os.path.join(query_results_folder_path,
+                                       ensemble.get_aggregate_file_name(aggregator))
+    if os.path.exists(aggregate_file_path):
+        return file_utils.load_json(aggregate_file_path)
+
+    plan_responses = load_ensemble_plan_responses(query_results_folder_path)
+    if len(plan_responses) == 0:
+        raise ValueError(
+            "Not found 'plan_x_y.json' files")
+    return ensemble.aggregate_plans(plan_responses, aggregator)
+
+
 def load_ai_results(reflection_iterations: int, semantic_map_basenames: list, queries_ids: list):
     data = dict()
     n_not_loaded_responses = 0
@@ -53,20 +117,19 @@ def load_ai_results(reflection_iterations: int, semantic_map_basenames: list, qu
         for method in (constants.METHOD_BASE, constants.METHOD_SELF_REFLECTION, constants.METHOD_MULTIAGENT_REFLECTION, constants.METHOD_ENSEMBLE):
             data[mode][method] = dict()
 
-            for llm in constants.LLM_PROVIDERS:
-                data[mode][method][llm.get_provider_name()] = dict()
+            for llm_provider_name in constants.LLM_PROVIDER_NAMES:
+                data[mode][method][llm_provider_name] = dict()
 
                 for semantic_map_basename in semantic_map_basenames:
-                    data[mode][method][llm.get_provider_name(
-                    )][semantic_map_basename] = dict()
+                    data[mode][method][llm_provider_name][semantic_map_basename] = dict()
 
                     for query_id in queries_ids:
                         try:
                             # Get final response file path
                             query_results_folder_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
                                                                      mode,
-                                                                     method,
-                                                                     llm.get_provider_name(),
+                                                                     constants.get_method_folder(method),
+                                                                     llm_provider_name,
                                                                      semantic_map_basename,
                                                                      query_id)
 
@@ -75,33 +138,19 @@ def load_ai_results(reflection_iterations: int, semantic_map_basenames: list, qu
                                                                     "final_plan.json")
 
                             elif method in (constants.METHOD_SELF_REFLECTION, constants.METHOD_MULTIAGENT_REFLECTION):
+                                # With early exit, queries may stop before the last iteration
                                 final_plan_file_path = os.path.join(query_results_folder_path,
-                                                                    f"plan_{reflection_iterations}.json")
-
-                            elif method == constants.METHOD_ENSEMBLE:
-                                # Get choice
-                                choice_file_paths = file_utils.find_matching_files(
-                                    query_results_folder_path, r"choice_\d+\.json")
-
-                                if len(choice_file_paths) == 0:
-                                    raise ValueError(
-                                        "Not found 'choice_x.json' file")
+                                                                    "final_plan.json" if constants.CONVERGENCE_POLICY is not None else f"plan_{reflection_iterations}.json")
 
-                                choice_file_path = choice_file_paths[0]
+                            elif method == constants.METHOD_ENSEMBLE and constants.ENSEMBLE_AGGREGATOR != ensemble.AGGREGATOR_CHOOSER:
+                                # Final plan of the aggregator (no LLM call)
+                                data[mode][method][llm_provider_name][semantic_map_basename][query_id] = load_ensemble_aggregate_plan(
+                                    query_results_folder_path, constants.ENSEMBLE_AGGREGATOR)["relevant_objects"]
+                                continue
 
-                                # Get chosen response
-                                choice = file_utils.load_json(choice_file_path)
-                                chosen_response_idx = int(
-                                    choice["chosen_response"])
-
-                                final_plan_file_paths = file_utils.find_matching_files(
-                                    query_results_folder_path, fr"plan_[a-zA-Z0-9\.\-_]+_{chosen_response_idx}\.json")
-
-                                if len(final_plan_file_paths) == 0:
-                                    raise ValueError(
-                                        "Not found 'plan_x_y.json' file")
-
-                                final_plan_file_path = final_plan_file_paths[0]
+                            elif method == constants.METHOD_ENSEMBLE:
+                                final_plan_file_path = get_ensemble_chosen_plan_file_path(
+                                    query_results_folder_path)
 
                             if not os.path.exists(final_plan_file_path):
                                 raise ValueError(
@@ -121,14 +170,12 @@ def load_ai_results(reflection_iterations: int, semantic_map_basenames: list, qu
                                 raise ValueError(
                                     "Response's 'relevant_objects' is not a list")
 
-                            data[mode][method][llm.get_provider_name(
-                            )][semantic_map_basename][query_id] = response_file_content["relevant_objects"]
+                            data[mode][method][llm_provider_name][semantic_map_basename][query_id] = response_file_content["relevant_objects"]
 
                         except (FileNotFoundError, KeyError, ValueError, IndexError) as e:
                             # print(f"Skipped answer: {
-                            #       mode}\\{method}\\{llm.get_provider_name()}\\{semantic_map_basename}\\{query_id}: {e}")
-                            data[mode][method][llm.get_provider_name(
-                            )][semantic_map_basename][query_id] = None
+                            #       mode}\\{method}\\{llm_provider_name}\\{semantic_map_basename}\\{query_id}: {e}")
+                            data[mode][method][llm_provider_name][semantic_map_basename][query_id] = None
                             n_not_loaded_responses += 1
 
     if n_not_loaded_responses != 0:
@@ -192,24 +239,20 @@ def compute_all_comparison_results(semantic_map_basenames: list, queries_ids: li
         for method in (constants.METHOD_BASE, constants.METHOD_SELF_REFLECTION, constants.METHOD_MULTIAGENT_REFLECTION, constants.METHOD_ENSEMBLE):
             all_comparison_results[mode][method] = dict()
 
-            for llm in constants.LLM_PROVIDERS:
-                all_comparison_results[mode][method][llm.get_provider_name(
-                )] = dict()
+            for llm_provider_name in constants.LLM_PROVIDER_NAMES:
+                all_comparison_results[mode][method][llm_provider_name] = dict()
 
                 for semantic_map_basename in semantic_map_basenames:
-                    all_comparison_results[mode][method][llm.get_provider_name(
-                    )][semantic_map_basename] = dict()
+                    all_comparison_results[mode][method][llm_provider_name][semantic_map_basename] = dict()
 
                     for query_id in queries_ids:
 
-                        ai_result = ai_results[mode][method][llm.get_provider_name(
-                        )][semantic_map_basename][query_id]
+                        ai_result = ai_results[mode][method][llm_provider_name][semantic_map_basename][query_id]
                         human_result = human_results[semantic_map_basename][query_id]
 
                         comparison_result = compare_human_ai_results(
                             ai_result, human_result)
-                        all_comparison_results[mode][method][llm.get_provider_name(
-                        )][semantic_map_basename][query_id] = comparison_result
+                        all_comparison_results[mode][method][llm_provider_name][semantic_map_basename][query_id] = comparison_result
 
                         if mode == "certainty" and method == "ensembling" and semantic_map_basename == "scannet_scene0000_00.json":
                             print(method)
@@ -253,24 +296,21 @@ def show_reflection_errors(semantic_map_basenames, queries_ids, all_comparison_r
     multiagent_reflection_errors = []
 
     for mode in (constants.MODE_CERTAINTY, constants.MODE_UNCERTAINTY):
-        for llm in constants.LLM_PROVIDERS:
+        for llm_provider_name in constants.LLM_PROVIDER_NAMES:
             for semantic_map_basename in semantic_map_basenames:
                 for query_id in queries_ids:
 
-                    base_cr = all_comparison_results[mode]["base"][llm.get_provider_name(
-                    )][semantic_map_basename][query_id]
-                    self_reflection_cr = all_comparison_results[mode][constants.METHOD_SELF_REFLECTION][llm.get_provider_name(
-                    )][semantic_map_basename][query_id]
-                    multiagent_reflection_cr = all_comparison_results[mode][constants.METHOD_MULTIAGENT_REFLECTION][llm.get_provider_name(
-                    )][semantic_map_basename][query_id]
+                    base_cr = all_comparison_results[mode]["base"][llm_provider_name][semantic_map_basename][query_id]
+                    self_reflection_cr = all_comparison_results[mode][constants.METHOD_SELF_REFLECTION][llm_provider_name][semantic_map_basename][query_id]
+                    multiagent_reflection_cr = all_comparison_results[mode][constants.METHOD_MULTIAGENT_REFLECTION][llm_provider_name][semantic_map_basename][query_id]
 
                     if base_cr > self_reflection_cr:
                         self_reflection_errors.append(
-                            f"{llm.get_provider_name()}/{semantic_map_basename}/{query_id}")
+                            f"{llm_provider_name}/{semantic_map_basename}/{query_id}")
 
                     if base_cr > multiagent_reflection_cr:
                         multiagent_reflection_errors.append(
-                            f"{llm.get_provider_name()}/{semantic_map_basename}/{query_id}")
+                            f"{llm_provider_name}/{semantic_map_basename}/{query_id}")
 
     print(f"SELF_REFLECTION made {len(self_reflection_errors)} errors")
     for error in self_reflection_errors:
@@ -281,7 +321,37 @@ def show_reflection_errors(semantic_map_basenames, queries_ids, all_comparison_r
         print(f"\t{error}")
 
 
+def show_pruning_losses(mode: str, semantic_map_basenames: list, human_results: dict):
+    """
+    Prints the relevant objects (ground truth) of the queries that the map pruning removes
+    from the prompts, so no plan with the pruned maps can find them.
+    """
+    queries_dict = file_utils.load_yaml(constants.QUERIES_FILE_PATH)["queries"]
+    for semantic_map_basename in semantic_map_basenames:
+        semantic_map_object = file_utils.load_json(os.path.join(constants.SEMANTIC_MAPS_FOLDER_PATH,
+                                                                f"{semantic_map_basename}.json"))
+        pre_processed_semantic_map = preprocess.preprocess_semantic_map(semantic_map_object,
+                                                                        class_uncertainty=(mode == constants.MODE_UNCERTAINTY))
+        for query_id, query_text in queries_dict.items():
+            pruned_object_ids = constants.MAP_PRUNER.count_pruned_gold_objects(pre_processed_semantic_map, query_text,
+                                                                               human_results[semantic_map_basename][query_id])
+            if len(pruned_object_ids) > 0:
+                print(f"\t{semantic_map_basename}/{query_id}: {', '.join(pruned_object_ids)} pruned away")
+
+    statistics = constants.MAP_PRUNER.get_statistics()
+    print(f"Map pruning ({mode}): {statistics['pruned_gold_objects']}/{statistics['gold_objects']} relevant objects "
+          f"pruned away, in {statistics['pruned_gold_queries']}/{statistics['gold_queries']} queries; "
+          f"{statistics['fallbacks']}/{statistics['queries']} fallbacks to the whole map, "
+          f"{100 * statistics['reduction_ratio']:.1f}% reduction")
+
+
 def main(args):
+    # Responses of other encodings than JSON are in their own results folder
+    constants.set_map_encoding(args.map_encoding)
+    constants.set_map_pruning(args.prune_maps)
+    constants.set_convergence_policy(args.early_exit, args.convergence_score)
+    constants.set_adaptive_ensemble(args.adaptive_ensemble)
+    constants.set_ensemble_aggregator(args.aggregator)
 
     semantic_map_basenames = load_semantic_maps_basenames()[:args.number_maps]
     semantic_map_sizes = load_semantic_maps_sizes()[:args.number_maps]
@@ -292,6 +362,9 @@ def main(args):
 
     human_results = load_human_results(semantic_map_basenames)
 
+    if constants.MAP_PRUNER is not None:
+        show_pruning_losses(args.mode, semantic_map_basenames, human_results)
+
     all_comparison_results = compute_all_comparison_results(
         semantic_map_basenames, queries_ids, ai_results, human_results, args.reflection_iterations)
 
@@ -385,6 +458,35 @@ if __name__ == "__main__":
                         help="Number of reflection iterations in the Self-Reflection and Multi-Agent Reflection workflows.",
                         default=2)
 
+    parser.add_argument("--map-encoding",
+                        help="Encoding of the semantic maps with which the responses were obtained.",
+                        type=str,
+                        choices=constants.MAP_ENCODINGS,
+                        default=constants.MAP_ENCODING)
+
+    parser.add_argument("--prune-maps",
+                        help="Evaluate the responses obtained with pruned semantic maps, and print the relevant objects that the pruning removes.",
+                        action="store_true")
+
+    parser.add_argument("--early-exit",
+                        help="Evaluate the responses of the reflection workflows obtained with early exit.",
+                        action="store_true")
+
+    parser.add_argument("--convergence-score",
+                        help="Convergence score with which the early exit responses were obtained.",
+                        type=float,
+                        default=9)
+
+    parser.add_argument("--aggregator",
+                        help="Final plan of the LLM Ensemble workflow: the choice of the chooser LLM, or a local aggregation of the stored plans.",
+                        type=str,
+                        choices=constants.ENSEMBLE_AGGREGATORS,
+                        default=constants.ENSEMBLE_AGGREGATOR)
+
+    parser.add_argument("--adaptive-ensemble",
+                        help="Evaluate the responses of the LLM Ensemble workflow obtained with adaptive sampling.",
+                        action="store_true")
+
     args = parser.parse_args()
 
     main(args)
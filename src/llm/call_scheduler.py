@@ -0,0 +1,158 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+
+# Scheduler of the LLM calls awaited in the current context, None if calls are not
+# limited (see `executor.gather_with_concurrency`)
+CURRENT_SCHEDULER = contextvars.ContextVar("current_scheduler", default=None)
+# State of the query whose calls are awaited in the current context
+CURRENT_QUERY = contextvars.ContextVar("current_query", default=None)
+
+
+class QueryState:
+    """
+    State of a query in the pipeline: its admission order (the priority of its calls),
+    the calls it made and when it started and finished.
+    """
+
+    def __init__(self, index: int):
+        self.index = index
+        self.n_calls = 0
+        self.start_time = None
+        self.end_time = None
+
+
+class CallScheduler:
+    """
+    Limits the LLM calls in flight across the queries of a pipeline, instead of the
+    queries in flight.
+
+    The steps of a query (e.g. plan -> reflect -> correct) are serial, but the steps of
+    different queries are not, so many queries are admitted at the same time and their
+    calls share `max_calls` slots: while a query waits for its reflection, the next one
+    is planned. A free slot is granted to the waiting call of the oldest query, so
+    queries already in progress are finished before new ones are started.
+    """
+
+    def __init__(self, max_calls: int):
+        """
+        Initializes the CallScheduler.
+
+        Args:
+            max_calls (int): Maximum number of LLM calls in flight.
+        """
+        self.max_calls = max(1, max_calls)
+        self.n_calls_in_flight = 0
+        # Waiting calls, as (query index, arrival, future) heap entries
+        self.waiting_calls = list()
+        self.arrivals = itertools.count()
+
+        self.queries = list()
+        self.n_calls = 0
+        self.max_calls_in_flight = 0
+
+    def add_query(self) -> QueryState:
+        """
+        Admits a new query in the pipeline.
+
+        Returns:
+            QueryState: The state of the query, to be set in its context (CURRENT_QUERY).
+        """
+        query_state = QueryState(len(self.queries))
+        self.queries.append(query_state)
+        return query_state
+
+    async def _acquire(self, priority: float):
+        if self.n_calls_in_flight < self.max_calls and len(self.waiting_calls) == 0:
+            self.n_calls_in_flight += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiting_calls, (priority, next(self.arrivals), future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                # The slot was already handed over, give it to the next call
+                if future.done() and not future.cancelled():
+                    self._release()
+                raise
+        self.n_calls += 1
+        self.max_calls_in_flight = max(self.max_calls_in_flight, self.n_calls_in_flight)
+
+    def _release(self):
+        # Hand over the slot to the oldest waiting query (the call in flight count is kept)
+        while self.waiting_calls:
+            _, _, future = heapq.heappop(self.waiting_calls)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.n_calls_in_flight -= 1
+
+    @asynccontextmanager
+    async def call_slot(self):
+        """
+        Waits for a free call slot and holds it inside the context.
+        """
+        query_state = CURRENT_QUERY.get()
+        await self._acquire(query_state.index if query_state is not None else float("inf"))
+        if query_state is not None:
+            query_state.n_calls += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    def get_statistics(self) -> dict:
+        """
+        Returns the queries and calls of the pipeline, the maximum calls in flight reached
+        and the mean time from the admission to the end of a query.
+        """
+        finished_queries = [query_state for query_state in self.queries
+                            if query_state.end_time is not None]
+        return {
+            "queries": len(self.queries),
+            "calls": self.n_calls,
+            "max_calls_in_flight": self.max_calls_in_flight,
+            "mean_query_time": (sum(query_state.end_time - query_state.start_time for query_state in finished_queries) /
+                                len(finished_queries)) if finished_queries else 0.0,
+        }
+
+
+@asynccontextmanager
+async def call_slot():
+    """
+    Holds a call slot of the scheduler of the current context inside the context (does
+    nothing if calls are not limited).
+    """
+    scheduler = CURRENT_SCHEDULER.get()
+    if scheduler is None:
+        yield
+        return
+    async with scheduler.call_slot():
+        yield
+
+
+async def run_query(scheduler: CallScheduler, coroutine):
+    """
+    Awaits the coroutine of a query admitted in the scheduler, so its calls share the
+    call slots of the pipeline with the priority of the query.
+
+    Args:
+        scheduler (CallScheduler): The scheduler of the pipeline.
+        coroutine (Coroutine): The coroutine of the query.
+
+    Returns:
+        Any: The value returned by the coroutine.
+    """
+    query_state = scheduler.add_query()
+    scheduler_token = CURRENT_SCHEDULER.set(scheduler)
+    query_token = CURRENT_QUERY.set(query_state)
+    query_state.start_time = time.perf_counter()
+    try:
+        return await coroutine
+    finally:
+        query_state.end_time = time.perf_counter()
+        CURRENT_QUERY.reset(query_token)
+        CURRENT_SCHEDULER.reset(scheduler_token)
@@ -1,6 +1,4 @@
 
-from vertexai.generative_models import Content, Part
-
 from utils.dict_utils import search_dict_by_key_value
 
 ROLE_SYSTEM = "system"
@@ -66,6 +64,9 @@ class ConversationHistory:
                 history. Defaults to an empty list.
         """
         self.conversation_history_list = []
+        # Cacheable prefix: number of messages and, optionally, number of characters of
+        # the last of them (see `mark_cacheable_prefix`)
+        self.cacheable_prefix = None
 
     def __str__(self):
         """
@@ -118,6 +119,51 @@ class ConversationHistory:
         TODO: documentation
         """
         self.conversation_history_list = list()
+        self.cacheable_prefix = None
+
+    def mark_cacheable_prefix(self, prefix_length: int = None):
+        """
+        Marks the messages appended so far as the cacheable prefix of the conversation: a
+        prefix shared by many conversations (e.g. the prompt with the semantic map, shared
+        by every query on the map), which providers supporting context caching send only
+        once and reference afterwards.
+
+        Args:
+            prefix_length (int, optional): Number of characters of the last message that
+                belong to the prefix, if the rest of it is not shared (e.g. the query at the
+                end of a prompt). Defaults to None (the whole message).
+        """
+        self.cacheable_prefix = (len(self.conversation_history_list), prefix_length)
+
+    def split_cacheable_prefix(self):
+        """
+        Splits the conversation history into its cacheable prefix and the rest of it. A
+        message partially in the prefix is split into two messages with the same role.
+
+        Returns:
+            Tuple[ConversationHistory, ConversationHistory]: The prefix and the rest of
+                the conversation history, or (None, the conversation history) if no prefix
+                is marked or nothing follows it.
+        """
+        if self.cacheable_prefix is None:
+            return None, self
+        n_messages, prefix_length = self.cacheable_prefix
+
+        prefix = ConversationHistory()
+        rest = ConversationHistory()
+        prefix.conversation_history_list = [dict(message)
+                                             for message in self.conversation_history_list[:n_messages]]
+        rest.conversation_history_list = [dict(message)
+                                           for message in self.conversation_history_list[n_messages:]]
+        if prefix_length is not None and len(prefix.conversation_history_list) > 0:
+            last_message = prefix.conversation_history_list[-1]
+            rest.conversation_history_list.insert(0, {KEY_ROLE: last_message[KEY_ROLE],
+                                                      KEY_CONTENT: last_message[KEY_CONTENT][prefix_length:]})
+            last_message[KEY_CONTENT] = last_message[KEY_CONTENT][:prefix_length]
+
+        if len(prefix.conversation_history_list) == 0 or len(rest.conversation_history_list) == 0:
+            return None, self
+        return prefix, rest
 
     def get_chat_gpt_conversation_history(self):
         """
@@ -139,6 +185,9 @@ class ConversationHistory:
                 - str: The system instruction extracted from the conversation.
                 - list: A list of formatted Content objects for the Gemini API.
         """
+        # Imported here, so the Vertex AI SDK is only needed by Gemini providers
+        from vertexai.generative_models import Content, Part
+
         # Get system instruction
         system_message = search_dict_by_key_value(
             self.conversation_history_list, KEY_ROLE, ROLE_SYSTEM)
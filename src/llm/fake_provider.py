@@ -0,0 +1,401 @@
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from typing import Iterator
+
+from llm.conversation_history import ConversationHistory
+from llm.large_language_model import LargeLanguageModel
+
+LATENCY_CONSTANT = "constant"
+LATENCY_UNIFORM = "uniform"
+LATENCY_NORMAL = "normal"
+LATENCY_LOGNORMAL = "lognormal"
+LATENCY_EXPONENTIAL = "exponential"
+LATENCY_DISTRIBUTIONS = [LATENCY_CONSTANT, LATENCY_UNIFORM, LATENCY_NORMAL,
+                         LATENCY_LOGNORMAL, LATENCY_EXPONENTIAL]
+
+# Markers of the prompts, to know which response is expected
+CHOOSER_MARKER = '"chosen_response"'
+REFLECTION_MARKER = "generate feedback"
+CORRECTION_MARKER = "The reflection response was:"
+# Response reflected on or corrected
+PRELIMINARY_RESPONSE_PATTERN = re.compile(r"The prelim\w* response was:\s*(.*?)\s*</PRELIMINARY_RESPONSE>", re.DOTALL)
+
+QUERY_PATTERNS = [re.compile(r"<USER_QUERY>\s*(.*?)\s*</USER_QUERY>", re.DOTALL),
+                  re.compile(r"<QUERY>\s*(?:The query was:)?\s*(.*?)\s*</QUERY>", re.DOTALL)]
+# Queries of a batch, as a JSON dictionary by query id
+BATCH_QUERIES_PATTERN = re.compile(r"<USER_QUERIES>\s*(.*?)\s*</USER_QUERIES>", re.DOTALL)
+RESPONSE_PATTERN = re.compile(r"RESPONSE (\d+):")
+OBJECT_ID_PATTERN = re.compile(r"\bobj\d+\b")
+# Row of a semantic map in the table encoding: id, 7 numbers and the most certain category
+TABLE_ROW_PATTERN = re.compile(r"^(obj\d+),(?:[^,\n]*,){7}([^:|\n]+):", re.MULTILINE)
+WORD_PATTERN = re.compile(r"[a-z]+")
+
+# Maximum number of relevant objects of a fake plan
+MAX_RELEVANT_OBJECTS = 5
+
+# Minimum score of every section of a reflection that passes a corrected plan
+PASS_SCORE = 9
+
+# Average characters per token, to estimate tokens without downloading a tokenizer
+CHARACTERS_PER_TOKEN = 4
+
+
+class FakeProviderError(ConnectionError):
+    """
+    Transient failure injected by the fake provider.
+    """
+    pass
+
+
+class FakeLlmProvider(LargeLanguageModel):
+    """
+    In-process stand-in of an LLM service provider, to run and benchmark the workflows
+    without network nor credentials.
+
+    Responses are deterministic (they only depend on the conversation and the sample
+    index, so the samples of a conversation differ reproducibly) and follow the
+    output format of every prompt: plans reference real object ids of the semantic map
+    in the conversation (objects whose category matches words of the query first),
+    reflections are feedback in four sections, and the chooser picks one of the
+    responses.
+
+    How often the workflows converge is configurable: the samples of a plan repeat the
+    first one at `plan_agreement_rate` (the planners of an ensemble agree), corrections
+    keep the relevant objects of the plan they correct at `correction_fixpoint_rate`,
+    and reflections on a corrected plan score every section PASS_SCORE or more at
+    `corrected_pass_rate` (the scores of a reflection only depend on the plan it
+    reflects on). The latency of every call is sampled from a configurable distribution,
+    and failures and malformed JSON responses can be injected at configurable rates.
+    Context caching only accounts the cached tokens of the prefixes. Several samples of
+    a conversation are generated by a single call (with the latency of one call), as the
+    candidates of the real providers.
+    """
+
+    # Maximum number of samples of a call, as Gemini candidates
+    MAX_SAMPLES_PER_CALL = 8
+
+    def __init__(self, model_name: str = "fake", latency_distribution: str = LATENCY_CONSTANT, latency_mean: float = 0.0, latency_stddev: float = 0.0, failure_rate: float = 0.0, malformed_json_rate: float = 0.0, seed: int = 0, max_samples_per_call: int = MAX_SAMPLES_PER_CALL, plan_agreement_rate: float = 0.5, correction_fixpoint_rate: float = 0.5, corrected_pass_rate: float = 0.5):
+        """
+        Initializes the FakeLlmProvider.
+
+        Args:
+            model_name (str, optional): Name of the fake model. Defaults to "fake".
+            latency_distribution (str, optional): Distribution of the latency of the calls
+                (one of LATENCY_DISTRIBUTIONS). Defaults to LATENCY_CONSTANT.
+            latency_mean (float, optional): Mean latency of the calls in seconds. Defaults to 0.0.
+            latency_stddev (float, optional): Standard deviation of the latency in seconds
+                (half-width for the uniform distribution). Defaults to 0.0.
+            failure_rate (float, optional): Probability of a call failing with a transient
+                error. Defaults to 0.0.
+            malformed_json_rate (float, optional): Probability of a JSON response being
+                malformed. Defaults to 0.0.
+            seed (int, optional): Seed of the latencies and injected errors. Defaults to 0.
+            max_samples_per_call (int, optional): Maximum number of samples generated by a
+                single call, 1 to generate every sample with its own call. Defaults to
+                MAX_SAMPLES_PER_CALL.
+            plan_agreement_rate (float, optional): Probability of a sample of a plan (but
+                the first one) being the same plan as the first sample. Defaults to 0.5.
+            correction_fixpoint_rate (float, optional): Probability of a correction
+                keeping the relevant objects of the plan it corrects. Defaults to 0.5.
+            corrected_pass_rate (float, optional): Probability of a reflection on a
+                corrected plan scoring every section PASS_SCORE or more. Defaults to 0.5.
+        """
+        super().__init__()
+        if latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(
+                f"Latency distribution {latency_distribution} not known")
+        self.model_name = model_name
+        self.latency_distribution = latency_distribution
+        self.latency_mean = latency_mean
+        self.latency_stddev = latency_stddev
+        self.failure_rate = failure_rate
+        self.malformed_json_rate = malformed_json_rate
+        self.MAX_SAMPLES_PER_CALL = max(1, max_samples_per_call)
+        self.plan_agreement_rate = plan_agreement_rate
+        self.correction_fixpoint_rate = correction_fixpoint_rate
+        self.corrected_pass_rate = corrected_pass_rate
+
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+
+        self.statistics_lock = threading.Lock()
+        self.n_calls = 0
+        self.n_failures = 0
+        self.n_malformed = 0
+        self.latency_time = 0.0
+
+    def get_provider_name(self) -> str:
+        return f"Fake_{self.model_name}"
+
+    def get_statistics(self) -> dict:
+        statistics = super().get_statistics()
+        with self.statistics_lock:
+            return statistics | {
+                "fake_calls": self.n_calls,
+                "fake_failures": self.n_failures,
+                "fake_malformed": self.n_malformed,
+                "fake_latency_time": self.latency_time,
+            }
+
+    def count_tokens(self, text: str) -> int:
+        return (len(text) + CHARACTERS_PER_TOKEN - 1) // CHARACTERS_PER_TOKEN
+
+    def sample_latency(self) -> float:
+        """
+        Samples the latency of a call from the configured distribution.
+
+        Returns:
+            float: The latency in seconds (never negative).
+        """
+        with self.random_lock:
+            if self.latency_distribution == LATENCY_UNIFORM:
+                latency = self.random.uniform(self.latency_mean - self.latency_stddev,
+                                              self.latency_mean + self.latency_stddev)
+            elif self.latency_distribution == LATENCY_NORMAL:
+                latency = self.random.gauss(self.latency_mean,
+                                            self.latency_stddev)
+            elif self.latency_distribution == LATENCY_LOGNORMAL:
+                if self.latency_mean <= 0:
+                    return 0.0
+                # Parameters of the underlying normal distribution for the given mean and stddev
+                sigma_2 = math.log1p((self.latency_stddev / self.latency_mean) ** 2)
+                mu = math.log(self.latency_mean) - sigma_2 / 2
+                latency = self.random.lognormvariate(mu, sigma_2 ** 0.5)
+            elif self.latency_distribution == LATENCY_EXPONENTIAL:
+                latency = self.random.expovariate(
+                    1 / self.latency_mean) if self.latency_mean > 0 else 0.0
+            else:
+                latency = self.latency_mean
+        return max(0.0, latency)
+
+    def _draw(self, rate: float) -> bool:
+        with self.random_lock:
+            return self.random.random() < rate
+
+    def _simulate_call(self) -> float:
+        # Wait the latency of the call and maybe fail
+        latency = self.sample_latency()
+        time.sleep(latency)
+        failed = self._draw(self.failure_rate)
+        with self.statistics_lock:
+            self.n_calls += 1
+            self.latency_time += latency
+            if failed:
+                self.n_failures += 1
+        if failed:
+            raise FakeProviderError("Injected failure of the fake LLM provider")
+        return latency
+
+    def _create_context_cache(self, prefix: ConversationHistory) -> dict:
+        # Nothing to send, the handle only keeps the tokens of the prefix
+        return {"tokens": self.count_conversation_tokens(prefix)}
+
+    def _generate_text(self, conversation_history: ConversationHistory) -> str:
+        context_cache, _ = self._get_context_cache(conversation_history)
+        self._simulate_call()
+        response_text = self._get_response(conversation_history, self.get_call_sample_indices()[0])
+        if context_cache is not None:
+            self._report_usage(self.count_conversation_tokens(conversation_history),
+                               self.count_tokens(response_text),
+                               context_cache["tokens"])
+        return response_text
+
+    def _generate_text_samples(self, conversation_history: ConversationHistory, n_samples: int) -> list:
+        context_cache, _ = self._get_context_cache(conversation_history)
+        self._simulate_call()
+        response_texts = [self._get_response(conversation_history, sample_index)
+                          for sample_index in self.get_call_sample_indices()[:n_samples]]
+        if context_cache is not None:
+            self._report_usage(self.count_conversation_tokens(conversation_history),
+                               sum(self.count_tokens(response_text) for response_text in response_texts),
+                               context_cache["tokens"])
+        return response_texts
+
+    def _generate_text_stream(self, conversation_history: ConversationHistory) -> Iterator[str]:
+        self._simulate_call()
+        response_text = self._get_response(conversation_history, self.get_call_sample_indices()[0])
+        for index in range(0, len(response_text), 16):
+            yield response_text[index:index + 16]
+
+    def _get_response(self, conversation_history: ConversationHistory, sample_index: int = 0) -> str:
+        messages = conversation_history.get_chat_gpt_conversation_history()
+        conversation_text = "\n".join(message["content"] for message in messages)
+        last_message_text = messages[-1]["content"] if messages else ""
+
+        # Deterministic choices for the same conversation and sample
+        conversation_hash = _hash(conversation_text)
+        conversation_random = random.Random(f"{conversation_hash}:{sample_index}")
+
+        if REFLECTION_MARKER in last_message_text:
+            # Reflections before this one (on the previous plans of the query)
+            n_reflections = sum(1 for message in messages[:-1]
+                                if REFLECTION_MARKER in message["content"]
+                                and PRELIMINARY_RESPONSE_PATTERN.search(message["content"]))
+            return self._get_reflection_response(last_message_text, n_reflections, sample_index)
+
+        batch_queries = _find_batch_queries(conversation_text)
+        if CHOOSER_MARKER in conversation_text:
+            response = self._get_chooser_response(last_message_text,
+                                                  conversation_random)
+        elif batch_queries is not None:
+            response = {query_id: self._get_plan_response(conversation_text, conversation_random, query_text)
+                        for query_id, query_text in batch_queries.items()}
+        elif CORRECTION_MARKER in last_message_text:
+            response = self._get_correction_response(conversation_text, last_message_text,
+                                                     conversation_random)
+        else:
+            if sample_index > 0 and conversation_random.random() < self.plan_agreement_rate:
+                # The same plan as the first sample
+                conversation_random = random.Random(f"{conversation_hash}:0")
+            response = self._get_plan_response(conversation_text,
+                                               conversation_random)
+        response_text = json.dumps(response, indent=4)
+
+        if self._draw(self.malformed_json_rate):
+            with self.statistics_lock:
+                self.n_malformed += 1
+            return self._malform(response_text, conversation_random)
+        return response_text
+
+    def _get_plan_response(self, conversation_text: str, conversation_random: random.Random, query_text: str = None, relevant_objects: list = None) -> dict:
+        if query_text is None:
+            query_text = _find_query(conversation_text)
+        object_labels = _find_object_labels(conversation_text)
+
+        if relevant_objects is None:
+            # Objects whose category shares a word with the query first, then random ones
+            query_words = set(WORD_PATTERN.findall(query_text.lower()))
+            matching_object_ids = [object_id for object_id, label in object_labels.items()
+                                   if query_words & set(WORD_PATTERN.findall(label.lower()))]
+            other_object_ids = [object_id for object_id in object_labels
+                                if object_id not in matching_object_ids]
+            conversation_random.shuffle(other_object_ids)
+            n_relevant_objects = conversation_random.randint(
+                1, MAX_RELEVANT_OBJECTS)
+            relevant_objects = (matching_object_ids +
+                                other_object_ids)[:n_relevant_objects]
+
+        return {
+            "inferred_query": query_text,
+            "query_achievable": len(relevant_objects) > 0,
+            "relevant_objects": relevant_objects,
+            "explanation": "The semantic map contains " + ", ".join(
+                f"'{object_id}' ({object_labels.get(object_id, 'object')})" for object_id in relevant_objects) + ".",
+        }
+
+    def _get_correction_response(self, conversation_text: str, last_message_text: str, conversation_random: random.Random) -> dict:
+        relevant_objects = _find_preliminary_relevant_objects(last_message_text)
+        if relevant_objects is not None and conversation_random.random() < self.correction_fixpoint_rate:
+            # The correction keeps the relevant objects of the plan
+            return self._get_plan_response(conversation_text, conversation_random,
+                                           relevant_objects=relevant_objects)
+        return self._get_plan_response(conversation_text, conversation_random)
+
+    def _get_chooser_response(self, last_message_text: str, conversation_random: random.Random) -> dict:
+        response_indices = [int(index)
+                            for index in RESPONSE_PATTERN.findall(last_message_text)]
+        return {
+            "chosen_response": conversation_random.choice(response_indices) if response_indices else 0,
+            "explaination": "The chosen response identifies the most relevant objects.",
+        }
+
+    def _get_reflection_response(self, last_message_text: str, n_reflections: int, sample_index: int = 0) -> str:
+        # Deterministic scores for the same plan and sample
+        match = PRELIMINARY_RESPONSE_PATTERN.search(last_message_text)
+        plan_random = random.Random(
+            f"{_hash(match.group(1) if match else last_message_text)}:{sample_index}")
+        # Plans reflected on before were corrected
+        if n_reflections > 0 and plan_random.random() < self.corrected_pass_rate:
+            scores = [plan_random.randint(PASS_SCORE, 10) for _ in range(3)]
+        else:
+            scores = [plan_random.randint(0, 10) for _ in range(3)]
+        return (f"1. Comments on Correctness:\n{scores[0]}/10. The relevant objects exist in the semantic map.\n"
+                f"2. Comments on Relevance:\n{scores[1]}/10. The objects are related to the query.\n"
+                f"3. Comments on Clarity:\nThe explanation is clear.\n"
+                f"4. Actions to Improve Response:\n{scores[2]}/10. Sort the objects by relevance.")
+
+    def _malform(self, response_text: str, conversation_random: random.Random) -> str:
+        # Typical failures of LLM responses, from locally repairable to hopeless
+        malformations = [
+            lambda text: text[:conversation_random.randint(1, len(text) - 1)],
+            lambda text: text.replace("\n}", ",\n}"),
+            lambda text: "```json\n" + text + "\n```",
+            lambda text: text.replace('"', "'"),
+            lambda text: "I am sorry, I cannot answer this query.",
+        ]
+        return conversation_random.choice(malformations)(response_text)
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _find_preliminary_relevant_objects(message_text: str) -> list:
+    """
+    Returns the relevant objects of the plan reflected on or corrected in a message, or
+    None if it has none.
+    """
+    match = PRELIMINARY_RESPONSE_PATTERN.search(message_text)
+    if match is None:
+        return None
+    try:
+        plan = json.loads(match.group(1))
+    except json.decoder.JSONDecodeError:
+        return None
+    relevant_objects = plan.get("relevant_objects") if isinstance(plan, dict) else None
+    return relevant_objects if isinstance(relevant_objects, list) else None
+
+
+def _find_query(conversation_text: str) -> str:
+    for query_pattern in QUERY_PATTERNS:
+        matches = query_pattern.findall(conversation_text)
+        if matches:
+            return matches[-1]
+    return ""
+
+
+def _find_batch_queries(conversation_text: str) -> dict:
+    """
+    Returns the queries of a batch prompt by query id, or None if it is not one.
+    """
+    match = BATCH_QUERIES_PATTERN.search(conversation_text)
+    if match is None:
+        return None
+    try:
+        batch_queries = json.loads(match.group(1))
+    except json.decoder.JSONDecodeError:
+        return None
+    return batch_queries if isinstance(batch_queries, dict) else None
+
+
+def _find_object_labels(conversation_text: str) -> dict:
+    """
+    Finds the objects of the semantic map in the conversation (the last JSON map, the
+    previous ones are the examples of the prompts, or the rows of a map in the table
+    encoding), with their most likely category.
+
+    Returns:
+        dict: The category of every object, by object id.
+    """
+    decoder = json.JSONDecoder()
+    semantic_map = None
+    for match in re.finditer(r'\{\s*"instances"', conversation_text):
+        try:
+            semantic_map, _ = decoder.raw_decode(conversation_text, match.start())
+        except json.decoder.JSONDecodeError:
+            continue
+    if semantic_map is not None and isinstance(semantic_map.get("instances"), dict):
+        # Results under "results", or "r" in the compact encoding
+        return {object_id: max(results, key=results.get) if (results := object_value.get("results", object_value.get("r"))) else "object"
+                for object_id, object_value in semantic_map["instances"].items()}
+    # Table encoding
+    table_rows = TABLE_ROW_PATTERN.findall(conversation_text)
+    if len(table_rows) > 0:
+        return dict(table_rows)
+    # Unknown map format: any object id in the conversation
+    return {object_id: "object" for object_id in dict.fromkeys(OBJECT_ID_PATTERN.findall(conversation_text))}
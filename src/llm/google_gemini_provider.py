@@ -1,20 +1,58 @@
 
 
+import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator
+
+import google.auth.credentials
 import google.cloud.aiplatform as aiplatform
 import google.oauth2.service_account
-from vertexai.preview.generative_models import GenerativeModel
+from vertexai.preview.generative_models import GenerationConfig, GenerativeModel
 
-from llm.conversation_history import ConversationHistory
+from llm.conversation_history import KEY_ROLE, ROLE_SYSTEM, ConversationHistory
 from llm.large_language_model import LargeLanguageModel
 
 
+def _import_cached_content() -> type:
+    # Context caching is public (vertexai.preview.caching) from google-cloud-aiplatform
+    # 1.56 on, and only a private module before. It is imported on first use, so an SDK
+    # without it only disables context caching
+    try:
+        from vertexai.preview.caching import CachedContent
+    except ImportError:
+        from vertexai._caching._caching import CachedContent
+    return CachedContent
+
+
 class GoogleGeminiProvider(LargeLanguageModel):
 
     GEMINI_1_0_PRO = "gemini-1.0-pro"
     GEMINI_1_0_PRO_VISION = "gemini-1.0-pro-vision"
     GEMINI_1_5_PRO = "gemini-1.5-pro"
 
-    def __init__(self, credentials_file: str, project_id: str, project_location: str, model_name: str):
+    # Number of model handles (one per system instruction) kept for reuse
+    MODEL_CACHE_SIZE = 16
+
+    # Minimum number of tokens of a cached content (Vertex AI context caching). The
+    # semantic map prompts are far shorter (about 2k tokens), so context caching is a
+    # no-op for them
+    MIN_CONTEXT_CACHE_TOKENS = 32768
+
+    # Time to live of the cached contents, in case they are not deleted
+    CONTEXT_CACHE_TTL = datetime.timedelta(hours=1)
+
+    # Maximum number of candidates of a response (generation config "candidate_count"), by
+    # model; other models are sent one candidate per request
+    MAX_SAMPLES_PER_CALL_BY_MODEL = {
+        GEMINI_1_0_PRO: 1,
+        GEMINI_1_0_PRO_VISION: 1,
+        GEMINI_1_5_PRO: 8,
+    }
+
+    def __init__(self, credentials_file: str, project_id: str, project_location: str, model_name: str, model_cache_size: int = MODEL_CACHE_SIZE, base_url: str = None):
         """
         Initialize the GoogleGeminiProvider with the specified credentials, project ID, project location, and model name.
 
@@ -23,41 +61,188 @@ class GoogleGeminiProvider(LargeLanguageModel):
             project_id (str): Google Cloud project ID.
             project_location (str): Google Cloud project location.
             model_name (str): Name of the model to be used.
+            model_cache_size (int, optional): Number of model handles kept for reuse, least
+                recently used ones are discarded first. Defaults to MODEL_CACHE_SIZE.
+            base_url (str, optional): Base URL of a Gemini-compatible REST API (e.g. the local
+                stand-in server, "http://127.0.0.1:8080"), reached without credentials.
+                Defaults to None (Vertex AI).
         """
-        credentials = (
-            google.oauth2.service_account.Credentials.from_service_account_file(
-                filename=credentials_file
+        super().__init__()
+        if base_url is not None:
+            aiplatform.init(project=project_id,
+                            location=project_location,
+                            credentials=google.auth.credentials.AnonymousCredentials(),
+                            api_endpoint=base_url,
+                            api_transport="rest")
+        else:
+            credentials = (
+                google.oauth2.service_account.Credentials.from_service_account_file(
+                    filename=credentials_file
+                )
             )
-        )
-        aiplatform.init(project=project_id,
-                        location=project_location,
-                        credentials=credentials)
+            aiplatform.init(project=project_id,
+                            location=project_location,
+                            credentials=credentials)
 
         self.model_name = model_name
+        self.MAX_SAMPLES_PER_CALL = self.MAX_SAMPLES_PER_CALL_BY_MODEL.get(model_name, 1)
+
+        # Model handles, by (model name, system instruction hash)
+        self.model_cache_size = model_cache_size
+        self.models = OrderedDict()
+        self.models_lock = threading.Lock()
+
+        # Per-call overhead instrumentation
+        self.statistics_lock = threading.Lock()
+        self.n_calls = 0
+        self.model_cache_hits = 0
+        self.conversion_time = 0.0
+        self.model_time = 0.0
+        self.request_time = 0.0
 
     def get_provider_name(self) -> str:
         return f"Google_{self.model_name}"
 
-    def generate_text(self, conversation_history: ConversationHistory) -> str:
-        # Get conversation history
+    def _get_model(self, system_instruction: str, cached_content: object = None) -> GenerativeModel:
+        """
+        Returns a model handle for the system instruction (or the cached content),
+        reusing a previous one (and its client and channel) if possible.
+
+        Args:
+            system_instruction (str): The system instruction, or None.
+            cached_content (CachedContent, optional): Cached content with the prefix of
+                the conversation (system instruction included). Defaults to None.
+
+        Returns:
+            GenerativeModel: The model handle.
+        """
+        if cached_content is not None:
+            model_key = (self.model_name, "cached_content",
+                         cached_content.resource_name)
+        else:
+            system_instruction_hash = hashlib.sha256(
+                (system_instruction or "").encode("utf-8")).hexdigest()
+            model_key = (self.model_name, system_instruction is None,
+                         system_instruction_hash)
+
+        with self.models_lock:
+            model = self.models.get(model_key)
+            if model is not None:
+                self.models.move_to_end(model_key)
+                with self.statistics_lock:
+                    self.model_cache_hits += 1
+                return model
+
+        if cached_content is not None:
+            # Public from google-cloud-aiplatform 1.56 on
+            from_cached_content = getattr(GenerativeModel, "from_cached_content", None) \
+                or GenerativeModel._from_cached_content
+            model = from_cached_content(cached_content)
+        else:
+            model = GenerativeModel(model_name=self.model_name,
+                                    system_instruction=system_instruction)
+
+        with self.models_lock:
+            self.models[model_key] = model
+            self.models.move_to_end(model_key)
+            while len(self.models) > self.model_cache_size:
+                self.models.popitem(last=False)
+        return model
+
+    def get_statistics(self) -> dict:
+        statistics = super().get_statistics()
+        with self.statistics_lock:
+            n_calls = max(1, self.n_calls)
+            return statistics | {
+                "calls": self.n_calls,
+                "model_cache_hits": self.model_cache_hits,
+                "avg_conversion_time": self.conversion_time / n_calls,
+                "avg_model_time": self.model_time / n_calls,
+                "avg_request_time": self.request_time / n_calls,
+            }
+
+    def _create_context_cache(self, prefix: ConversationHistory) -> dict:
+        # This SDK version cannot cache a system instruction without contents, so prefixes
+        # with only the system message are sent whole
+        if all(message[KEY_ROLE] == ROLE_SYSTEM for message in prefix.get_chat_gpt_conversation_history()):
+            return None
+        system_instruction, contents = prefix.get_gemini_conversation_history()
+        # An SDK without context caching raises ImportError, and the conversations are
+        # sent whole
+        cached_content = _import_cached_content().create(model_name=self.model_name,
+                                                         system_instruction=system_instruction,
+                                                         contents=contents,
+                                                         ttl=self.CONTEXT_CACHE_TTL)
+        # The usage metadata does not give the cached tokens, so they are estimated once
+        return {"cached_content": cached_content,
+                "tokens": self.count_conversation_tokens(prefix)}
+
+    def _delete_context_cache(self, context_cache: dict):
+        context_cache["cached_content"].delete()
+
+    def _generate_text(self, conversation_history: ConversationHistory) -> str:
+        return self._generate_text_samples(conversation_history, 1)[0]
+
+    def _generate_text_samples(self, conversation_history: ConversationHistory, n_samples: int) -> list:
+        start_time = time.perf_counter()
+        # Get conversation history (without the prefix, if it is cached)
+        context_cache, conversation_history = self._get_context_cache(conversation_history)
         system_instruction, contents = conversation_history.get_gemini_conversation_history()
+        conversion_end_time = time.perf_counter()
 
-        # Instantiate model
-        model = GenerativeModel(model_name=self.model_name,
-                                system_instruction=system_instruction)
+        # Get model (reused for the same system instruction or cached content)
+        model = self._get_model(system_instruction,
+                                context_cache["cached_content"] if context_cache is not None else None)
+        model_end_time = time.perf_counter()
 
         # print("#"*100)
         # print(f"system_instruction = {system_instruction}")
         # print(f"contents = {contents}")
 
-        # Get response
-        response = model.generate_content(contents)
-
-        response_text = response.candidates[0].content.parts[0].text
+        # Get response (one candidate per sample, the prompt is only sent once)
+        generation_config = GenerationConfig(candidate_count=n_samples) if n_samples > 1 else None
+        response = model.generate_content(contents, generation_config=generation_config)
+        request_end_time = time.perf_counter()
+
+        with self.statistics_lock:
+            self.n_calls += 1
+            self.conversion_time += conversion_end_time - start_time
+            self.model_time += model_end_time - conversion_end_time
+            self.request_time += request_end_time - model_end_time
+
+        if n_samples > 1:
+            # Candidates without text (e.g. blocked) are dropped
+            response_texts = [candidate.content.parts[0].text for candidate in response.candidates
+                              if len(candidate.content.parts) > 0]
+        else:
+            response_texts = [response.candidates[0].content.parts[0].text]
+        # Empty usage metadata (all counts 0) if the API did not send it
+        if response.usage_metadata.prompt_token_count > 0:
+            self._report_usage(response.usage_metadata.prompt_token_count,
+                               response.usage_metadata.candidates_token_count,
+                               context_cache["tokens"] if context_cache is not None else 0)
         # print("RESPONSE")
-        # print(response_text)
+        # print(response_texts)
         # print("#"*100)
 
         # time.sleep(7)
 
-        return response_text
+        return response_texts
+
+    def _generate_text_stream(self, conversation_history: ConversationHistory) -> Iterator[str]:
+        # Get conversation history (without the prefix, if it is cached)
+        context_cache, conversation_history = self._get_context_cache(conversation_history)
+        system_instruction, contents = conversation_history.get_gemini_conversation_history()
+
+        # Get model (reused for the same system instruction or cached content)
+        model = self._get_model(system_instruction,
+                                context_cache["cached_content"] if context_cache is not None else None)
+
+        # Get response stream
+        responses = model.generate_content(contents, stream=True)
+        try:
+            for response in responses:
+                yield response.candidates[0].content.parts[0].text
+        finally:
+            # Cancels the request if the stream was not consumed
+            responses.close()
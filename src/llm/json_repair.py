@@ -0,0 +1,179 @@
+import json
+import re
+
+# Characters that may follow the end of a string in valid JSON ("" is the end of the text)
+STRING_END_FOLLOWERS = ",:}]"
+
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+CODE_FENCE_PATTERN = re.compile(r"```[a-zA-Z]*")
+
+# Endings of a complete value (numbers may have been cut), after which a truncated
+# response can be closed
+COMPLETE_VALUE_ENDINGS = ('"', "]", "}", "true", "false", "null")
+
+
+def _next_non_space(text: str, index: int) -> str:
+    while index < len(text) and text[index].isspace():
+        index += 1
+    return text[index] if index < len(text) else ""
+
+
+def _remove_trailing_commas(text: str) -> str:
+    # Commas followed by a closer, outside strings
+    output = []
+    in_string = False
+    escape = False
+    for index, char in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "," and _next_non_space(text, index + 1) in ("}", "]"):
+            continue
+        output.append(char)
+    return "".join(output)
+
+
+def _scan(text: str) -> tuple:
+    """
+    Rewrites the text as JSON, character by character: converts single-quoted strings,
+    escapes raw control characters and unescaped quotes inside strings, and converts
+    Python literals. Stops when the outermost object (or array) is closed.
+
+    Returns:
+        tuple: The rewritten text, the closers of the brackets left open (innermost
+            last), and whether the text ended inside a string.
+    """
+    output = []
+    stack = []
+    quote = None
+    escape = False
+    index = 0
+
+    while index < len(text):
+        char = text[index]
+
+        if quote is not None:
+            if escape:
+                escape = False
+                output.append(char)
+            elif char == "\\":
+                escape = True
+                output.append(char)
+            elif char == quote and _next_non_space(text, index + 1) in STRING_END_FOLLOWERS:
+                quote = None
+                output.append('"')
+            elif char == '"':
+                # Unescaped double quote inside a string
+                output.append('\\"')
+            elif char == "\n":
+                output.append("\\n")
+            elif char == "\r":
+                output.append("\\r")
+            elif char == "\t":
+                output.append("\\t")
+            else:
+                output.append(char)
+
+        elif char in "\"'":
+            quote = char
+            output.append('"')
+
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+            output.append(char)
+
+        elif char in "}]":
+            if not stack:
+                break
+            # Close any bracket left open before this one
+            while stack and stack[-1] != char:
+                output.append(stack.pop())
+            if stack:
+                stack.pop()
+            output.append(char)
+            if not stack:
+                break
+
+        elif char.isalpha():
+            # Bare words: Python literals
+            word_end = index
+            while word_end < len(text) and (text[word_end].isalnum() or text[word_end] == "_"):
+                word_end += 1
+            word = text[index:word_end]
+            output.append(PYTHON_LITERALS.get(word, word))
+            index = word_end
+            continue
+
+        else:
+            output.append(char)
+
+        index += 1
+
+    return "".join(output), stack, quote is not None
+
+
+def repair_json(text: str, close_truncated: bool = False) -> str:
+    """
+    Tries to repair a malformed JSON response locally, without asking the LLM again.
+
+    Handles the most common failures of LLM responses: code fences, trailing commas,
+    single-quoted strings, raw newlines and unescaped quotes inside strings, Python
+    literals (True, False, None) and brackets left open inside the response.
+
+    Truncated responses are not repaired by default, since the rest of their elements
+    (e.g. the last relevant objects of a plan) may be lost. With `close_truncated`, the
+    brackets left open are closed if the response was truncated after a complete value
+    (not inside a string, nor after a comma, colon or number), so the caller must check
+    that the result has every field it needs. Repairs to an empty object or array (e.g.
+    "Sure! {") are never returned, so the response is generated again.
+
+    Args:
+        text (str): The raw response of the LLM.
+        close_truncated (bool, optional): Whether to close the brackets left open by a
+            truncated response. Defaults to False.
+
+    Returns:
+        str: The repaired JSON text, or None if it could not be repaired without losses.
+    """
+    text = CODE_FENCE_PATTERN.sub("", text)
+
+    # Start of the outermost object (or array)
+    start_indices = [index for index in (text.find("{"), text.find("["))
+                     if index != -1]
+    if not start_indices:
+        return None
+    text = text[min(start_indices):]
+
+    output, open_closers, in_string = _scan(text)
+    if in_string or (open_closers and not close_truncated):
+        return None
+    if open_closers:
+        output = output.rstrip()
+        if not output.endswith(COMPLETE_VALUE_ENDINGS):
+            return None
+        output += "".join(reversed(open_closers))
+
+    repaired_text = _remove_trailing_commas(output)
+    try:
+        repaired_value = json.loads(repaired_text)
+    except json.decoder.JSONDecodeError:
+        return None
+    if len(repaired_value) == 0:
+        return None
+    return repaired_text
+
+
+def has_keys(json_text: str, keys: list) -> bool:
+    """
+    Returns whether a JSON text is an object with all the given keys (e.g. the fields
+    of a plan).
+    """
+    value = json.loads(json_text)
+    return isinstance(value, dict) and all(key in value for key in keys)
@@ -0,0 +1,131 @@
+import json
+
+
+class JsonCompletionDetector:
+    """
+    Incrementally scans a streamed response to detect when its outermost JSON object
+    (or array) has been closed, so the rest of the stream (usually trailing prose) does
+    not have to be waited for.
+
+    It keeps track of the brace/bracket depth, skipping strings and escaped characters,
+    and also detects every top-level field of an object as soon as its value is closed,
+    so callers can act on e.g. "relevant_objects" before the "explanation" is finished.
+    """
+
+    def __init__(self):
+        self.buffer = []
+        self.position = 0
+
+        self.start_index = None
+        self.end_index = None
+        self.depth = 0
+        self.is_object = False
+        self.in_string = False
+        self.escape = False
+
+        # Top-level field being read (objects only)
+        self.key_start_index = None
+        self.reading_key = False
+        self.key = None
+        self.value_start_index = None
+
+        self.completed_fields = []
+
+    def is_complete(self) -> bool:
+        """
+        Returns whether the outermost JSON object (or array) has been closed.
+        """
+        return self.end_index is not None
+
+    def get_text(self) -> str:
+        """
+        Returns all the text received so far.
+        """
+        return "".join(self.buffer)
+
+    def get_json_text(self) -> str:
+        """
+        Returns the text of the outermost JSON object (or array), or None if it has not
+        been closed yet.
+        """
+        if not self.is_complete():
+            return None
+        return self.get_text()[self.start_index:self.end_index]
+
+    def _complete_field(self, text: str):
+        if self.key is None or self.value_start_index is None:
+            return
+        value_text = text[self.value_start_index:self.position].strip()
+        try:
+            self.completed_fields.append((self.key, json.loads(value_text)))
+        except json.decoder.JSONDecodeError:
+            pass
+
+    def feed(self, chunk: str) -> list:
+        """
+        Scans a new chunk of the stream.
+
+        Args:
+            chunk (str): The chunk of text.
+
+        Returns:
+            list: (key, value) tuples of the top-level fields completed in this chunk.
+        """
+        if self.is_complete():
+            return []
+
+        self.buffer.append(chunk)
+        text = None
+        n_completed_fields = len(self.completed_fields)
+
+        for char in chunk:
+            if self.start_index is None:
+                if char in "{[":
+                    self.start_index = self.position
+                    self.depth = 1
+                    self.is_object = char == "{"
+
+            elif self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.reading_key:
+                        text = text or self.get_text()
+                        self.key = json.loads(
+                            text[self.key_start_index:self.position + 1])
+                        self.reading_key = False
+
+            elif char == '"':
+                self.in_string = True
+                if self.depth == 1 and self.is_object and self.key is None:
+                    self.reading_key = True
+                    self.key_start_index = self.position
+
+            elif char == ":":
+                if self.depth == 1 and self.key is not None and self.value_start_index is None:
+                    self.value_start_index = self.position + 1
+
+            elif char in "{[":
+                self.depth += 1
+
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    text = text or self.get_text()
+                    self._complete_field(text)
+                    self.end_index = self.position + 1
+                    self.position += 1
+                    break
+
+            elif char == "," and self.depth == 1:
+                text = text or self.get_text()
+                self._complete_field(text)
+                self.key = None
+                self.value_start_index = None
+
+            self.position += 1
+
+        return self.completed_fields[n_completed_fields:]
@@ -1,14 +1,107 @@
 
+import asyncio
+import hashlib
 import json
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Tuple
+from typing import Callable, Iterator, Tuple
 
+import tiktoken
+
+from llm import call_scheduler, json_repair, tracing
 from llm.conversation_history import ConversationHistory
+from llm.json_stream import JsonCompletionDetector
+from llm.rate_limiter import RateLimiter
+from llm.response_cache import CACHE_KIND_JSON, CACHE_KIND_TEXT, ResponseCache
+from llm.retry_policy import (
+    ERROR_PARSE,
+    ERROR_PERMANENT,
+    ProviderCallError,
+    RetryPolicy,
+    SamplesRejectedError,
+    classify_error,
+)
+from llm.telemetry import Telemetry
+
+# Tokenizer used to estimate the tokens of providers without their own tokenizer
+DEFAULT_TOKENIZER_ENCODING = "cl100k_base"
 
 
 class LargeLanguageModel(ABC):
 
-    JSON_MAX_ATTEMPTS = 10
+    # Tokens added by the chat format to every message
+    TOKENS_PER_MESSAGE = 4
+
+    # Optional rate limiter shared by every call of the provider
+    rate_limiter: RateLimiter = None
+
+    # Optional cache of the responses
+    response_cache: ResponseCache = None
+
+    # Optional telemetry of every call
+    telemetry: Telemetry = None
+
+    # Whether JSON responses are streamed and cut as soon as the JSON is complete
+    streaming: bool = False
+
+    # Optional prices of the tokens, in USD per million input, cached input and output
+    # tokens (e.g. {"input": 5.0, "cached_input": 2.5, "output": 15.0})
+    token_prices: dict = None
+
+    # Whether the cacheable prefix of the conversations is cached by the provider
+    context_caching: bool = False
+
+    # Minimum number of tokens of a prefix for the provider to cache it
+    MIN_CONTEXT_CACHE_TOKENS = 0
+
+    # Maximum number of samples (candidates) of a conversation generated by a single call,
+    # 1 if the provider cannot generate several (lowered to 1 for the rest of the run if
+    # the provider rejects a call with several samples)
+    MAX_SAMPLES_PER_CALL = 1
+
+    # Lazily loaded default tokenizer, shared by every provider
+    _default_tokenizer = None
+
+    def __init__(self):
+        # Retries of the failed calls
+        self.retry_policy = RetryPolicy()
+
+        # Outcome counters of the JSON responses
+        self.counters_lock = threading.Lock()
+        self.counters = {
+            "json_valid": 0,
+            "json_repaired": 0,
+            "json_regenerated": 0,
+            "json_failed": 0,
+        }
+
+        # Tokens and estimated cost of the calls sent to the provider
+        self.token_usage = {
+            "input_tokens": 0,
+            "cached_input_tokens": 0,
+            "output_tokens": 0,
+            "cost": 0.0,
+        }
+        # Token usage reported by the provider for the call in progress, by thread
+        self.call_usage = threading.local()
+        # Sample indices of the call in progress, by thread
+        self.call_samples = threading.local()
+
+        # Context caches of the prefixes, by hash of the prefix
+        self.context_caches_lock = threading.Lock()
+        self.context_caches = dict()
+        self.context_cache_counters = {
+            "context_caches_created": 0,
+            "context_cache_hits": 0,
+            "context_caches_skipped": 0,
+        }
+        # Whether the prefixes that cannot be cached were already warned about
+        self.context_cache_skip_warned = False
+
+    def _count(self, counter: str):
+        with self.counters_lock:
+            self.counters[counter] += 1
 
     @abstractmethod
     def get_provider_name(self) -> str:
@@ -21,21 +114,630 @@ class LargeLanguageModel(ABC):
         pass
 
     @abstractmethod
-    def generate_text(self, conversation_history: ConversationHistory) -> Tuple[str, float]:
+    def _generate_text(self, conversation_history: ConversationHistory) -> str:
         """
-        Generates text based on the provided conversation history.
+        Abstract method to generate text with the LLM service provider, based on the
+        provided conversation history. Called by `generate_text`.
 
         Args:
             conversation_history (ConversationHistory): The conversation history
                 that the LLM will use as context to generate the text.
 
         Returns:
-            Tuple[str, float]: A tuple containing the generated text and the
-                cost associated with the request.
-            TODO: update
+            str: The generated text.
         """
         pass
 
+    def _generate_text_stream(self, conversation_history: ConversationHistory) -> Iterator[str]:
+        """
+        Generates text with the LLM service provider, yielding it in chunks as they arrive.
+        Closing the iterator must cancel the rest of the generation.
+
+        By default, the whole text is generated with `_generate_text` and yielded at once.
+        Providers supporting streaming should override it.
+
+        Args:
+            conversation_history (ConversationHistory): The conversation history
+                that the LLM will use as context to generate the text.
+
+        Yields:
+            str: The chunks of the generated text.
+        """
+        yield self._generate_text(conversation_history)
+
+    def _generate_text_samples(self, conversation_history: ConversationHistory, n_samples: int) -> list:
+        """
+        Generates several samples (candidates) of text for the same conversation history
+        in a single call to the LLM service provider. Called by `generate_text_samples` and
+        `generate_json_samples` with at most MAX_SAMPLES_PER_CALL samples.
+
+        By default, every sample is generated with `_generate_text`. Providers able to
+        return several candidates per request should override it (and MAX_SAMPLES_PER_CALL).
+
+        Args:
+            conversation_history (ConversationHistory): The conversation history
+                that the LLM will use as context to generate the text.
+            n_samples (int): Number of samples.
+
+        Returns:
+            list: The generated texts (fewer than `n_samples` if the provider dropped some).
+        """
+        return [self._generate_text(conversation_history) for _ in range(n_samples)]
+
+    def get_statistics(self) -> dict:
+        """
+        Returns statistics of the calls made so far: the outcome counters of the JSON
+        responses (valid at once, repaired locally, regenerated, failed), the tokens and
+        estimated cost of the calls, the context cache counters and the retry counters. Providers with their own statistics (e.g. overhead timings) should
+        extend it.
+
+        Returns:
+            dict: The statistics, by name.
+        """
+        with self.counters_lock:
+            statistics = dict(self.counters) | dict(self.token_usage) | dict(self.context_cache_counters)
+        return statistics | self.retry_policy.get_statistics()
+
+    def set_rate_limiter(self, rate_limiter: RateLimiter):
+        """
+        Sets the rate limiter that admits the calls to the LLM service provider.
+
+        Args:
+            rate_limiter (RateLimiter): The rate limiter, or None to disable rate limiting.
+        """
+        self.rate_limiter = rate_limiter
+
+    def set_token_prices(self, token_prices: dict):
+        """
+        Sets the prices of the tokens, used to estimate the cost of every call.
+
+        Args:
+            token_prices (dict): Prices in USD per million tokens, with keys "input" and
+                "output", or None if unknown (no cost is estimated).
+        """
+        self.token_prices = token_prices
+
+    def set_context_caching(self, context_caching: bool):
+        """
+        Sets whether the cacheable prefix of the conversations (see
+        `ConversationHistory.mark_cacheable_prefix`) is cached by the provider, so it is
+        only sent once. Only providers supporting context caching are affected, and only
+        prefixes of at least MIN_CONTEXT_CACHE_TOKENS tokens are cached (the others are
+        counted as skipped, with a warning).
+
+        Args:
+            context_caching (bool): Whether context caching is enabled.
+        """
+        self.context_caching = context_caching
+
+    def set_retry_policy(self, retry_policy: RetryPolicy):
+        """
+        Sets the policy that retries the failed calls to the LLM service provider.
+
+        Args:
+            retry_policy (RetryPolicy): The retry policy.
+        """
+        self.retry_policy = retry_policy
+
+    def set_telemetry(self, telemetry: Telemetry):
+        """
+        Sets the telemetry in which every call (attempt or cache hit) is recorded.
+
+        Args:
+            telemetry (Telemetry): The telemetry, or None to disable it.
+        """
+        self.telemetry = telemetry
+
+    def set_streaming(self, streaming: bool):
+        """
+        Sets whether `generate_json` streams the responses, resolving as soon as the
+        outermost JSON object is closed and cancelling the rest of the generation.
+
+        Args:
+            streaming (bool): True to enable streaming.
+        """
+        self.streaming = streaming
+
+    def set_response_cache(self, response_cache: ResponseCache):
+        """
+        Sets the cache in which the responses of `generate_text` and `generate_json` are
+        looked up before calling the LLM service provider.
+
+        Args:
+            response_cache (ResponseCache): The response cache, or None to disable caching.
+        """
+        self.response_cache = response_cache
+
+    def get_generation_parameters(self) -> dict:
+        """
+        Returns the parameters that affect the generation of the responses (e.g. temperature),
+        used to address cached responses. Providers with such parameters should override it.
+
+        Returns:
+            dict: The generation parameters.
+        """
+        return dict()
+
+    def _get_cached_response(self, conversation_history: ConversationHistory, sample_index: int, kind: str) -> Tuple[str, str]:
+        if self.response_cache is None:
+            return None, None
+        cache_key = ResponseCache.get_key(provider_name=self.get_provider_name(),
+                                          generation_parameters=self.get_generation_parameters(),
+                                          sample_index=sample_index,
+                                          conversation_history=conversation_history,
+                                          kind=kind)
+        return cache_key, self.response_cache.get(cache_key)
+
+    def _set_cached_response(self, cache_key: str, response: str):
+        if self.response_cache is not None:
+            self.response_cache.set(cache_key, response)
+
+    def _record_call(self, **fields):
+        if self.telemetry is not None:
+            self.telemetry.record(provider=self.get_provider_name(), **fields)
+
+    def _report_usage(self, input_tokens: int, output_tokens: int, cached_input_tokens: int = 0):
+        """
+        Reports the token usage of the call in progress, as given by the provider in the
+        metadata of the response. Providers should call it from `_generate_text`, calls
+        without reported usage are estimated with the tokenizer.
+
+        Args:
+            input_tokens (int): Tokens of the prompt (including the cached ones).
+            output_tokens (int): Tokens of the response.
+            cached_input_tokens (int, optional): Tokens of the prompt read from a context
+                cache. Defaults to 0.
+        """
+        self.call_usage.tokens = (input_tokens, output_tokens, cached_input_tokens)
+
+    def get_call_sample_indices(self) -> list:
+        """
+        Returns the sample indices of the call in progress in this thread, one per
+        generated sample (see `generate_text_samples`), so providers can tell apart the
+        samples of the same conversation (e.g. the fake provider). Providers should call
+        it from `_generate_text`, `_generate_text_stream` or `_generate_text_samples`.
+
+        Returns:
+            list: The sample indices ([0] outside a call).
+        """
+        return getattr(self.call_samples, "indices", [0])
+
+    def _measure_usage(self, conversation_history: ConversationHistory, response_text: str) -> dict:
+        # Usage reported by the provider, otherwise estimated with the tokenizer
+        reported_tokens = getattr(self.call_usage, "tokens", None)
+        if reported_tokens is not None:
+            input_tokens, output_tokens, cached_input_tokens = reported_tokens
+            token_source = "provider"
+        else:
+            input_tokens = self.count_conversation_tokens(conversation_history)
+            output_tokens = self.count_tokens(response_text)
+            cached_input_tokens = 0
+            token_source = "tokenizer"
+
+        cost = None
+        if self.token_prices is not None:
+            # Cached tokens are billed at the cached price, if the provider has one
+            cached_input_price = self.token_prices.get("cached_input", self.token_prices["input"])
+            cost = ((input_tokens - cached_input_tokens) * self.token_prices["input"] +
+                    cached_input_tokens * cached_input_price +
+                    output_tokens * self.token_prices["output"]) / 1e6
+
+        with self.counters_lock:
+            self.token_usage["input_tokens"] += input_tokens
+            self.token_usage["cached_input_tokens"] += cached_input_tokens
+            self.token_usage["output_tokens"] += output_tokens
+            self.token_usage["cost"] += cost or 0.0
+
+        return {"input_tokens": input_tokens,
+                "cached_input_tokens": cached_input_tokens,
+                "output_tokens": output_tokens,
+                "token_source": token_source,
+                "cost": cost}
+
+    def _create_context_cache(self, prefix: ConversationHistory) -> object:
+        """
+        Caches a conversation prefix in the LLM service provider. Providers supporting
+        context caching should override it (and `_delete_context_cache`).
+
+        Args:
+            prefix (ConversationHistory): The prefix of the conversations.
+
+        Returns:
+            object: Handle of the context cache, used by `_generate_text` to reference it,
+                or None if the prefix cannot be cached.
+        """
+        return None
+
+    def _delete_context_cache(self, context_cache: object):
+        """
+        Deletes a context cache created by `_create_context_cache`.
+
+        Args:
+            context_cache (object): Handle of the context cache.
+        """
+        pass
+
+    def _get_context_cache(self, conversation_history: ConversationHistory) -> Tuple[object, ConversationHistory]:
+        """
+        Returns the context cache of the cacheable prefix of a conversation, creating it
+        the first time the prefix is seen (concurrent calls with the same prefix wait for
+        it), together with the rest of the conversation. Providers supporting context
+        caching call it from `_generate_text`.
+
+        Args:
+            conversation_history (ConversationHistory): The conversation history.
+
+        Returns:
+            Tuple[object, ConversationHistory]: Handle of the context cache and the rest of
+                the conversation, or (None, the whole conversation) if context caching is
+                disabled, there is no prefix, or the prefix cannot be cached.
+        """
+        if not self.context_caching:
+            return None, conversation_history
+        prefix, rest = conversation_history.split_cacheable_prefix()
+        if prefix is None:
+            return None, conversation_history
+
+        prefix_key = hashlib.sha256(json.dumps(prefix.get_chat_gpt_conversation_history(),
+                                               ensure_ascii=False).encode("utf-8")).hexdigest()
+        with self.context_caches_lock:
+            context_cache_entry = self.context_caches.setdefault(
+                prefix_key, {"lock": threading.Lock(), "created": False, "handle": None})
+
+        with context_cache_entry["lock"]:
+            counter = "context_cache_hits"
+            if not context_cache_entry["created"]:
+                context_cache_entry["created"] = True
+                counter = "context_caches_created"
+                prefix_tokens = self.count_conversation_tokens(prefix)
+                if prefix_tokens < self.MIN_CONTEXT_CACHE_TOKENS:
+                    self._skip_context_cache(f"its prefix has {prefix_tokens} tokens, "
+                                             f"below the minimum of {self.MIN_CONTEXT_CACHE_TOKENS} tokens")
+                else:
+                    try:
+                        context_cache_entry["handle"] = self._create_context_cache(prefix)
+                        if context_cache_entry["handle"] is None:
+                            self._skip_context_cache("the provider cannot cache its prefix "
+                                                     "(e.g. a system instruction without contents)")
+                    except Exception as e:
+                        # The conversations are sent whole instead
+                        print(f"WARNING: context cache could not be created: {e}")
+
+        if context_cache_entry["handle"] is None:
+            return None, conversation_history
+        with self.counters_lock:
+            self.context_cache_counters[counter] += 1
+        return context_cache_entry["handle"], rest
+
+    def _skip_context_cache(self, reason: str):
+        # Context caching is a no-op for this prefix, the conversations are sent whole
+        with self.counters_lock:
+            self.context_cache_counters["context_caches_skipped"] += 1
+            if self.context_cache_skip_warned:
+                return
+            self.context_cache_skip_warned = True
+        print(f"WARNING: {self.get_provider_name()} context caching is a no-op for a conversation, "
+              f"since {reason}; such conversations are sent whole (warned once)")
+
+    def clear_context_caches(self):
+        """
+        Deletes every context cache created so far (e.g. once all the queries on a semantic
+        map are planned), so the provider does not keep (and bill) them until they expire.
+        """
+        with self.context_caches_lock:
+            context_cache_entries = list(self.context_caches.values())
+            self.context_caches = dict()
+        for context_cache_entry in context_cache_entries:
+            if context_cache_entry["handle"] is not None:
+                try:
+                    self._delete_context_cache(context_cache_entry["handle"])
+                except Exception as e:
+                    print(f"WARNING: context cache could not be deleted: {e}")
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Estimates the number of tokens of a text. Providers with their own tokenizer
+        should override this method.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            int: The estimated number of tokens.
+        """
+        if LargeLanguageModel._default_tokenizer is None:
+            LargeLanguageModel._default_tokenizer = tiktoken.get_encoding(
+                DEFAULT_TOKENIZER_ENCODING)
+        return len(LargeLanguageModel._default_tokenizer.encode(text))
+
+    def count_conversation_tokens(self, conversation_history: ConversationHistory) -> int:
+        """
+        Estimates the number of input tokens of a request with the conversation history.
+
+        Args:
+            conversation_history (ConversationHistory): The conversation history.
+
+        Returns:
+            int: The estimated number of tokens.
+        """
+        return sum(self.count_tokens(message["content"]) + self.TOKENS_PER_MESSAGE
+                   for message in conversation_history.get_chat_gpt_conversation_history())
+
+    def _call_provider(self, conversation_history: ConversationHistory, kind: str = CACHE_KIND_TEXT, attempt: int = 1, read_json_stream: bool = False, on_field: Callable[[str, object], None] = None, sample_index: int = 0, sample_indices: list = None) -> str:
+        """
+        Calls the LLM service provider, waiting first for the rate limiter (if any).
+
+        If a rate limiter is set, the call waits until the request (with its estimated
+        input tokens) fits in the budget of the provider, and the tokens of the response
+        are charged afterwards. Failed calls are retried according to the retry policy,
+        and every try is recorded in the telemetry (with its tokens and estimated
+        cost) and traced as a span (if enabled).
+
+        Args:
+            conversation_history (ConversationHistory): The conversation history
+                that the LLM will use as context to generate the text.
+            kind (str, optional): Kind of the response (text or JSON). Defaults to text.
+            attempt (int, optional): Number of the generation attempt (JSON responses are
+                generated again if they cannot be parsed). Defaults to 1.
+            read_json_stream (bool, optional): Whether the response is streamed and cut as
+                soon as its JSON object is closed. Defaults to False.
+            on_field (Callable[[str, object], None], optional): Called with every top-level
+                field of the streamed JSON object. Defaults to None.
+            sample_index (int, optional): Sample index of the response. Defaults to 0.
+            sample_indices (list, optional): If given, sample indices of the samples
+                generated by the call (see `_generate_text_samples`), returned as a list.
+                Defaults to None.
+
+        Raises:
+            ProviderCallError: If a retryable error persists after the allowed retries, or
+                after a permanent error of the request.
+
+        Returns:
+            str: The generated text (list of texts if `sample_indices` is given).
+        """
+        retry = 0
+        n_samples = len(sample_indices) if sample_indices is not None else None
+
+        def timed_call() -> str:
+            nonlocal retry
+            retry += 1
+            start_time = time.perf_counter()
+            error_class = None
+            usage = dict()
+            with tracing.span(f"{kind} {attempt}.{retry}", "attempt",
+                              provider=self.get_provider_name(), attempt=attempt, retry=retry) as attempt_span:
+                try:
+                    self.call_usage.tokens = None
+                    self.call_samples.indices = sample_indices if sample_indices is not None else [sample_index]
+                    if n_samples is not None:
+                        response_texts = self._call_provider_samples_once(conversation_history, n_samples)
+                        usage = self._measure_usage(conversation_history, "".join(response_texts))
+                    else:
+                        if read_json_stream:
+                            response_text = self._read_json_stream(conversation_history, on_field)
+                        else:
+                            response_text = self._call_provider_once(conversation_history)
+                        usage = self._measure_usage(conversation_history, response_text)
+                    if attempt_span is not None:
+                        attempt_span.args.update(usage)
+                    return response_texts if n_samples is not None else response_text
+                except Exception as e:
+                    error_class = classify_error(e)
+                    if attempt_span is not None:
+                        attempt_span.args["error"] = error_class
+                    raise
+                finally:
+                    self._record_call(kind=kind,
+                                      attempt=attempt,
+                                      retry=retry,
+                                      cache_hit=False,
+                                      latency=time.perf_counter() - start_time,
+                                      error=error_class,
+                                      samples=n_samples or 1,
+                                      **usage)
+
+        return self.retry_policy.call(timed_call)
+
+    def _call_provider_once(self, conversation_history: ConversationHistory) -> str:
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(
+                self.count_conversation_tokens(conversation_history))
+
+        response_text = self._generate_text(conversation_history)
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume_tokens(self.count_tokens(response_text))
+
+        return response_text
+
+    def _call_provider_samples_once(self, conversation_history: ConversationHistory, n_samples: int) -> list:
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(
+                self.count_conversation_tokens(conversation_history))
+
+        response_texts = self._generate_text_samples(conversation_history, n_samples)
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume_tokens(sum(self.count_tokens(response_text)
+                                                 for response_text in response_texts))
+
+        return response_texts
+
+    def _call_provider_samples(self, conversation_history: ConversationHistory, sample_indices: list, kind: str = CACHE_KIND_TEXT, attempt: int = 1) -> list:
+        """
+        Generates several samples of a conversation in as few calls to the LLM service
+        provider as possible (MAX_SAMPLES_PER_CALL samples per call), each call retried
+        and recorded as in `_call_provider`.
+
+        If the provider rejects a call with several samples (permanent error), it is only
+        sent one sample per call for the rest of the run (MAX_SAMPLES_PER_CALL is lowered
+        to 1) and SamplesRejectedError is raised, so the caller generates the samples
+        again one by one.
+
+        Raises:
+            ProviderCallError: If a retryable error persists after the allowed retries, or
+                after a permanent error of the request.
+            SamplesRejectedError: If the provider rejected a call with several samples.
+
+        Returns:
+            list: The generated texts, by sample index (fewer than `sample_indices` if the
+                provider dropped some).
+        """
+        response_texts = list()
+        max_samples_per_call = self.MAX_SAMPLES_PER_CALL
+        for first_sample in range(0, len(sample_indices), max_samples_per_call):
+            call_sample_indices = sample_indices[first_sample:first_sample + max_samples_per_call]
+            n_call_samples = len(call_sample_indices)
+            if n_call_samples == 1:
+                response_texts.append(self._call_provider(conversation_history, kind=kind, attempt=attempt,
+                                                          sample_index=call_sample_indices[0]))
+                continue
+            try:
+                response_texts.extend(self._call_provider(conversation_history, kind=kind, attempt=attempt,
+                                                          sample_indices=call_sample_indices))
+            except Exception as e:
+                # Retryable errors given up and errors of the run are not caused by the
+                # number of samples
+                if not isinstance(e, ProviderCallError) or e.error_class != ERROR_PERMANENT:
+                    raise
+                print(f"WARNING: {self.get_provider_name()} rejected a call with {n_call_samples} samples, "
+                      f"generating one sample per call from now on: {e.cause!r}")
+                self.MAX_SAMPLES_PER_CALL = 1
+                raise SamplesRejectedError(n_call_samples, e.cause) from e
+        return response_texts
+
+    def _get_cached_samples(self, conversation_history: ConversationHistory, n_samples: int, first_sample_index: int, kind: str) -> Tuple[dict, dict]:
+        # Cache keys of the samples and cached responses, by sample index
+        cache_keys = dict()
+        cached_responses = dict()
+        for sample_index in range(first_sample_index, first_sample_index + n_samples):
+            cache_keys[sample_index], cached_response = self._get_cached_response(conversation_history,
+                                                                                 sample_index,
+                                                                                 kind)
+            if cached_response is not None:
+                self._record_call(kind=kind, attempt=0, retry=0,
+                                  cache_hit=True, latency=0.0, error=None)
+                cached_responses[sample_index] = cached_response
+        return cache_keys, cached_responses
+
+    def generate_text_stream(self, conversation_history: ConversationHistory) -> Iterator[str]:
+        """
+        Generates text based on the provided conversation history, yielding it in chunks
+        as they arrive. Closing the iterator cancels the rest of the generation.
+
+        Responses are not cached, but the rate limiter (if any) is applied as in
+        `generate_text`.
+
+        Args:
+            conversation_history (ConversationHistory): The conversation history
+                that the LLM will use as context to generate the text.
+
+        Yields:
+            str: The chunks of the generated text.
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(
+                self.count_conversation_tokens(conversation_history))
+
+        response_chunks = []
+        text_stream = self._generate_text_stream(conversation_history)
+        try:
+            for chunk in text_stream:
+                response_chunks.append(chunk)
+                yield chunk
+        finally:
+            text_stream.close()
+            if self.rate_limiter is not None:
+                self.rate_limiter.consume_tokens(
+                    self.count_tokens("".join(response_chunks)))
+
+    def _read_json_stream(self, conversation_history: ConversationHistory, on_field: Callable[[str, object], None] = None) -> str:
+        """
+        Streams a response and returns it as soon as its outermost JSON object is closed,
+        cancelling the rest of the stream.
+
+        Args:
+            conversation_history (ConversationHistory): The conversation history
+                that the LLM will use as context to generate the text.
+            on_field (Callable[[str, object], None], optional): Called with the key and
+                value of every top-level field of the JSON object as soon as it is complete.
+                Defaults to None.
+
+        Returns:
+            str: The JSON text, or the whole response if no complete JSON was found.
+        """
+        detector = JsonCompletionDetector()
+        text_stream = self.generate_text_stream(conversation_history)
+        try:
+            for chunk in text_stream:
+                completed_fields = detector.feed(chunk)
+                if on_field is not None:
+                    for key, value in completed_fields:
+                        on_field(key, value)
+                if detector.is_complete():
+                    return detector.get_json_text()
+        finally:
+            # Cancel the rest of the stream
+            text_stream.close()
+        return detector.get_text()
+
+    def generate_text(self, conversation_history: ConversationHistory, sample_index: int = 0) -> str:
+        """
+        Generates text based on the provided conversation history.
+
+        Args:
+            conversation_history (ConversationHistory): The conversation history
+                that the LLM will use as context to generate the text.
+            sample_index (int, optional): Index of the sample when the same conversation
+                is sent several times to get different responses. Defaults to 0.
+
+        Returns:
+            str: The generated text.
+        """
+        cache_key, cached_response = self._get_cached_response(conversation_history,
+                                                               sample_index,
+                                                               CACHE_KIND_TEXT)
+        if cached_response is not None:
+            self._record_call(kind=CACHE_KIND_TEXT, attempt=0, retry=0,
+                              cache_hit=True, latency=0.0, error=None)
+            return cached_response
+
+        response_text = self._call_provider(conversation_history, sample_index=sample_index)
+
+        self._set_cached_response(cache_key, response_text)
+        return response_text
+
+    def generate_text_samples(self, conversation_history: ConversationHistory, n_samples: int, first_sample_index: int = 0) -> list:
+        """
+        Generates several samples of text for the same conversation history, in as few
+        calls as the provider allows (see MAX_SAMPLES_PER_CALL). Every sample is cached as
+        the response of `generate_text` with its sample index.
+
+        Args:
+            conversation_history (ConversationHistory): The conversation history
+                that the LLM will use as context to generate the text.
+            n_samples (int): Number of samples.
+            first_sample_index (int, optional): Sample index of the first sample, the
+                next ones follow it. Defaults to 0.
+
+        Returns:
+            list: The generated texts, by sample ("" for samples dropped by the provider).
+        """
+        cache_keys, responses = self._get_cached_samples(conversation_history, n_samples,
+                                                         first_sample_index, CACHE_KIND_TEXT)
+        missing_sample_indices = [sample_index for sample_index in cache_keys
+                                  if sample_index not in responses]
+        if len(missing_sample_indices) > 0:
+            try:
+                response_texts = self._call_provider_samples(conversation_history, missing_sample_indices)
+            except SamplesRejectedError:
+                # One sample per call from now on
+                response_texts = self._call_provider_samples(conversation_history, missing_sample_indices)
+            for sample_index, response_text in zip(missing_sample_indices, response_texts):
+                responses[sample_index] = response_text
+                self._set_cached_response(cache_keys[sample_index], response_text)
+        return [responses.get(sample_index, "") for sample_index in cache_keys]
+
     def _clean_response(self, text: str) -> str:
         """
         Extract the JSON-like portion from the model's response by finding the text
@@ -68,40 +770,266 @@ class LargeLanguageModel(ABC):
         else:
             return ""
 
-    def generate_json(self, conversation_history: ConversationHistory) -> Tuple[str, float]:
+    def _parse_json_response(self, raw_response: str, required_keys: list = None) -> str:
+        """
+        Extracts the JSON of a response, repairing it locally if it cannot be parsed
+        (trailing commas, single quotes...). Truncated responses are only closed if
+        required keys are given and the closed response has all of them (see
+        `json_repair.repair_json`), otherwise they are generated again.
+
+        Args:
+            raw_response (str): The response of the LLM.
+            required_keys (list, optional): Keys that a repaired response must have (e.g.
+                the fields of a plan). Defaults to None.
+
+        Raises:
+            json.decoder.JSONDecodeError: If the JSON cannot be parsed nor repaired.
+
+        Returns:
+            str: The valid JSON string.
+        """
+        response = self._clean_response(raw_response)
+        try:
+            json.loads(response)
+            self._count("json_valid")
+            return response
+        except json.decoder.JSONDecodeError:
+            repaired_response = json_repair.repair_json(raw_response)
+            if repaired_response is None and required_keys is not None:
+                repaired_response = json_repair.repair_json(raw_response, close_truncated=True)
+            if repaired_response is None:
+                raise
+            if required_keys is not None and not json_repair.has_keys(repaired_response, required_keys):
+                raise
+            self._count("json_repaired")
+            return repaired_response
+
+    def generate_json(self, conversation_history: ConversationHistory, sample_index: int = 0, on_field: Callable[[str, object], None] = None, required_keys: list = None) -> str:
         """
         Generates a JSON-like response by repeatedly attempting to generate text
         from the conversation history and parsing it as JSON.
 
+        A response that cannot be parsed is first repaired locally (trailing commas,
+        single quotes...), and the LLM is only asked again if that fails (responses
+        truncated inside a string or before a required key, or repairs without the
+        required keys) and the retry policy allows it. Calls given up by the retry
+        policy resolve to "{}" instead of aborting the whole run.
+
+        If streaming is enabled (or `on_field` is given), every attempt is streamed and
+        resolved as soon as the outermost JSON object is closed.
+
         Args:
             conversation_history (ConversationHistory): The conversation history
                 that the LLM will use as context to generate the text.
+            sample_index (int, optional): Index of the sample when the same conversation
+                is sent several times to get different responses. Defaults to 0.
+            on_field (Callable[[str, object], None], optional): Called with the key and
+                value of every top-level field of the streamed JSON object as soon as it
+                is complete (e.g. "relevant_objects"). Defaults to None.
+            required_keys (list, optional): Keys that a repaired response must have (e.g.
+                the fields of a plan). Defaults to None.
 
         Returns:
-            Tuple[str, float]: A tuple containing the valid JSON string (or "{}" if
-                no valid response was found) and the total cost associated with the requests.
-                # TODO: update
+            str: The valid JSON string, or "{}" if no valid response was found.
         """
+        cache_key, cached_response = self._get_cached_response(conversation_history,
+                                                               sample_index,
+                                                               CACHE_KIND_JSON)
+        if cached_response is not None:
+            self._record_call(kind=CACHE_KIND_JSON, attempt=0, retry=0,
+                              cache_hit=True, latency=0.0, error=None)
+            return cached_response
+
         attempt = 1
-        while attempt <= self.JSON_MAX_ATTEMPTS:
+        while True:
+            raw_response = ""
             response = ""
             try:
-                response = self.generate_text(conversation_history)
-                # print(response)
+                # Not through generate_text, a cached wrong response would be returned again
+                raw_response = self._call_provider(conversation_history,
+                                                   kind=CACHE_KIND_JSON,
+                                                   attempt=attempt,
+                                                   read_json_stream=self.streaming or on_field is not None,
+                                                   on_field=on_field,
+                                                   sample_index=sample_index)
+                # print(raw_response)
 
-                # Clean response
-                response = self._clean_response(response)
-                # Try to parse response
-                json.loads(response)
+                # Clean response (repaired locally before asking the LLM again)
+                response = self._parse_json_response(raw_response, required_keys)
+                self._set_cached_response(cache_key, response)
                 return response  # Return the valid JSON response
 
-            except (json.decoder.JSONDecodeError, IndexError) as e:
+            except json.decoder.JSONDecodeError as e:
                 print(f"Error generating JSON on attempt {
                     attempt}: {str(e)}")
-                print("WARNING: wrong response: " + response)
+                print("WARNING: wrong response: " + raw_response)
+                if not self.retry_policy.should_retry(ERROR_PARSE, attempt):
+                    print(
+                        "Couldn't get a valid JSON response, max attempts exceeded")
+                    break
+
+            except ProviderCallError as e:
+                print(f"Error generating JSON: {str(e)}")
+                break
 
+            self._count("json_regenerated")
             attempt += 1  # Increment attempt counter
 
-        print(
-            "Couldn't get a valid JSON response, max attempts exceeded")
+        self._count("json_failed")
         return "{}"
+
+    def generate_json_samples(self, conversation_history: ConversationHistory, n_samples: int, first_sample_index: int = 0, required_keys: list = None) -> list:
+        """
+        Generates several JSON samples for the same conversation history (e.g. the plans
+        of an ensemble), in as few calls as the provider allows: up to
+        MAX_SAMPLES_PER_CALL candidates are returned by every call, so the conversation
+        is sent (and its input tokens billed) once instead of once per sample.
+
+        Samples are parsed, repaired and cached one by one as in `generate_json` (with
+        their sample index), and only the samples that cannot be parsed nor repaired are
+        asked again, in a single call, as long as the retry policy allows it. Samples
+        given up resolve to "{}". If the provider rejects the calls with several samples,
+        the samples are generated one per call (see `_call_provider_samples`).
+
+        Args:
+            conversation_history (ConversationHistory): The conversation history
+                that the LLM will use as context to generate the text.
+            n_samples (int): Number of samples.
+            first_sample_index (int, optional): Sample index of the first sample, the
+                next ones follow it. Defaults to 0.
+            required_keys (list, optional): Keys that a repaired response must have (e.g.
+                the fields of a plan). Defaults to None.
+
+        Returns:
+            list: The valid JSON strings (or "{}" if no valid response was found), by sample.
+        """
+        try:
+            return self._generate_json_samples(conversation_history, n_samples, first_sample_index, required_keys)
+        except SamplesRejectedError:
+            # One sample per call from now on, the samples already parsed are cached
+            return self._generate_json_samples(conversation_history, n_samples, first_sample_index, required_keys)
+
+    def _generate_json_samples(self, conversation_history: ConversationHistory, n_samples: int, first_sample_index: int, required_keys: list) -> list:
+        """
+        Generates several JSON samples as `generate_json_samples`, raising
+        SamplesRejectedError if the provider rejects a call with several samples.
+        """
+        cache_keys, responses = self._get_cached_samples(conversation_history, n_samples,
+                                                         first_sample_index, CACHE_KIND_JSON)
+
+        attempt = 1
+        missing_sample_indices = [sample_index for sample_index in cache_keys
+                                  if sample_index not in responses]
+        while len(missing_sample_indices) > 0:
+            try:
+                raw_responses = self._call_provider_samples(conversation_history,
+                                                            missing_sample_indices,
+                                                            kind=CACHE_KIND_JSON,
+                                                            attempt=attempt)
+            except ProviderCallError as e:
+                print(f"Error generating JSON samples: {str(e)}")
+                break
+
+            for sample_index, raw_response in zip(missing_sample_indices, raw_responses):
+                try:
+                    responses[sample_index] = self._parse_json_response(raw_response, required_keys)
+                    self._set_cached_response(cache_keys[sample_index], responses[sample_index])
+                except json.decoder.JSONDecodeError:
+                    print("WARNING: wrong response: " + raw_response)
+
+            missing_sample_indices = [sample_index for sample_index in missing_sample_indices
+                                      if sample_index not in responses]
+            if len(missing_sample_indices) == 0:
+                break
+            print(f"Error generating JSON samples on attempt {attempt}: "
+                  f"{len(missing_sample_indices)} of {n_samples} samples missing or malformed")
+            if not self.retry_policy.should_retry(ERROR_PARSE, attempt):
+                print(
+                    "Couldn't get valid JSON responses, max attempts exceeded")
+                break
+
+            for _ in missing_sample_indices:
+                self._count("json_regenerated")
+            attempt += 1
+
+        for sample_index in cache_keys:
+            if sample_index not in responses:
+                self._count("json_failed")
+        return [responses.get(sample_index, "{}") for sample_index in cache_keys]
+
+    async def agenerate_text(self, conversation_history: ConversationHistory, sample_index: int = 0) -> str:
+        """
+        Asynchronous version of `generate_text`.
+
+        The blocking provider call is executed in a worker thread of the event loop's
+        default executor, so several calls can be awaited concurrently. If the calls are
+        scheduled (see `call_scheduler`), the call first waits for a free call slot.
+
+        Args:
+            conversation_history (ConversationHistory): The conversation history
+                that the LLM will use as context to generate the text.
+            sample_index (int, optional): Index of the sample. Defaults to 0.
+
+        Returns:
+            str: The generated text.
+        """
+        async with call_scheduler.call_slot():
+            return await asyncio.to_thread(self.generate_text, conversation_history, sample_index)
+
+    async def agenerate_json(self, conversation_history: ConversationHistory, sample_index: int = 0, required_keys: list = None) -> str:
+        """
+        Asynchronous version of `generate_json`.
+
+        The whole retry loop of `generate_json` is executed in a worker thread of the
+        event loop's default executor, so several calls can be awaited concurrently. If
+        the calls are scheduled (see `call_scheduler`), the call first waits for a free
+        call slot.
+
+        Args:
+            conversation_history (ConversationHistory): The conversation history
+                that the LLM will use as context to generate the text.
+            sample_index (int, optional): Index of the sample. Defaults to 0.
+            required_keys (list, optional): Keys that a repaired response must have.
+                Defaults to None.
+
+        Returns:
+            str: The valid JSON string (or "{}" if no valid response was found).
+        """
+        async with call_scheduler.call_slot():
+            return await asyncio.to_thread(self.generate_json, conversation_history, sample_index,
+                                           required_keys=required_keys)
+
+    async def agenerate_json_samples(self, conversation_history: ConversationHistory, n_samples: int, first_sample_index: int = 0, required_keys: list = None) -> list:
+        """
+        Asynchronous version of `generate_json_samples`.
+
+        If the provider generates a single sample per call, or JSON responses are
+        streamed, the samples are generated with concurrent `agenerate_json` calls
+        instead (one call per sample). Otherwise, the calls of the samples are executed
+        in a worker thread and hold a single call slot (see `call_scheduler`), and if the
+        provider rejects the calls with several samples, the missing samples fall back to
+        concurrent `agenerate_json` calls (as every later call of the run).
+
+        Args:
+            conversation_history (ConversationHistory): The conversation history
+                that the LLM will use as context to generate the text.
+            n_samples (int): Number of samples.
+            first_sample_index (int, optional): Sample index of the first sample.
+                Defaults to 0.
+            required_keys (list, optional): Keys that a repaired response must have.
+                Defaults to None.
+
+        Returns:
+            list: The valid JSON strings (or "{}" if no valid response was found), by sample.
+        """
+        if self.MAX_SAMPLES_PER_CALL > 1 and not self.streaming:
+            try:
+                async with call_scheduler.call_slot():
+                    return await asyncio.to_thread(self._generate_json_samples, conversation_history,
+                                                   n_samples, first_sample_index, required_keys)
+            except SamplesRejectedError:
+                # One sample per call from now on, the samples already parsed are cached
+                pass
+        return list(await asyncio.gather(*[self.agenerate_json(conversation_history, sample_index, required_keys)
+                                           for sample_index in range(first_sample_index,
+                                                                     first_sample_index + n_samples)]))
@@ -1,4 +1,5 @@
 import logging
+from typing import Iterator
 
 import tiktoken
 from openai import OpenAI
@@ -17,7 +18,13 @@ class OpenAiGptProvider(LargeLanguageModel):
 
     TOKEN_REMOVAL_CONSTANT = 150
 
-    def __init__(self, openai_api_key: str, model_name: str, max_output_tokens: int = 500):
+    # API key sent to servers that do not need one (e.g. the local stand-in server)
+    PLACEHOLDER_API_KEY = "stand-in"
+
+    # Maximum number of choices of a chat completion (parameter "n")
+    MAX_SAMPLES_PER_CALL = 128
+
+    def __init__(self, openai_api_key: str, model_name: str, max_output_tokens: int = 500, base_url: str = None):
         """
         Initializes the OpenAIProvider with the given API key, model name, and maximum output tokens.
 
@@ -25,10 +32,16 @@ class OpenAiGptProvider(LargeLanguageModel):
             openai_api_key (str): The API key for authenticating with the OpenAI service.
             model_name (str): The name of the model to use (e.g., "gpt-3.5-turbo").
             max_output_tokens (int, optional): The maximum number of tokens for the output. Defaults to 500.
+            base_url (str, optional): Base URL of an OpenAI-compatible API (e.g. the local
+                stand-in server, "http://127.0.0.1:8080/v1"). Defaults to None (OpenAI API).
         """
+        super().__init__()
         self.model_name = model_name
         self.max_output_tokens = max_output_tokens
-        self.client = OpenAI(api_key=openai_api_key)
+        if base_url is not None and openai_api_key is None:
+            openai_api_key = self.PLACEHOLDER_API_KEY
+        self.client = OpenAI(api_key=openai_api_key,
+                             base_url=base_url)
         try:
             self.tokenizer = tiktoken.encoding_for_model(model_name)
         except KeyError:  # TODO: temporal! no tokenizer for chat gpt 4o
@@ -37,15 +50,47 @@ class OpenAiGptProvider(LargeLanguageModel):
     def get_provider_name(self) -> str:
         return f"OpenAI_{self.model_name}"
 
-    def generate_text(self, conversation_history: ConversationHistory) -> str:
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text))
+
+    def _generate_text(self, conversation_history: ConversationHistory) -> str:
+        return self._generate_text_samples(conversation_history, 1)[0]
+
+    def _generate_text_samples(self, conversation_history: ConversationHistory, n_samples: int) -> list:
         # Get conversation history
         chat_gpt_prompt = conversation_history.get_chat_gpt_conversation_history()
 
-        # Get response
+        # Get response (one choice per sample, the prompt is only sent once)
         response = self.client.chat.completions.create(
             messages=chat_gpt_prompt,
-            model=self.model_name
+            model=self.model_name,
+            n=n_samples
         )
-        response_text = response.choices[0].message.content
+        response_texts = [choice.message.content or "" for choice in response.choices]
+        if response.usage is not None:
+            # Prompt prefixes are cached automatically (at least 1024 tokens), the cached
+            # tokens are given in the details of the usage (not modelled by this SDK version)
+            prompt_tokens_details = getattr(response.usage, "prompt_tokens_details", None) or dict()
+            self._report_usage(response.usage.prompt_tokens,
+                               response.usage.completion_tokens,
+                               prompt_tokens_details.get("cached_tokens", 0))
+
+        return response_texts
 
-        return response_text
+    def _generate_text_stream(self, conversation_history: ConversationHistory) -> Iterator[str]:
+        # Get conversation history
+        chat_gpt_prompt = conversation_history.get_chat_gpt_conversation_history()
+
+        # Get response stream
+        stream = self.client.chat.completions.create(
+            messages=chat_gpt_prompt,
+            model=self.model_name,
+            stream=True
+        )
+        try:
+            for chunk in stream:
+                if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Closes the connection if the stream was not consumed
+            stream.close()
@@ -0,0 +1,73 @@
+import threading
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    # Only for type hints, the provider SDKs are not imported until a provider is built
+    from llm.large_language_model import LargeLanguageModel
+
+
+class ProviderRegistry:
+    """
+    Registry of the available LLM providers, addressed by their command line constant
+    (e.g. "g15p").
+
+    Providers are registered with a factory and only built the first time they are
+    requested, so scripts that only need the provider names (e.g. for evaluation) do not
+    import the provider SDKs nor need their credentials.
+    """
+
+    def __init__(self):
+        self.factories = dict()
+        self.provider_names = dict()
+        self.providers = dict()
+        self.lock = threading.Lock()
+
+    def register(self, constant: str, provider_name: str, factory: Callable[[], "LargeLanguageModel"]):
+        """
+        Registers a provider.
+
+        Args:
+            constant (str): Constant identifying the provider (e.g. "g15p").
+            provider_name (str): Name of the provider, as returned by its `get_provider_name`.
+            factory (Callable[[], LargeLanguageModel]): Function that builds the provider.
+        """
+        self.factories[constant] = factory
+        self.provider_names[constant] = provider_name
+
+    def get_constants(self) -> list:
+        """
+        Returns the constants of every registered provider.
+        """
+        return list(self.factories.keys())
+
+    def get_provider_name(self, constant: str) -> str:
+        """
+        Returns the name of a provider without building it.
+
+        Args:
+            constant (str): Constant identifying the provider.
+
+        Returns:
+            str: The name of the provider.
+        """
+        if constant not in self.provider_names:
+            raise ValueError(f"Constant value {constant} not known")
+        return self.provider_names[constant]
+
+    def get(self, constant: str) -> "LargeLanguageModel":
+        """
+        Returns a provider, building it on first use. Every call with the same constant
+        returns the same instance.
+
+        Args:
+            constant (str): Constant identifying the provider.
+
+        Returns:
+            LargeLanguageModel: The provider.
+        """
+        if constant not in self.factories:
+            raise ValueError(f"Constant value {constant} not known")
+        with self.lock:
+            if constant not in self.providers:
+                self.providers[constant] = self.factories[constant]()
+            return self.providers[constant]
@@ -0,0 +1,131 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a constant rate.
+
+    The bucket can go into debt: an amount bigger than its capacity is admitted once
+    the bucket is full, and later amounts have to wait until the debt is paid back.
+    This way the long-term admitted rate is exactly the refill rate, whatever the
+    size of the individual amounts.
+    """
+
+    def __init__(self, rate_per_minute: float, burst_seconds: float = 1.0):
+        """
+        Initializes a full TokenBucket.
+
+        Args:
+            rate_per_minute (float): Amount refilled every minute.
+            burst_seconds (float, optional): Seconds of refill that the bucket can hold,
+                i.e. how much can be admitted at once after being idle. Defaults to 1.0.
+        """
+        self.refill_per_second = rate_per_minute / 60
+        self.capacity = max(1.0, self.refill_per_second * burst_seconds)
+        self.available = self.capacity
+        self.last_refill_time = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity,
+                             self.available + (now - self.last_refill_time) * self.refill_per_second)
+        self.last_refill_time = now
+
+    def time_until_available(self, amount: float) -> float:
+        """
+        Computes how long to wait until `amount` can be consumed.
+
+        Args:
+            amount (float): Amount to be consumed.
+
+        Returns:
+            float: Seconds to wait (0 if it can be consumed right now).
+        """
+        self._refill()
+        missing = min(amount, self.capacity) - self.available
+        if missing <= 0:
+            return 0.0
+        return missing / self.refill_per_second
+
+    def consume(self, amount: float):
+        """
+        Consumes `amount` from the bucket, possibly leaving it in debt.
+
+        Args:
+            amount (float): Amount to be consumed.
+        """
+        self._refill()
+        self.available -= amount
+
+
+class RateLimiter:
+    """
+    Thread-safe rate limiter for the calls to an LLM provider, with a requests-per-minute
+    (RPM) and a tokens-per-minute (TPM) budget. Any of them can be disabled.
+    """
+
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None, burst_seconds: float = 1.0):
+        """
+        Initializes the RateLimiter.
+
+        Args:
+            requests_per_minute (float, optional): Requests allowed per minute. Defaults to None (no limit).
+            tokens_per_minute (float, optional): Tokens allowed per minute. Defaults to None (no limit).
+            burst_seconds (float, optional): Seconds of budget that can be spent at once. Defaults to 1.0.
+        """
+        self.requests_bucket = TokenBucket(requests_per_minute, burst_seconds) \
+            if requests_per_minute else None
+        self.tokens_bucket = TokenBucket(tokens_per_minute, burst_seconds) \
+            if tokens_per_minute else None
+
+        # Protects the buckets
+        self.lock = threading.Lock()
+        # Only one caller waits at a time, so big requests are not starved by small ones
+        self.admission_lock = threading.Lock()
+
+        self.total_wait_time = 0.0
+
+    def _time_until_available(self, tokens: int) -> float:
+        wait_time = 0.0
+        if self.requests_bucket is not None:
+            wait_time = max(wait_time,
+                            self.requests_bucket.time_until_available(1))
+        if self.tokens_bucket is not None:
+            wait_time = max(wait_time,
+                            self.tokens_bucket.time_until_available(tokens))
+        return wait_time
+
+    def acquire(self, tokens: int = 0):
+        """
+        Blocks until a request of `tokens` (estimated) tokens can be sent, and consumes
+        its budget.
+
+        Args:
+            tokens (int, optional): Estimated tokens of the request. Defaults to 0.
+        """
+        with self.admission_lock:
+            while True:
+                with self.lock:
+                    wait_time = self._time_until_available(tokens)
+                    if wait_time <= 0:
+                        if self.requests_bucket is not None:
+                            self.requests_bucket.consume(1)
+                        if self.tokens_bucket is not None:
+                            self.tokens_bucket.consume(tokens)
+                        return
+                self.total_wait_time += wait_time
+                time.sleep(wait_time)
+
+    def consume_tokens(self, tokens: int):
+        """
+        Consumes tokens that were not known when the request was admitted (e.g. the
+        tokens of the response), without waiting.
+
+        Args:
+            tokens (int): Number of tokens.
+        """
+        if self.tokens_bucket is None:
+            return
+        with self.lock:
+            self.tokens_bucket.consume(tokens)
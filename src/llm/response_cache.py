@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from llm.conversation_history import ConversationHistory
+
+CACHE_KIND_TEXT = "text"
+CACHE_KIND_JSON = "json"
+
+
+class CacheBackend(ABC):
+    """
+    Storage of the cached LLM responses, addressed by key.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> str:
+        """
+        Returns the value stored for the key, or None if there is none.
+        """
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: str):
+        """
+        Stores the value for the key, overwriting any previous one.
+        """
+        pass
+
+    @abstractmethod
+    def delete(self, key: str):
+        """
+        Deletes the value stored for the key, if any.
+        """
+        pass
+
+    @abstractmethod
+    def keys(self) -> list:
+        """
+        Returns the stored keys, from least to most recently used.
+        """
+        pass
+
+    def touch(self, key: str):
+        """
+        Marks the key as recently used. Only needed by persistent backends.
+        """
+        pass
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    Cache backend that keeps the responses in memory (they are lost when the process ends).
+    """
+
+    def __init__(self):
+        self.values = dict()
+
+    def get(self, key: str) -> str:
+        return self.values.get(key)
+
+    def set(self, key: str, value: str):
+        self.values[key] = value
+
+    def delete(self, key: str):
+        self.values.pop(key, None)
+
+    def keys(self) -> list:
+        return list(self.values.keys())
+
+
+class DiskCacheBackend(CacheBackend):
+    """
+    Cache backend that stores every response in its own JSON file inside a folder.
+    The modification time of the files keeps track of their last use.
+    """
+
+    FILE_EXTENSION = ".json"
+
+    def __init__(self, folder_path: str):
+        self.folder_path = folder_path
+        os.makedirs(folder_path, exist_ok=True)
+
+    def _get_file_path(self, key: str) -> str:
+        # Two-character sub-folders to avoid huge folders
+        return os.path.join(self.folder_path, key[:2], key + self.FILE_EXTENSION)
+
+    def get(self, key: str) -> str:
+        try:
+            with open(self._get_file_path(key), "r", encoding="utf-8") as file:
+                return json.load(file)["value"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+
+    def set(self, key: str, value: str):
+        file_path = self._get_file_path(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # Write to a temporary file first, so a killed run never leaves a half-written entry
+        temporary_file_path = f"{file_path}.{threading.get_ident()}.tmp"
+        with open(temporary_file_path, "w", encoding="utf-8") as file:
+            json.dump({"value": value}, file, ensure_ascii=False)
+        os.replace(temporary_file_path, file_path)
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._get_file_path(key))
+        except FileNotFoundError:
+            pass
+
+    def keys(self) -> list:
+        entries = list()
+        for directory_path, _, file_names in os.walk(self.folder_path):
+            for file_name in file_names:
+                if file_name.endswith(self.FILE_EXTENSION):
+                    file_path = os.path.join(directory_path, file_name)
+                    entries.append((os.path.getmtime(file_path),
+                                    file_name[:-len(self.FILE_EXTENSION)]))
+        return [key for _, key in sorted(entries)]
+
+    def touch(self, key: str):
+        try:
+            os.utime(self._get_file_path(key))
+        except FileNotFoundError:
+            pass
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of LLM responses with least-recently-used (LRU) eviction.
+
+    Responses are addressed by a hash of everything that determines them: the provider
+    and model, the generation parameters, the sample index (to keep apart several
+    samples of the same prompt) and the whole conversation history. A changed prompt
+    therefore never reuses a stale response, and identical requests are only paid once.
+    """
+
+    def __init__(self, backend: CacheBackend, max_entries: int = None):
+        """
+        Initializes the ResponseCache.
+
+        Args:
+            backend (CacheBackend): Storage of the responses.
+            max_entries (int, optional): Maximum number of responses kept, the least recently
+                used ones are evicted first. Defaults to None (no limit).
+        """
+        self.backend = backend
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        # Recency index of the stored keys (least recently used first)
+        self.lru_keys = OrderedDict((key, None) for key in backend.keys())
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._evict()
+
+    @staticmethod
+    def get_key(provider_name: str, generation_parameters: dict, sample_index: int, conversation_history: ConversationHistory, kind: str) -> str:
+        """
+        Computes the cache key of a request.
+
+        Args:
+            provider_name (str): Name of the provider and model.
+            generation_parameters (dict): Parameters that affect the generation (e.g. temperature).
+            sample_index (int): Index of the sample, for repeated requests with the same prompt.
+            conversation_history (ConversationHistory): The conversation sent to the model.
+            kind (str): Kind of the response (text or JSON).
+
+        Returns:
+            str: The SHA-256 hex digest identifying the request.
+        """
+        request = {
+            "provider": provider_name,
+            "generation_parameters": generation_parameters,
+            "sample_index": sample_index,
+            "kind": kind,
+            "conversation": conversation_history.get_chat_gpt_conversation_history(),
+        }
+        request_str = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request_str.encode("utf-8")).hexdigest()
+
+    def _evict(self):
+        if self.max_entries is None:
+            return
+        while len(self.lru_keys) > self.max_entries:
+            evicted_key, _ = self.lru_keys.popitem(last=False)
+            self.backend.delete(evicted_key)
+            self.evictions += 1
+
+    def get(self, key: str) -> str:
+        """
+        Returns the cached response for the key, or None on a miss.
+        """
+        with self.lock:
+            value = self.backend.get(key) if key in self.lru_keys else None
+            if value is None:
+                self.lru_keys.pop(key, None)
+                self.misses += 1
+                return None
+            self.lru_keys.move_to_end(key)
+            self.backend.touch(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: str):
+        """
+        Stores the response for the key, evicting the least recently used ones if needed.
+        """
+        with self.lock:
+            self.backend.set(key, value)
+            self.lru_keys[key] = None
+            self.lru_keys.move_to_end(key)
+            self._evict()
+
+    def get_statistics(self) -> dict:
+        """
+        Returns the hit, miss and eviction counters of the cache.
+        """
+        with self.lock:
+            n_lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / n_lookups if n_lookups > 0 else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.lru_keys),
+            }
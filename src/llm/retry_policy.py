@@ -0,0 +1,299 @@
+import json
+import random
+import threading
+import time
+from typing import Callable
+
+# Classes of errors of the calls to the LLM service providers
+ERROR_RATE_LIMIT = "rate_limit"
+ERROR_TRANSIENT = "transient"
+ERROR_CONTENT_BLOCK = "content_block"
+ERROR_PARSE = "parse"
+ERROR_PERMANENT = "permanent"
+
+RETRYABLE_ERRORS = [ERROR_RATE_LIMIT,
+                    ERROR_TRANSIENT,
+                    ERROR_CONTENT_BLOCK,
+                    ERROR_PARSE]
+
+# HTTP status codes of the retryable errors (OpenAI errors have a `status_code`,
+# Google API errors a `code`)
+RATE_LIMIT_STATUS_CODES = [429]
+TRANSIENT_STATUS_CODES = [408, 409, 500, 502, 503, 504]
+
+# Names of the SDK exceptions, so the SDKs do not have to be imported to classify them
+RATE_LIMIT_ERROR_NAMES = ["RateLimitError",
+                          "ResourceExhausted",
+                          "TooManyRequests"]
+TRANSIENT_ERROR_NAMES = ["APIConnectionError",
+                         "APITimeoutError",
+                         "InternalServerError",
+                         "ServiceUnavailable",
+                         "DeadlineExceeded",
+                         "GatewayTimeout",
+                         "BadGateway",
+                         "Aborted",
+                         "RetryError",
+                         # Dropped connections and incomplete bodies (requests, http.client, httpx)
+                         "ConnectionError",
+                         "ChunkedEncodingError",
+                         "ReadTimeout",
+                         "RemoteDisconnected",
+                         "IncompleteRead",
+                         "RemoteProtocolError"]
+CONTENT_BLOCK_MESSAGES = ["blocked", "safety"]
+
+# Permanent errors that every call of the run would get (authentication, permissions,
+# model not found, missing credentials), so the run is stopped instead of skipping
+# every query
+RUN_STATUS_CODES = [401, 403, 404]
+RUN_ERROR_NAMES = ["AuthenticationError",
+                   "PermissionDeniedError",
+                   "NotFoundError",
+                   "Unauthenticated",
+                   "PermissionDenied",
+                   "NotFound",
+                   "DefaultCredentialsError",
+                   "RefreshError",
+                   # Raised by the OpenAI client without an API key
+                   "OpenAIError"]
+
+
+class ProviderCallError(Exception):
+    """
+    Raised when a call to an LLM service provider is given up: after a retryable error,
+    because its attempts or the retry budget were exhausted, or at once after a
+    permanent error of the request (e.g. an invalid argument or an unexpected response),
+    so the query is skipped and the run goes on.
+    """
+
+    def __init__(self, error_class: str, attempts: int, cause: Exception):
+        super().__init__(
+            f"Provider call failed with {error_class} error after {attempts} attempts: {cause!r}")
+        self.error_class = error_class
+        self.attempts = attempts
+        self.cause = cause
+
+
+class SamplesRejectedError(Exception):
+    """
+    Raised when a call generating several samples (candidates) of a conversation is
+    rejected with a permanent error (e.g. a model that only accepts one candidate per
+    request), so the samples have to be generated one per call.
+    """
+
+    def __init__(self, n_samples: int, cause: Exception):
+        super().__init__(
+            f"Provider call with {n_samples} samples rejected: {cause!r}")
+        self.n_samples = n_samples
+        self.cause = cause
+
+
+def _get_status_code(error: Exception) -> int:
+    status_code = getattr(error, "status_code", None)
+    if not isinstance(status_code, int):
+        status_code = getattr(error, "code", None)
+    return status_code
+
+
+def classify_error(error: Exception) -> str:
+    """
+    Classifies an error raised by a call to an LLM service provider.
+
+    Args:
+        error (Exception): The error.
+
+    Returns:
+        str: The class of the error (ERROR_RATE_LIMIT, ERROR_TRANSIENT,
+            ERROR_CONTENT_BLOCK, ERROR_PARSE or ERROR_PERMANENT).
+    """
+    if isinstance(error, json.decoder.JSONDecodeError):
+        return ERROR_PARSE
+
+    # Gemini responses blocked by the safety filters have no candidates (or no parts)
+    if isinstance(error, IndexError):
+        return ERROR_CONTENT_BLOCK
+    if isinstance(error, ValueError) and any(message in str(error).lower()
+                                             for message in CONTENT_BLOCK_MESSAGES):
+        return ERROR_CONTENT_BLOCK
+
+    error_name = type(error).__name__
+    status_code = _get_status_code(error)
+
+    if status_code in RATE_LIMIT_STATUS_CODES or error_name in RATE_LIMIT_ERROR_NAMES:
+        return ERROR_RATE_LIMIT
+    if status_code in TRANSIENT_STATUS_CODES or error_name in TRANSIENT_ERROR_NAMES:
+        return ERROR_TRANSIENT
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return ERROR_TRANSIENT
+
+    return ERROR_PERMANENT
+
+
+def is_run_error(error: Exception) -> bool:
+    """
+    Returns whether a permanent error affects the whole run (authentication,
+    permissions, model not found or missing credentials) rather than a single request
+    (e.g. an invalid argument, an oversized prompt or an unexpected response).
+    """
+    return _get_status_code(error) in RUN_STATUS_CODES or type(error).__name__ in RUN_ERROR_NAMES
+
+
+class RetryPolicy:
+    """
+    Retry policy of the calls to an LLM service provider.
+
+    Errors are classified (see `classify_error`). Permanent errors are not retried: the
+    ones of the run (see `is_run_error`) are raised as they are, to stop the run, and
+    the ones of the request are given up as the retryable ones that cannot be retried
+    (ProviderCallError), so only their query is skipped. Retryable errors are retried up
+    to a number of attempts per error class, waiting an exponential backoff with full jitter
+    (a random delay between 0 and base_delay * 2^(attempt - 1), capped at max_delay).
+
+    Retries are also limited by a retry budget shared by every call of the provider:
+    each call earns `budget_ratio` retries (plus `min_retries` to start with), so a
+    provider that is down does not get a retry storm that burns the quota.
+    """
+
+    # Maximum number of attempts (first one included), by error class
+    MAX_ATTEMPTS = {
+        ERROR_RATE_LIMIT: 8,
+        ERROR_TRANSIENT: 5,
+        ERROR_CONTENT_BLOCK: 3,
+        ERROR_PARSE: 10,
+    }
+
+    # Base delay of the backoff in seconds, by error class (parse failures and content
+    # blocks are not caused by the load of the provider, so they are retried at once)
+    BASE_DELAYS = {
+        ERROR_RATE_LIMIT: 2.0,
+        ERROR_TRANSIENT: 1.0,
+        ERROR_CONTENT_BLOCK: 0.0,
+        ERROR_PARSE: 0.0,
+    }
+
+    def __init__(self, max_attempts: dict = None, base_delays: dict = None, max_delay: float = 60.0, budget_ratio: float = 0.2, min_retries: int = 20):
+        """
+        Initializes the RetryPolicy.
+
+        Args:
+            max_attempts (dict, optional): Maximum number of attempts by error class.
+                Defaults to MAX_ATTEMPTS.
+            base_delays (dict, optional): Base delay of the backoff in seconds by error class.
+                Defaults to BASE_DELAYS.
+            max_delay (float, optional): Maximum delay between attempts in seconds. Defaults to 60.0.
+            budget_ratio (float, optional): Retries earned by every call. Defaults to 0.2.
+            min_retries (int, optional): Retries available before any call is made. Defaults to 20.
+        """
+        self.max_attempts = self.MAX_ATTEMPTS | (max_attempts or dict())
+        self.base_delays = self.BASE_DELAYS | (base_delays or dict())
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.min_retries = min_retries
+
+        self.lock = threading.Lock()
+        self.n_calls = 0
+        self.retries = {error_class: 0 for error_class in RETRYABLE_ERRORS}
+        self.failures = {error_class: 0 for error_class in RETRYABLE_ERRORS + [ERROR_PERMANENT]}
+        self.budget_exhaustions = 0
+        self.backoff_time = 0.0
+
+    def get_delay(self, error_class: str, attempt: int) -> float:
+        """
+        Returns the (jittered) delay before retrying after a failed attempt.
+
+        Args:
+            error_class (str): Class of the error of the attempt.
+            attempt (int): Number of the failed attempt, starting at 1.
+
+        Returns:
+            float: The delay in seconds.
+        """
+        delay = min(self.max_delay,
+                    self.base_delays[error_class] * 2 ** (attempt - 1))
+        return random.uniform(0.0, delay)
+
+    def should_retry(self, error_class: str, attempt: int) -> bool:
+        """
+        Decides whether a failed attempt is retried, withdrawing the retry from the budget.
+
+        Args:
+            error_class (str): Class of the error of the attempt.
+            attempt (int): Number of the failed attempt, starting at 1.
+
+        Returns:
+            bool: True if the attempt has to be retried.
+        """
+        with self.lock:
+            if error_class not in RETRYABLE_ERRORS or attempt >= self.max_attempts[error_class]:
+                self.failures[error_class] += 1
+                return False
+            n_retries = sum(self.retries.values())
+            if n_retries >= self.min_retries + self.budget_ratio * self.n_calls:
+                self.failures[error_class] += 1
+                self.budget_exhaustions += 1
+                return False
+            self.retries[error_class] += 1
+            return True
+
+    def wait(self, error_class: str, attempt: int):
+        """
+        Sleeps the backoff delay before retrying a failed attempt.
+
+        Args:
+            error_class (str): Class of the error of the attempt.
+            attempt (int): Number of the failed attempt, starting at 1.
+        """
+        delay = self.get_delay(error_class, attempt)
+        if delay > 0:
+            time.sleep(delay)
+            with self.lock:
+                self.backoff_time += delay
+
+    def call(self, function: Callable[[], object]) -> object:
+        """
+        Calls a function that calls the LLM service provider, retrying it according
+        to the policy.
+
+        Args:
+            function (Callable[[], object]): The function.
+
+        Raises:
+            ProviderCallError: If a retryable error persists after the allowed attempts,
+                or after a permanent error of the request.
+            Exception: The original error, if it is a permanent error of the run.
+
+        Returns:
+            object: The value returned by the function.
+        """
+        with self.lock:
+            self.n_calls += 1
+
+        # Failed attempts by error class, each class has its own limit and backoff
+        attempts = dict()
+        while True:
+            try:
+                return function()
+            except Exception as e:
+                error_class = classify_error(e)
+                attempts[error_class] = attempts.get(error_class, 0) + 1
+                attempt = attempts[error_class]
+                if not self.should_retry(error_class, attempt):
+                    if error_class == ERROR_PERMANENT and is_run_error(e):
+                        raise
+                    raise ProviderCallError(error_class, sum(attempts.values()), e) from e
+                print(f"WARNING: {error_class} error on attempt {attempt}, retrying: {e!r}")
+                self.wait(error_class, attempt)
+
+    def get_statistics(self) -> dict:
+        """
+        Returns the retry and failure counters of the policy, by error class.
+        """
+        with self.lock:
+            statistics = {f"retries_{error_class}": n_retries
+                          for error_class, n_retries in self.retries.items()}
+            statistics |= {f"failures_{error_class}": n_failures
+                           for error_class, n_failures in self.failures.items()}
+            statistics["retry_budget_exhaustions"] = self.budget_exhaustions
+            statistics["backoff_time"] = self.backoff_time
+            return statistics
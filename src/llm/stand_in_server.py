@@ -0,0 +1,445 @@
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm.conversation_history import ConversationHistory
+from llm.fake_provider import FakeLlmProvider
+
+OPENAI_CHAT_COMPLETIONS_PATH = "/v1/chat/completions"
+GEMINI_PATH_PATTERN = re.compile(
+    r"/models/(?P<model>[^/:]+):(?P<method>generateContent|streamGenerateContent)$")
+GEMINI_CACHED_CONTENTS_PATH_PATTERN = re.compile(
+    r"/(?P<parent>projects/[^/]+/locations/[^/]+)/cachedContents$")
+GEMINI_CACHED_CONTENT_PATH_PATTERN = re.compile(
+    r"/(?P<name>projects/[^/]+/locations/[^/]+/cachedContents/[^/]+)$")
+
+# Minimum number of tokens of a prompt prefix cached by the OpenAI API
+OPENAI_MIN_CACHED_TOKENS = 1024
+
+# Faults injected by the server, in the order they are drawn
+FAULT_RATE_LIMIT = "rate_limit"
+FAULT_TIMEOUT = "timeout"
+FAULT_TRUNCATED_BODY = "truncated_body"
+
+# Characters of every chunk of the streamed responses
+STREAM_CHUNK_SIZE = 16
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Local HTTP server that emulates the OpenAI chat-completions API and the Vertex AI
+    Gemini REST API (generateContent and streamGenerateContent), so the real client
+    stacks of the providers (connection setup, serialization, retries) can be
+    benchmarked and load-tested offline, pointing the providers to it through their
+    `base_url`.
+
+    Responses are generated by a `FakeLlmProvider` (deterministic, schema-valid and with
+    its latency distribution and malformed JSON rate), and HTTP faults are injected at
+    configurable rates: 429 responses, timeouts (the connection hangs and is dropped
+    without response) and truncated bodies (the connection is dropped mid-body).
+
+    Context caching is emulated too: Gemini cached contents can be created, referenced
+    and deleted, and OpenAI prompts report as cached the longest prefix of messages
+    (of at least 1024 tokens) already seen in a previous request.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, responder: FakeLlmProvider = None, rate_limit_rate: float = 0.0, timeout_rate: float = 0.0, timeout_seconds: float = 30.0, truncated_body_rate: float = 0.0, seed: int = 0):
+        """
+        Initializes the StandInServer (it does not start serving).
+
+        Args:
+            host (str, optional): Host to listen on. Defaults to "127.0.0.1".
+            port (int, optional): Port to listen on, 0 for any free port. Defaults to 0.
+            responder (FakeLlmProvider, optional): Generator of the responses. Defaults to
+                None (a FakeLlmProvider without latency).
+            rate_limit_rate (float, optional): Probability of answering 429. Defaults to 0.0.
+            timeout_rate (float, optional): Probability of not answering. Defaults to 0.0.
+            timeout_seconds (float, optional): Time the connection hangs before being
+                dropped on a timeout. Defaults to 30.0.
+            truncated_body_rate (float, optional): Probability of dropping the connection
+                in the middle of the body. Defaults to 0.0.
+            seed (int, optional): Seed of the injected faults. Defaults to 0.
+        """
+        super().__init__((host, port), StandInRequestHandler)
+        self.responder = responder if responder is not None else FakeLlmProvider()
+        self.fault_rates = {
+            FAULT_RATE_LIMIT: rate_limit_rate,
+            FAULT_TIMEOUT: timeout_rate,
+            FAULT_TRUNCATED_BODY: truncated_body_rate,
+        }
+        self.timeout_seconds = timeout_seconds
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_faults = {fault: 0 for fault in self.fault_rates}
+        self.thread = None
+
+        # Gemini cached contents by name, and hashes of the OpenAI prompt prefixes seen
+        self.cached_contents = dict()
+        self.prompt_prefixes = set()
+        self.n_cached_contents = 0
+
+    def get_base_url(self) -> str:
+        """
+        Returns the base URL of the server (e.g. "http://127.0.0.1:8080").
+        """
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def draw_fault(self) -> str:
+        """
+        Draws the fault injected in a request.
+
+        Returns:
+            str: The fault, or None if the request is answered normally.
+        """
+        with self.lock:
+            self.n_requests += 1
+            for fault, rate in self.fault_rates.items():
+                if self.random.random() < rate:
+                    self.n_faults[fault] += 1
+                    return fault
+        return None
+
+    def start(self):
+        """
+        Starts serving in a background thread.
+        """
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops serving and closes the socket.
+        """
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def handle_error(self, request, client_address):
+        # Clients drop the connection when they cancel a stream or time out
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def get_statistics(self) -> dict:
+        """
+        Returns the number of requests received and of injected faults.
+        """
+        with self.lock:
+            return {"requests": self.n_requests,
+                    "cached_contents_created": self.n_cached_contents} | {
+                f"faults_{fault}": n_faults for fault, n_faults in self.n_faults.items()}
+
+    def create_cached_content(self, parent: str, cached_content: dict) -> dict:
+        """
+        Creates a Gemini cached content.
+
+        Args:
+            parent (str): Parent of the resource ("projects/PROJECT/locations/LOCATION").
+            cached_content (dict): The cached content (model, system instruction, contents).
+
+        Returns:
+            dict: The created resource, with its name.
+        """
+        with self.lock:
+            self.n_cached_contents += 1
+            name = f"{parent}/cachedContents/{uuid.uuid4().hex}"
+            self.cached_contents[name] = cached_content | {"name": name}
+            return self.cached_contents[name]
+
+    def get_cached_content(self, name: str) -> dict:
+        with self.lock:
+            return self.cached_contents.get(name)
+
+    def delete_cached_content(self, name: str) -> bool:
+        with self.lock:
+            return self.cached_contents.pop(name, None) is not None
+
+    def get_cached_prompt_tokens(self, messages: list) -> int:
+        """
+        Emulates the automatic prompt caching of OpenAI: returns the tokens of the longest
+        prefix of messages (of at least OPENAI_MIN_CACHED_TOKENS) seen in a previous
+        request, and remembers the prefixes of this one.
+
+        Args:
+            messages (list): Messages of the request.
+
+        Returns:
+            int: The cached tokens of the prompt.
+        """
+        prefix_hashes = list()
+        prefix_hash = hashlib.sha256()
+        for message in messages:
+            prefix_hash.update(json.dumps(message, sort_keys=True).encode("utf-8"))
+            prefix_hashes.append(prefix_hash.hexdigest())
+
+        cached_tokens = 0
+        with self.lock:
+            for n_messages in range(len(messages), 0, -1):
+                if prefix_hashes[n_messages - 1] in self.prompt_prefixes:
+                    cached_tokens = sum(self.responder.count_tokens(message.get("content") or "") +
+                                        self.responder.TOKENS_PER_MESSAGE
+                                        for message in messages[:n_messages])
+                    break
+            self.prompt_prefixes.update(prefix_hashes)
+        return cached_tokens if cached_tokens >= OPENAI_MIN_CACHED_TOKENS else 0
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+
+    # Keep-alive connections, as the real APIs
+    protocol_version = "HTTP/1.1"
+
+    server: StandInServer
+
+    def log_message(self, format, *args):
+        # Requests are not logged, it would dominate the benchmarks
+        pass
+
+    def do_POST(self):
+        request_body = json.loads(self.rfile.read(
+            int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = self.path.split("?")[0]
+
+        cached_contents_match = GEMINI_CACHED_CONTENTS_PATH_PATTERN.search(path)
+        if cached_contents_match is not None:
+            self._send_json(200, self.server.create_cached_content(cached_contents_match.group("parent"),
+                                                                   request_body))
+            return
+
+        gemini_match = GEMINI_PATH_PATTERN.search(path)
+        if path != OPENAI_CHAT_COMPLETIONS_PATH and gemini_match is None:
+            self._send_json(404, {"error": {"code": 404,
+                                            "message": f"Unknown path {path}"}})
+            return
+
+        fault = self.server.draw_fault()
+        if fault == FAULT_RATE_LIMIT:
+            self._send_json(429, {"error": {"code": 429,
+                                            "message": "Resource has been exhausted (stand-in).",
+                                            "status": "RESOURCE_EXHAUSTED",
+                                            "type": "rate_limit_exceeded"}})
+            return
+        if fault == FAULT_TIMEOUT:
+            time.sleep(self.server.timeout_seconds)
+            self.close_connection = True
+            return
+
+        # Prepend the cached content referenced by the request (Gemini)
+        cached_content_name = request_body.get("cachedContent", request_body.get("cached_content"))
+        if gemini_match is not None and cached_content_name:
+            cached_content = self.server.get_cached_content(cached_content_name)
+            if cached_content is None:
+                self._send_json(404, {"error": {"code": 404,
+                                                "message": f"Cached content {cached_content_name} not found",
+                                                "status": "NOT_FOUND"}})
+                return
+            request_body = request_body | {
+                "systemInstruction": cached_content.get("systemInstruction",
+                                                        cached_content.get("system_instruction")),
+                "contents": cached_content.get("contents", list()) + request_body.get("contents", list())}
+
+        # Generate the responses (with the latency of the responder)
+        cached_tokens = 0
+        if gemini_match is None:
+            conversation_history = _get_openai_conversation_history(request_body)
+            cached_tokens = self.server.get_cached_prompt_tokens(request_body.get("messages", list()))
+            n_responses = request_body.get("n") or 1
+            streaming = request_body.get("stream", False)
+            model_name = request_body.get("model", "")
+        else:
+            conversation_history = _get_gemini_conversation_history(request_body)
+            generation_config = request_body.get("generationConfig",
+                                                 request_body.get("generation_config", dict()))
+            n_responses = generation_config.get("candidateCount",
+                                                generation_config.get("candidate_count")) or 1
+            streaming = gemini_match.group("method") == "streamGenerateContent"
+            model_name = gemini_match.group("model")
+
+        # Candidates of a request are generated together (with the latency of one call)
+        response_texts = self.server.responder.generate_text_samples(conversation_history, n_responses)
+        prompt_tokens = self.server.responder.count_conversation_tokens(
+            conversation_history)
+        completion_tokens = sum(self.server.responder.count_tokens(response_text)
+                                for response_text in response_texts)
+        truncated = fault == FAULT_TRUNCATED_BODY
+
+        if gemini_match is None and streaming:
+            self._send_openai_stream(model_name, response_texts, truncated)
+        elif gemini_match is None:
+            self._send_json(200, _get_openai_response(model_name, response_texts,
+                                                      prompt_tokens, completion_tokens,
+                                                      cached_tokens),
+                            truncated)
+        elif streaming:
+            self._send_gemini_stream(response_texts, prompt_tokens,
+                                     completion_tokens, truncated)
+        else:
+            self._send_json(200, _get_gemini_response(response_texts, prompt_tokens,
+                                                      completion_tokens),
+                            truncated)
+
+    def do_DELETE(self):
+        path = self.path.split("?")[0]
+        cached_content_match = GEMINI_CACHED_CONTENT_PATH_PATTERN.search(path)
+        if cached_content_match is None or not self.server.delete_cached_content(cached_content_match.group("name")):
+            self._send_json(404, {"error": {"code": 404,
+                                            "message": f"Unknown resource {path}",
+                                            "status": "NOT_FOUND"}})
+            return
+        self._send_json(200, dict())
+
+    def _send_json(self, status_code: int, body: dict, truncated: bool = False):
+        body_bytes = json.dumps(body).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body_bytes)))
+        self.end_headers()
+        if truncated:
+            # Announced length not honoured, the client gets an incomplete body
+            self.wfile.write(body_bytes[:len(body_bytes) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body_bytes)
+
+    def _start_chunked(self, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, data: str):
+        data_bytes = data.encode("utf-8")
+        self.wfile.write(f"{len(data_bytes):x}\r\n".encode("ascii") +
+                         data_bytes + b"\r\n")
+        self.wfile.flush()
+
+    def _end_chunked(self, truncated: bool):
+        if truncated:
+            # Stream dropped before its end
+            self.close_connection = True
+        else:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def _send_openai_stream(self, model_name: str, response_texts: list, truncated: bool):
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        chunks = list()
+        for index, response_text in enumerate(response_texts):
+            for start_index in range(0, len(response_text), STREAM_CHUNK_SIZE):
+                chunks.append(_get_openai_chunk(completion_id, model_name, index,
+                                                {"content": response_text[start_index:start_index + STREAM_CHUNK_SIZE]},
+                                                None))
+            chunks.append(_get_openai_chunk(completion_id, model_name, index,
+                                            dict(), "stop"))
+        if truncated:
+            chunks = chunks[:len(chunks) // 2]
+
+        self._start_chunked("text/event-stream")
+        for chunk in chunks:
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+        if not truncated:
+            self._write_chunk("data: [DONE]\n\n")
+        self._end_chunked(truncated)
+
+    def _send_gemini_stream(self, response_texts: list, prompt_tokens: int, completion_tokens: int, truncated: bool):
+        # JSON array of partial responses, one chunk of text of every candidate each
+        n_chunks = max((len(response_text) + STREAM_CHUNK_SIZE - 1) // STREAM_CHUNK_SIZE
+                       for response_text in response_texts)
+        partial_responses = [
+            _get_gemini_response([response_text[chunk_index * STREAM_CHUNK_SIZE:(chunk_index + 1) * STREAM_CHUNK_SIZE]
+                                  for response_text in response_texts],
+                                 prompt_tokens, completion_tokens)
+            for chunk_index in range(n_chunks)]
+        if truncated:
+            partial_responses = partial_responses[:len(partial_responses) // 2]
+
+        self._start_chunked("application/json")
+        for index, partial_response in enumerate(partial_responses):
+            self._write_chunk(("[" if index == 0 else ",\r\n") +
+                              json.dumps(partial_response))
+        if not truncated:
+            self._write_chunk("]" if partial_responses else "[]")
+        self._end_chunked(truncated)
+
+
+def _get_openai_conversation_history(request_body: dict) -> ConversationHistory:
+    conversation_history = ConversationHistory()
+    for message in request_body.get("messages", list()):
+        content = message.get("content") or ""
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") for part in content)
+        if message.get("role") == "system":
+            conversation_history.append_system_message(content)
+        elif message.get("role") == "assistant":
+            conversation_history.append_assistant_message(content)
+        else:
+            conversation_history.append_user_message(content)
+    return conversation_history
+
+
+def _get_gemini_conversation_history(request_body: dict) -> ConversationHistory:
+    conversation_history = ConversationHistory()
+    system_instruction = request_body.get("systemInstruction",
+                                          request_body.get("system_instruction"))
+    if system_instruction is not None:
+        conversation_history.append_system_message(
+            "".join(part.get("text", "") for part in system_instruction.get("parts", list())))
+    for content in request_body.get("contents", list()):
+        text = "".join(part.get("text", "") for part in content.get("parts", list()))
+        if content.get("role") == "model":
+            conversation_history.append_assistant_message(text)
+        else:
+            conversation_history.append_user_message(text)
+    return conversation_history
+
+
+def _get_openai_response(model_name: str, response_texts: list, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> dict:
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model_name,
+        "choices": [{"index": index,
+                     "message": {"role": "assistant", "content": response_text},
+                     "finish_reason": "stop"}
+                    for index, response_text in enumerate(response_texts)],
+        "usage": {"prompt_tokens": prompt_tokens,
+                  "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens,
+                  "prompt_tokens_details": {"cached_tokens": cached_tokens}},
+    }
+
+
+def _get_openai_chunk(completion_id: str, model_name: str, index: int, delta: dict, finish_reason: str) -> dict:
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model_name,
+        "choices": [{"index": index,
+                     "delta": delta,
+                     "finish_reason": finish_reason}],
+    }
+
+
+def _get_gemini_response(response_texts: list, prompt_tokens: int, completion_tokens: int) -> dict:
+    return {
+        "candidates": [{"index": index,
+                        "content": {"role": "model", "parts": [{"text": response_text}]},
+                        "finishReason": "STOP"}
+                       for index, response_text in enumerate(response_texts)],
+        "usageMetadata": {"promptTokenCount": prompt_tokens,
+                          "candidatesTokenCount": completion_tokens,
+                          "totalTokenCount": prompt_tokens + completion_tokens},
+    }
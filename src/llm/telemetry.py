@@ -0,0 +1,228 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Coroutine
+
+from llm import tracing
+
+# Stages of the agentic workflows
+STAGE_PLAN = "plan"
+# Plan of a batch of queries in a single call
+STAGE_PLAN_BATCH = "plan_batch"
+STAGE_REFLECT = "reflect"
+STAGE_CORRECT = "correct"
+STAGE_CHOOSE = "choose"
+
+# Tags of the calls made in the current context (workflow, stage, map, query...).
+# Context variables are copied into the worker threads of `asyncio.to_thread` and into
+# every new task, so concurrent queries do not see each other's tags
+CALL_TAGS = contextvars.ContextVar("call_tags", default=dict())
+
+PERCENTILES = [50, 95, 99]
+
+
+@contextmanager
+def tag_calls(**tags):
+    """
+    Tags every LLM call made inside the context (nested contexts add or override tags).
+
+    If tracing is enabled, the context is also traced as a span named after its most
+    specific tag (the stage, else the query), with the tags as arguments.
+
+    Example:
+        with telemetry.tag_calls(workflow="base", stage=telemetry.STAGE_PLAN, query="query_01"):
+            response = await llm_provider.agenerate_json(conversation_history)
+
+    Args:
+        **tags: Tags of the calls (e.g. workflow, stage, map, query).
+    """
+    token = CALL_TAGS.set(CALL_TAGS.get() | tags)
+    try:
+        with tracing.span(*_get_span_name(tags), **tags):
+            yield
+    finally:
+        CALL_TAGS.reset(token)
+
+
+async def tagged(coroutine: Coroutine, **tags):
+    """
+    Awaits a coroutine tagging every LLM call it makes (see `tag_calls`).
+
+    Args:
+        coroutine (Coroutine): The coroutine (e.g. the workflow of a query).
+        **tags: Tags of the calls.
+
+    Returns:
+        Any: The value returned by the coroutine.
+    """
+    with tag_calls(**tags):
+        return await coroutine
+
+
+def _get_span_name(tags: dict) -> tuple:
+    """
+    Returns the name and category of the trace span of a tagging context.
+    """
+    for key in ("stage", "query", "map", "workflow"):
+        if key in tags:
+            return str(tags[key]), key
+    return "calls", "tags"
+
+
+def get_call_tags() -> dict:
+    """
+    Returns the tags of the calls made in the current context.
+    """
+    return dict(CALL_TAGS.get())
+
+
+def percentile(values: list, percent: float) -> float:
+    """
+    Computes a percentile of a list of values, interpolating between the closest ranks.
+
+    Args:
+        values (list): The values.
+        percent (float): The percentile, between 0 and 100.
+
+    Returns:
+        float: The percentile, or None if there are no values.
+    """
+    if len(values) == 0:
+        return None
+    sorted_values = sorted(values)
+    rank = (len(sorted_values) - 1) * percent / 100
+    lower_index = int(rank)
+    upper_index = min(lower_index + 1, len(sorted_values) - 1)
+    return sorted_values[lower_index] + (sorted_values[upper_index] - sorted_values[lower_index]) * (rank - lower_index)
+
+
+def _sum_costs(call_records: list) -> float:
+    # None if the cost of no call is known (provider without prices)
+    costs = [call_record["cost"] for call_record in call_records
+             if call_record.get("cost") is not None]
+    if len(costs) == 0:
+        return None
+    return sum(costs)
+
+
+class Telemetry:
+    """
+    Collects a record of every LLM call (every attempt sent to the provider and every
+    cache hit), with its latency, outcome and the tags of its context, and writes them
+    to a JSON Lines file as they arrive.
+
+    At the end of a run, `get_summary` gives the latency percentiles of every
+    (workflow, stage), to find where the tail latency of the workflows is.
+    """
+
+    def __init__(self, file_path: str = None):
+        """
+        Initializes the Telemetry.
+
+        Args:
+            file_path (str, optional): JSON Lines file to which the records are appended.
+                Defaults to None (records are only kept in memory).
+        """
+        self.file_path = file_path
+        self.records = list()
+        self.lock = threading.Lock()
+        if file_path is not None:
+            os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+
+    @classmethod
+    def load(cls, file_path: str) -> "Telemetry":
+        """
+        Loads the records of a JSON Lines telemetry file (e.g. of a past run), to
+        summarize them again. New records are not written to the file.
+
+        Args:
+            file_path (str): The JSON Lines file.
+
+        Returns:
+            Telemetry: The telemetry, with the records of the file.
+        """
+        loaded_telemetry = cls()
+        with open(file_path, "r", encoding="utf-8") as file:
+            loaded_telemetry.records = [json.loads(line) for line in file if line.strip()]
+        return loaded_telemetry
+
+    def record(self, **fields):
+        """
+        Records a call, together with the tags of the current context.
+
+        Args:
+            **fields: Fields of the call (e.g. provider, latency, attempt, cache_hit).
+        """
+        call_record = {"timestamp": time.time()} | get_call_tags() | fields
+        with self.lock:
+            self.records.append(call_record)
+            if self.file_path is not None:
+                with open(self.file_path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(call_record) + "\n")
+
+    def get_records(self) -> list:
+        """
+        Returns a copy of the records collected so far.
+        """
+        with self.lock:
+            return list(self.records)
+
+    def get_summary(self, group_keys: tuple = ("workflow", "stage")) -> dict:
+        """
+        Summarizes the records by group (by default, by workflow and stage).
+
+        Latency percentiles only take into account the calls sent to the provider (not
+        the cache hits), every retry counted as a call of its own. Tokens and cost are
+        those of the calls sent to the provider (cache hits are free).
+
+        Args:
+            group_keys (tuple, optional): Tags that define the groups. Defaults to
+                ("workflow", "stage").
+
+        Returns:
+            dict: Number of calls, cache hits, errors, input and output tokens, estimated
+                cost (None if no call has a price), total latency and latency percentiles
+                (p50, p95, p99) by group (tuple of tag values).
+        """
+        groups = dict()
+        for call_record in self.get_records():
+            group = tuple(call_record.get(key) for key in group_keys)
+            groups.setdefault(group, list()).append(call_record)
+
+        summary = dict()
+        for group, call_records in sorted(groups.items(), key=lambda item: str(item[0])):
+            latencies = [call_record["latency"] for call_record in call_records
+                         if not call_record.get("cache_hit")]
+            summary[group] = {
+                "calls": len(latencies),
+                "cache_hits": len(call_records) - len(latencies),
+                "errors": sum(1 for call_record in call_records
+                              if call_record.get("error") is not None),
+                "input_tokens": sum(call_record.get("input_tokens") or 0 for call_record in call_records),
+                "output_tokens": sum(call_record.get("output_tokens") or 0 for call_record in call_records),
+                "cost": _sum_costs(call_records),
+                "total_latency": sum(latencies),
+            } | {f"p{percent}": percentile(latencies, percent) for percent in PERCENTILES}
+        return summary
+
+    def print_summary(self, group_keys: tuple = ("workflow", "stage")):
+        """
+        Prints the latency summary by group (see `get_summary`).
+        """
+        summary = self.get_summary(group_keys)
+        if len(summary) == 0:
+            return
+        print(f"{' / '.join(group_keys):<40}{'calls':>7}{'cached':>8}{'errors':>8}"
+              f"{'in tokens':>11}{'out tokens':>11}{'cost ($)':>10}"
+              f"{'total (s)':>11}" + "".join(f"{f'p{percent} (s)':>10}" for percent in PERCENTILES))
+        for group, group_summary in summary.items():
+            cost = f"{group_summary['cost']:>10.4f}" if group_summary["cost"] is not None else f"{'-':>10}"
+            print(f"{' / '.join(str(value) for value in group):<40}{group_summary['calls']:>7}"
+                  f"{group_summary['cache_hits']:>8}{group_summary['errors']:>8}"
+                  f"{group_summary['input_tokens']:>11}{group_summary['output_tokens']:>11}{cost}"
+                  f"{group_summary['total_latency']:>11.2f}" +
+                  "".join(f"{group_summary[f'p{percent}']:>10.3f}" if group_summary[f"p{percent}"] is not None else f"{'-':>10}"
+                          for percent in PERCENTILES))
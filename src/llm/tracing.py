@@ -0,0 +1,156 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Span open in the current context, parent of the spans opened inside it. Context
+# variables are copied into every new task and `asyncio.to_thread` worker, so the spans
+# of concurrent queries (and ensemble planners) get the right parents
+CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+
+# Tracer of the run, None if tracing is disabled
+TRACER = None
+
+
+class Span:
+    """
+    Timed operation of a trace (run, semantic map, query, workflow stage or provider attempt).
+    """
+
+    def __init__(self, name: str, category: str, parent: "Span", lane: int, args: dict):
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.lane = lane
+        self.args = args
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        # Whether the span took a new lane (it releases it when it ends)
+        self.owns_lane = False
+
+
+class Tracer:
+    """
+    Collects hierarchical spans (run -> map -> query -> stage -> attempt) and exports them
+    in the Chrome trace event format, which can be opened in chrome://tracing or Perfetto.
+
+    Every span is drawn in a lane (a thread of the trace viewer). A span is drawn in the
+    lane of its parent, unless another child of the parent is still open there (e.g.
+    concurrent queries, or the concurrent planners of an ensemble); then it takes a new
+    lane, which is freed when it ends. Lanes are reused, so the timeline shows the
+    concurrency actually reached.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.events = list()
+        # Open spans of every lane (innermost last) and free lanes
+        self.lane_spans = dict()
+        self.free_lanes = list()
+        self.n_lanes = 0
+
+    def _acquire_lane(self) -> int:
+        if self.free_lanes:
+            self.free_lanes.sort()
+            return self.free_lanes.pop(0)
+        self.n_lanes += 1
+        return self.n_lanes - 1
+
+    def start_span(self, name: str, category: str, args: dict) -> Span:
+        """
+        Starts a span, child of the span open in the current context.
+        """
+        parent = CURRENT_SPAN.get()
+        with self.lock:
+            if parent is not None and self.lane_spans.get(parent.lane, [None])[-1] is parent:
+                lane = parent.lane
+                owns_lane = False
+            else:
+                lane = self._acquire_lane()
+                owns_lane = True
+            span = Span(name, category, parent, lane, args)
+            span.owns_lane = owns_lane
+            self.lane_spans.setdefault(lane, list()).append(span)
+        return span
+
+    def end_span(self, span: Span):
+        """
+        Ends a span and records its event.
+        """
+        span.end_time = time.perf_counter()
+        with self.lock:
+            lane_spans = self.lane_spans[span.lane]
+            if span in lane_spans:
+                lane_spans.remove(span)
+            if span.owns_lane:
+                self.free_lanes.append(span.lane)
+            self.events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": (span.start_time - self.start_time) * 1e6,
+                "dur": (span.end_time - span.start_time) * 1e6,
+                "pid": os.getpid(),
+                "tid": span.lane,
+                "args": span.args | ({"parent": span.parent.name} if span.parent is not None else dict()),
+            })
+
+    def export(self, file_path: str):
+        """
+        Writes the recorded spans to a Chrome trace JSON file.
+
+        Args:
+            file_path (str): Path of the trace file.
+        """
+        with self.lock:
+            events = list(self.events)
+            n_lanes = self.n_lanes
+        metadata_events = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": lane,
+                            "args": {"name": f"lane {lane}"}}
+                           for lane in range(n_lanes)]
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        with open(file_path, "w", encoding="utf-8") as file:
+            json.dump({"traceEvents": metadata_events + sorted(events, key=lambda event: event["ts"]),
+                       "displayTimeUnit": "ms"},
+                      file)
+
+
+def set_tracer(tracer: Tracer):
+    """
+    Sets the tracer of the run.
+
+    Args:
+        tracer (Tracer): The tracer, or None to disable tracing.
+    """
+    global TRACER
+    TRACER = tracer
+
+
+@contextmanager
+def span(name: str, category: str, **args):
+    """
+    Traces the operations inside the context as a span, child of the span open in the
+    current context. Does nothing if no tracer is set.
+
+    Args:
+        name (str): Name of the span (e.g. "query_01", "reflect").
+        category (str): Category of the span (e.g. "query", "stage").
+        **args: Arguments shown with the span.
+
+    Yields:
+        Span: The span (its `args` can be updated inside the context), or None.
+    """
+    tracer = TRACER
+    if tracer is None:
+        yield None
+        return
+    current_span = tracer.start_span(name, category, args)
+    token = CURRENT_SPAN.set(current_span)
+    try:
+        yield current_span
+    finally:
+        CURRENT_SPAN.reset(token)
+        tracer.end_span(current_span)
@@ -1,16 +1,8 @@
 
-from constants import (
-    GOOGLE_GEMINI_CREDENTIALS_FILENAME,
-    GOOGLE_GEMINI_PROJECT_ID,
-    GOOGLE_GEMINI_PROJECT_LOCATION,
-)
+from constants import LLM_GEMINI_1_0_PRO, LLM_REGISTRY
 from llm.conversation_history import ConversationHistory
-from llm.google_gemini_provider import GoogleGeminiProvider
 
-gemini = GoogleGeminiProvider(credentials_file=GOOGLE_GEMINI_CREDENTIALS_FILENAME,
-                              project_id=GOOGLE_GEMINI_PROJECT_ID,
-                              project_location=GOOGLE_GEMINI_PROJECT_LOCATION,
-                              model_name=GoogleGeminiProvider.GEMINI_1_0_PRO)
+gemini = LLM_REGISTRY.get(LLM_GEMINI_1_0_PRO)
 
 
 if __name__ == "__main__":
@@ -1,485 +1,784 @@
 
 
 import argparse
+import asyncio
+import itertools
+import json
 import os
 import time
-
-import tqdm
+from typing import Callable
 
 import constants
+from llm import telemetry, tracing
 from llm.conversation_history import ConversationHistory
 from llm.large_language_model import LargeLanguageModel
+from llm.response_cache import DiskCacheBackend, ResponseCache
+from llm.retry_policy import ProviderCallError
 from prompt.chooser_prompt import ChooserPrompt
 from prompt.correction_prompt import (
     PromptCorrect,
     PromptCorrectAgent,
     PromptCorrectUser,
 )
-from prompt.planner_prompt import PromptPlan, PromptPlanAgent, PromptPlanUser
+from prompt.planner_prompt import (
+    PromptPlan,
+    PromptPlanAgent,
+    PromptPlanBatch,
+    PromptPlanUser,
+)
 from prompt.self_reflection_prompt import (
     PromptReflect,
     PromptReflectAgent,
     PromptReflectUser,
 )
 from utils import file_utils, text_utils
-from voxelad import preprocess
-
-
-def plan_base(mode: str, semantic_map: list[tuple], llm_provider: LargeLanguageModel, queries: list):
+from voxelad import preprocess, serialization
+from workflow import convergence, ensemble, executor
+from workflow.plan_store import PlanStore
+
+
+def get_semantic_map_text(semantic_map_object: dict, query_text: str) -> str:
+    """
+    Serializes a pre-processed semantic map for the prompts of a query, pruned to the
+    objects relevant to the query if map pruning is enabled.
+    """
+    if constants.MAP_PRUNER is not None:
+        semantic_map_object = constants.MAP_PRUNER.prune(semantic_map_object, query_text)
+    return serialization.serialize_semantic_map(semantic_map_object, constants.MAP_ENCODING)
+
+
+async def generate_first_plan(llm_provider: LargeLanguageModel, conversation_history: ConversationHistory) -> str:
+    """
+    Generates the first plan of a query (the `PromptPlan` conversation, first sample),
+    reusing the plan of another workflow if plan sharing is enabled (see `PlanStore`).
+    """
+    with telemetry.tag_calls(stage=telemetry.STAGE_PLAN):
+        if constants.PLAN_STORE is None:
+            return await llm_provider.agenerate_json(conversation_history, required_keys=constants.PLAN_KEYS)
+        return await constants.PLAN_STORE.aget_plan(llm_provider, conversation_history,
+                                                    lambda: llm_provider.agenerate_json(conversation_history,
+                                                                                        required_keys=constants.PLAN_KEYS))
+
+
+def get_base_output_file_path(mode: str, llm_provider: LargeLanguageModel, semantic_map_basename: str, query_id: str) -> str:
+    return os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
+                        mode,
+                        constants.get_method_folder(constants.METHOD_BASE),
+                        llm_provider.get_provider_name(),
+                        semantic_map_basename,
+                        query_id,
+                        "final_plan.json")
+
+
+async def plan_base_query(mode: str, semantic_map: tuple, llm_provider: LargeLanguageModel, query_id: str, query_text: str):
 
     semantic_map_basename = semantic_map[0]
     semantic_map_object = semantic_map[1]
 
-    for query_id, query_text in tqdm.tqdm(queries,
-                                          desc=f"Ex. {mode} {constants.METHOD_BASE} {semantic_map_basename} {llm_provider.get_provider_name()}..."):
+    # Skip if exists
+    output_file_path = get_base_output_file_path(mode, llm_provider,
+                                                 semantic_map_basename, query_id)
+    if os.path.exists(output_file_path):
+        print(f"Skipping {output_file_path}...")
+        return
 
-        # Skip if exists
-        output_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
-                                        mode,
-                                        constants.METHOD_BASE,
-                                        llm_provider.get_provider_name(),
-                                        semantic_map_basename,
-                                        query_id,
-                                        "final_plan.json")
-        if os.path.exists(output_file_path):
-            print(f"Skipping {output_file_path}...")
-            continue
+    conversation_history = ConversationHistory()
 
-        conversation_history = ConversationHistory()
+    # Append prompt (user)
+    prompt_plan = PromptPlan(
+        semantic_map=get_semantic_map_text(semantic_map_object, query_text),
+        query=query_text)
+    prompt_plan_text = prompt_plan.get_prompt_text()
+    conversation_history.append_user_message(prompt_plan_text)
+    # Everything but the query is shared by the queries on the map
+    conversation_history.mark_cacheable_prefix(
+        prompt_plan.get_cacheable_prefix_length(prompt_plan_text))
 
-        # Append prompt (user)
-        prompt_plan = PromptPlan(
-            semantic_map=text_utils.dict_to_json_str(semantic_map_object),
-            query=query_text)
-        conversation_history.append_user_message(
-            prompt_plan.get_prompt_text())
+    # Get response
+    response = await generate_first_plan(llm_provider, conversation_history)
 
-        # Get response
-        response = llm_provider.generate_json(conversation_history)
+    # Save response
+    file_utils.create_directories_for_file(output_file_path)
+    file_utils.save_json_str_to_file(json_str=response,
+                                     output_path=output_file_path)
 
-        # Save response
-        file_utils.create_directories_for_file(output_file_path)
-        file_utils.save_json_str_to_file(json_str=response,
-                                         output_path=output_file_path)
 
+async def plan_base(mode: str, semantic_map: tuple, llm_provider: LargeLanguageModel, queries: list, max_concurrency: int = 1, batch_size: int = 1, max_calls: int = None):
 
-def plan_self_reflection(mode: str, semantic_map: list, llm_provider: LargeLanguageModel, queries: list, reflection_iterations: int):
+    semantic_map_basename = semantic_map[0]
 
+    await executor.gather_with_concurrency(
+        plan_queries(constants.METHOD_BASE, mode, semantic_map, llm_provider, queries, 0, batch_size),
+        max_concurrency=max_concurrency,
+        max_calls=max_calls,
+        desc=f"Ex. {mode} {constants.METHOD_BASE} {semantic_map_basename} {llm_provider.get_provider_name()}...",
+        skipped_errors=(ProviderCallError,))
+
+
+def get_batch_plan(batch_response: dict, query_id: str) -> dict:
+    """
+    Returns the plan of a query in the response of a batch, or None if it is missing or
+    malformed (not a dictionary with all the fields of a plan).
+    """
+    plan = batch_response.get(query_id) if isinstance(batch_response, dict) else None
+    if not isinstance(plan, dict) or any(key not in plan for key in constants.PLAN_KEYS):
+        return None
+    if not isinstance(plan["relevant_objects"], list):
+        return None
+    return plan
+
+
+async def plan_base_batch(mode: str, semantic_map: tuple, llm_provider: LargeLanguageModel, queries: list) -> int:
+    """
+    Plans a batch of queries on a semantic map with a single call, which answers every
+    query under its query id. The plans of the queries that are missing or malformed in
+    the response (or all of them, if the call fails or its response is not a JSON
+    dictionary) are retried individually, as in `plan_base_query`.
+
+    Args:
+        mode (str): Semantic maps input mode (with uncertainty or not).
+        semantic_map (tuple): Pre-processed semantic map (basename, object).
+        llm_provider (LargeLanguageModel): LLM used in the workflow.
+        queries (list): Queries of the batch, as (query id, query text) pairs.
+
+    Returns:
+        int: Number of queries retried individually.
+    """
     semantic_map_basename = semantic_map[0]
     semantic_map_object = semantic_map[1]
-    semantic_map_object_str = text_utils.dict_to_json_str(semantic_map_object)
 
+    # Skip the queries that already have a response
+    pending_queries = list()
+    for query_id, query_text in queries:
+        output_file_path = get_base_output_file_path(mode, llm_provider,
+                                                     semantic_map_basename, query_id)
+        if os.path.exists(output_file_path):
+            print(f"Skipping {output_file_path}...")
+        else:
+            pending_queries.append((query_id, query_text))
+    if len(pending_queries) == 0:
+        return 0
+
+    conversation_history = ConversationHistory()
+
+    # Append prompt (user). Map pruning is query-specific, so the batch gets the whole map
+    prompt_plan = PromptPlanBatch(
+        semantic_map=serialization.serialize_semantic_map(semantic_map_object,
+                                                          constants.MAP_ENCODING),
+        queries=json.dumps(dict(pending_queries), indent=4))
+    prompt_plan_text = prompt_plan.get_prompt_text()
+    conversation_history.append_user_message(prompt_plan_text)
+    conversation_history.mark_cacheable_prefix(
+        prompt_plan.get_cacheable_prefix_length(prompt_plan_text))
+
+    # Get response ("{}" if the call failed, then every query is retried)
+    with telemetry.tag_calls(stage=telemetry.STAGE_PLAN_BATCH):
+        batch_response = json.loads(await llm_provider.agenerate_json(conversation_history))
+
+    # Save the plans of the response, the other queries are retried individually
+    retried_queries = list()
+    for query_id, query_text in pending_queries:
+        plan = get_batch_plan(batch_response, query_id)
+        if plan is None:
+            retried_queries.append((query_id, query_text))
+            continue
+        output_file_path = get_base_output_file_path(mode, llm_provider,
+                                                     semantic_map_basename, query_id)
+        file_utils.create_directories_for_file(output_file_path)
+        file_utils.save_json_str_to_file(json_str=json.dumps(plan, indent=4),
+                                         output_path=output_file_path)
+    if len(retried_queries) > 0:
+        print(f"WARNING: {len(retried_queries)} of {len(pending_queries)} queries of the batch on "
+              f"{semantic_map_basename} missing or malformed, planning them individually")
+
+    await asyncio.gather(*[telemetry.tagged(plan_base_query(mode, semantic_map, llm_provider, query_id, query_text),
+                                            query=query_id)
+                           for query_id, query_text in retried_queries])
+    return len(retried_queries)
+
+
+def plan_base_batches(mode: str, semantic_map: tuple, llm_provider: LargeLanguageModel, queries: list, batch_size: int) -> list:
+    """
+    Creates the coroutines that plan the queries on a semantic map in batches of
+    `batch_size` queries (see `plan_base_batch`). Every LLM call of a batch is tagged with
+    the base workflow, mode, semantic map and batch (or query, when retried individually)
+    in the telemetry.
+
+    Returns:
+        list: The coroutines, one per batch.
+    """
+    return [telemetry.tagged(plan_base_batch(mode, semantic_map, llm_provider, queries[index:index + batch_size]),
+                             workflow=constants.METHOD_BASE,
+                             mode=mode,
+                             map=semantic_map[0],
+                             query=f"batch_{index // batch_size:02d}")
+            for index in range(0, len(queries), batch_size)]
+
+
+def save_convergence(final_plan_file_path: str, stop_reason: str, n_iterations: int):
+    """
+    Records why and after how many reflection iterations a query stopped, next to its
+    final plan ("convergence.json"), if early exit is enabled.
+    """
+    if constants.CONVERGENCE_POLICY is None:
+        return
+    stop_reason = stop_reason or convergence.STOP_ITERATIONS
+    constants.CONVERGENCE_POLICY.record_stop(stop_reason, n_iterations)
+    file_utils.save_dict_to_json_file({"stop_reason": stop_reason,
+                                       "reflection_iterations": n_iterations},
+                                      os.path.join(os.path.dirname(final_plan_file_path), "convergence.json"))
+
+
+async def plan_self_reflection_query(mode: str, semantic_map: tuple, llm_provider: LargeLanguageModel, query_id: str, query_text: str, reflection_iterations: int):
+
+    semantic_map_basename = semantic_map[0]
+    semantic_map_object = semantic_map[1]
+    semantic_map_object_str = get_semantic_map_text(semantic_map_object, query_text)
+
+    # New query -> new conversation histories
     plan_conversation_history = ConversationHistory()
     self_reflection_conversation_history = ConversationHistory()
     correction_conversation_history = ConversationHistory()
 
-    for query_id, query_text in tqdm.tqdm(queries,
-                                          desc=f"Ex. {mode} {constants.METHOD_SELF_REFLECTION} {semantic_map_basename} {llm_provider.get_provider_name()}..."):
-
-        # New query -> empty conversation histories
-        plan_conversation_history.clear()
-        self_reflection_conversation_history.clear()
-        correction_conversation_history.clear()
+    ##########################################
+    ################## PLAN ##################
+    ##########################################
+    print("Planning...")
+    # Append prompt (user)
+    prompt_plan = PromptPlan(
+        semantic_map=semantic_map_object_str,
+        query=query_text)
+    prompt_plan_text = prompt_plan.get_prompt_text()
+    plan_conversation_history.append_user_message(prompt_plan_text)
+    plan_conversation_history.mark_cacheable_prefix(
+        prompt_plan.get_cacheable_prefix_length(prompt_plan_text))
+
+    # Skip if exists
+    plan_response_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
+                                           mode,
+                                           constants.get_method_folder(constants.METHOD_SELF_REFLECTION),
+                                           llm_provider.get_provider_name(),
+                                           semantic_map_basename,
+                                           query_id,
+                                           "plan_0.json")
+    # Get response
+    if os.path.exists(plan_response_file_path):
+        print(f"Skipping {plan_response_file_path}...")
+        plan_response = text_utils.dict_to_json_str(
+            file_utils.load_json(plan_response_file_path))
+    else:
+        plan_response = await generate_first_plan(llm_provider,
+                                                  plan_conversation_history)
+        file_utils.create_directories_for_file(plan_response_file_path)
+        file_utils.save_json_str_to_file(json_str=plan_response,
+                                         output_path=plan_response_file_path)
+    # Append response to conversation history
+    plan_conversation_history.append_assistant_message(plan_response)
+
+    # Initial plan is response to be refined
+    response_to_be_refined = plan_response
+
+    # Set reflection and correction first prompts (user), shared by the queries on the map
+    self_reflection_conversation_history.append_user_message(PromptReflect(
+        semantic_map=semantic_map_object_str).get_prompt_text())
+    self_reflection_conversation_history.mark_cacheable_prefix()
+    correction_conversation_history.append_user_message(PromptCorrect(
+        semantic_map=semantic_map_object_str).get_prompt_text())
+    correction_conversation_history.mark_cacheable_prefix()
+
+    stop_reason = None
+    for reflection_iteration_idx in range(reflection_iterations):
 
         ##########################################
-        ################## PLAN ##################
+        ############## SELF-REFLECT ##############
         ##########################################
-        print("Planning...")
+        print("Reflecting...")
         # Append prompt (user)
-        plan_conversation_history.append_user_message(
-            PromptPlan(
-                semantic_map=semantic_map_object_str,
-                query=query_text).get_prompt_text(),
+        self_reflection_conversation_history.append_user_message(
+            PromptReflectUser(
+                query=query_text,
+                plan_response=response_to_be_refined).get_prompt_text(),
         )
 
         # Skip if exists
-        plan_response_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
-                                               mode,
-                                               constants.METHOD_SELF_REFLECTION,
-                                               llm_provider.get_provider_name(),
-                                               semantic_map_basename,
-                                               query_id,
-                                               "plan_0.json")
+        self_reflection_response_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
+                                                          mode,
+                                                          constants.get_method_folder(constants.METHOD_SELF_REFLECTION),
+                                                          llm_provider.get_provider_name(),
+                                                          semantic_map_basename,
+                                                          query_id,
+                                                          f"self_reflection_{reflection_iteration_idx}.txt")
         # Get response
-        if os.path.exists(plan_response_file_path):
-            print(f"Skipping {plan_response_file_path}...")
-            plan_response = text_utils.dict_to_json_str(
-                file_utils.load_json(plan_response_file_path))
+        if os.path.exists(self_reflection_response_file_path):
+            print(f"Skipping {self_reflection_response_file_path}...")
+            self_reflection_response = text_utils.dict_to_json_str(
+                file_utils.read_text_from_file(self_reflection_response_file_path))
         else:
-            plan_response = llm_provider.generate_json(
-                plan_conversation_history)
-            file_utils.create_directories_for_file(plan_response_file_path)
-            file_utils.save_json_str_to_file(json_str=plan_response,
-                                             output_path=plan_response_file_path)
-        # Append response to conversation history
-        plan_conversation_history.append_assistant_message(plan_response)
-
-        # Initial plan is response to be refined
-        response_to_be_refined = plan_response
-
-        # Set reflection and correction first prompts (user)
-        self_reflection_conversation_history.append_user_message(PromptReflect(
-            semantic_map=semantic_map_object_str).get_prompt_text())
-        correction_conversation_history.append_user_message(PromptCorrect(
-            semantic_map=semantic_map_object_str).get_prompt_text())
-
-        for reflection_iteration_idx in range(reflection_iterations):
-
-            ##########################################
-            ############## SELF-REFLECT ##############
-            ##########################################
-            print("Reflecting...")
-            # Append prompt (user)
-            self_reflection_conversation_history.append_user_message(
-                PromptReflectUser(
-                    query=query_text,
-                    plan_response=response_to_be_refined).get_prompt_text(),
-            )
-
-            # Skip if exists
-            self_reflection_response_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
-                                                              mode,
-                                                              constants.METHOD_SELF_REFLECTION,
-                                                              llm_provider.get_provider_name(),
-                                                              semantic_map_basename,
-                                                              query_id,
-                                                              f"self_reflection_{reflection_iteration_idx}.txt")
-            # Get response
-            if os.path.exists(self_reflection_response_file_path):
-                print(f"Skipping {self_reflection_response_file_path}...")
-                self_reflection_response = text_utils.dict_to_json_str(
-                    file_utils.read_text_from_file(self_reflection_response_file_path))
-            else:
-                self_reflection_response = llm_provider.generate_text(
+            with telemetry.tag_calls(stage=telemetry.STAGE_REFLECT):
+                self_reflection_response = await llm_provider.agenerate_text(
                     self_reflection_conversation_history)
-                file_utils.create_directories_for_file(
-                    self_reflection_response_file_path)
-                file_utils.save_text_to_file(text=self_reflection_response,
-                                             output_path=self_reflection_response_file_path)
-            # Append response (assistant)
-            self_reflection_conversation_history.append_assistant_message(
+            file_utils.create_directories_for_file(
+                self_reflection_response_file_path)
+            file_utils.save_text_to_file(text=self_reflection_response,
+                                         output_path=self_reflection_response_file_path)
+        # Append response (assistant)
+        self_reflection_conversation_history.append_assistant_message(
+            self_reflection_response)
+
+        # The critic is satisfied with the response -> it is not corrected
+        if constants.CONVERGENCE_POLICY is not None:
+            stop_reason = constants.CONVERGENCE_POLICY.check_reflection(
                 self_reflection_response)
+            if stop_reason is not None:
+                break
 
-            ##########################################
-            ################ CORRECT #################
-            ##########################################
-            print("Correcting...")
-            # Append prompt (user)
-            correction_conversation_history.append_user_message(
-                PromptCorrectUser(
-                    plan_response=response_to_be_refined,
-                    self_reflection_response=self_reflection_response).get_prompt_text())
-
-            # Skip if exists
-            correction_response_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
-                                                         mode,
-                                                         constants.METHOD_SELF_REFLECTION,
-                                                         llm_provider.get_provider_name(),
-                                                         semantic_map_basename,
-                                                         query_id,
-                                                         f"plan_{reflection_iteration_idx+1}.json")
-            # Get response
-            if os.path.exists(correction_response_file_path):
-                print(f"Skipping {correction_response_file_path}...")
-                correction_response = text_utils.dict_to_json_str(
-                    file_utils.load_json(correction_response_file_path))
-            else:
-                correction_response = llm_provider.generate_json(
-                    correction_conversation_history)
-                file_utils.create_directories_for_file(
-                    correction_response_file_path)
-                file_utils.save_json_str_to_file(json_str=correction_response,
-                                                 output_path=correction_response_file_path)
-            # Append response (assistant)
-            correction_conversation_history.append_assistant_message(
-                correction_response)
-
-            # New response to be refined
-            response_to_be_refined = correction_response
-
-        # Once reflection iterations finished, new set final plan
-        final_plan_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
-                                            mode,
-                                            constants.METHOD_SELF_REFLECTION,
-                                            llm_provider.get_provider_name(),
-                                            semantic_map_basename,
-                                            query_id,
-                                            f"final_plan.json")
-        file_utils.create_directories_for_file(
-            final_plan_file_path)
-        file_utils.save_json_str_to_file(json_str=correction_response,
-                                         output_path=final_plan_file_path)
-
-
-def plan_multiagent_reflection(mode: str, semantic_map: list, llm_provider: LargeLanguageModel, queries: list, reflection_iterations: int):
+        ##########################################
+        ################ CORRECT #################
+        ##########################################
+        print("Correcting...")
+        # Append prompt (user)
+        correction_conversation_history.append_user_message(
+            PromptCorrectUser(
+                plan_response=response_to_be_refined,
+                self_reflection_response=self_reflection_response).get_prompt_text())
+
+        # Skip if exists
+        correction_response_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
+                                                     mode,
+                                                     constants.get_method_folder(constants.METHOD_SELF_REFLECTION),
+                                                     llm_provider.get_provider_name(),
+                                                     semantic_map_basename,
+                                                     query_id,
+                                                     f"plan_{reflection_iteration_idx+1}.json")
+        # Get response
+        if os.path.exists(correction_response_file_path):
+            print(f"Skipping {correction_response_file_path}...")
+            correction_response = text_utils.dict_to_json_str(
+                file_utils.load_json(correction_response_file_path))
+        else:
+            with telemetry.tag_calls(stage=telemetry.STAGE_CORRECT):
+                correction_response = await llm_provider.agenerate_json(
+                    correction_conversation_history, required_keys=constants.PLAN_KEYS)
+            file_utils.create_directories_for_file(
+                correction_response_file_path)
+            file_utils.save_json_str_to_file(json_str=correction_response,
+                                             output_path=correction_response_file_path)
+        # Append response (assistant)
+        correction_conversation_history.append_assistant_message(
+            correction_response)
+
+        # The correction does not change the response -> no more iterations
+        if constants.CONVERGENCE_POLICY is not None:
+            stop_reason = constants.CONVERGENCE_POLICY.check_correction(
+                response_to_be_refined, correction_response)
+
+        # New response to be refined
+        response_to_be_refined = correction_response
+        if stop_reason is not None:
+            break
+
+    # Once reflection iterations finished, new set final plan
+    final_plan_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
+                                        mode,
+                                        constants.get_method_folder(constants.METHOD_SELF_REFLECTION),
+                                        llm_provider.get_provider_name(),
+                                        semantic_map_basename,
+                                        query_id,
+                                        f"final_plan.json")
+    file_utils.create_directories_for_file(
+        final_plan_file_path)
+    file_utils.save_json_str_to_file(json_str=response_to_be_refined,
+                                     output_path=final_plan_file_path)
+    save_convergence(final_plan_file_path, stop_reason,
+                     reflection_iteration_idx + 1 if reflection_iterations > 0 else 0)
+
+
+async def plan_self_reflection(mode: str, semantic_map: tuple, llm_provider: LargeLanguageModel, queries: list, reflection_iterations: int, max_concurrency: int = 1, max_calls: int = None):
+
+    semantic_map_basename = semantic_map[0]
+
+    await executor.gather_with_concurrency(
+        [plan_query(constants.METHOD_SELF_REFLECTION, mode, semantic_map, llm_provider, query_id, query_text, reflection_iterations)
+         for query_id, query_text in queries],
+        max_concurrency=max_concurrency,
+        max_calls=max_calls,
+        desc=f"Ex. {mode} {constants.METHOD_SELF_REFLECTION} {semantic_map_basename} {llm_provider.get_provider_name()}...",
+        skipped_errors=(ProviderCallError,))
+
+
+async def plan_multiagent_reflection_query(mode: str, semantic_map: tuple, llm_provider: LargeLanguageModel, query_id: str, query_text: str, reflection_iterations: int):
 
     semantic_map_basename = semantic_map[0]
     semantic_map_object = semantic_map[1]
-    semantic_map_object_str = text_utils.dict_to_json_str(semantic_map_object)
+    semantic_map_object_str = get_semantic_map_text(semantic_map_object, query_text)
 
+    # New query -> new conversation histories
     plan_conversation_history = ConversationHistory()
     self_reflection_conversation_history = ConversationHistory()
     correction_conversation_history = ConversationHistory()
 
-    for query_id, query_text in tqdm.tqdm(queries,
-                                          desc=f"Ex. {mode} {constants.METHOD_SELF_REFLECTION} {semantic_map_basename} {llm_provider.get_provider_name()}..."):
-
-        # New query -> empty conversation histories
-        plan_conversation_history.clear()
-        self_reflection_conversation_history.clear()
-        correction_conversation_history.clear()
+    ##########################################
+    ################## PLAN ##################
+    ##########################################
+    print("Planning...")
+    # Append prompt (system), shared by the queries on the map
+    plan_conversation_history.append_system_message(
+        PromptPlanAgent(
+            semantic_map=semantic_map_object_str).get_prompt_text(),
+    )
+    plan_conversation_history.mark_cacheable_prefix()
+    # Append query (user)
+    plan_conversation_history.append_user_message(
+        PromptPlanUser(query=query_text).get_prompt_text()
+    )
+
+    # Skip if exists
+    plan_response_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
+                                           mode,
+                                           constants.get_method_folder(constants.METHOD_MULTIAGENT_REFLECTION),
+                                           llm_provider.get_provider_name(),
+                                           semantic_map_basename,
+                                           query_id,
+                                           "plan_0.json")
+    # Get response
+    if os.path.exists(plan_response_file_path):
+        print(f"Skipping {plan_response_file_path}...")
+        plan_response = text_utils.dict_to_json_str(
+            file_utils.load_json(plan_response_file_path))
+    else:
+        with telemetry.tag_calls(stage=telemetry.STAGE_PLAN):
+            plan_response = await llm_provider.agenerate_json(
+                plan_conversation_history, required_keys=constants.PLAN_KEYS)
+        file_utils.create_directories_for_file(plan_response_file_path)
+        file_utils.save_json_str_to_file(json_str=plan_response,
+                                         output_path=plan_response_file_path)
+    # Append response (assistant)
+    plan_conversation_history.append_assistant_message(plan_response)
+
+    # Initial plan is response to be refined
+    response_to_be_refined = plan_response
+
+    # Set reflection and correction first prompts (system), shared by the queries on the map
+    self_reflection_conversation_history.append_system_message(PromptReflectAgent(
+        semantic_map=semantic_map_object_str).get_prompt_text())
+    self_reflection_conversation_history.mark_cacheable_prefix()
+    correction_conversation_history.append_system_message(PromptCorrectAgent(
+        semantic_map=semantic_map_object_str).get_prompt_text())
+    correction_conversation_history.mark_cacheable_prefix()
+
+    stop_reason = None
+    for reflection_iteration_idx in range(reflection_iterations):
 
         ##########################################
-        ################## PLAN ##################
+        ################ REFLECT #################
         ##########################################
-        print("Planning...")
-        # Append prompt (system)
-        plan_conversation_history.append_system_message(
-            PromptPlanAgent(
-                semantic_map=semantic_map_object_str).get_prompt_text(),
-        )
-        # Append query (user)
-        plan_conversation_history.append_user_message(
-            PromptPlanUser(query=query_text).get_prompt_text()
+        print("Reflecting...")
+        # Append query and plan (user)
+        self_reflection_conversation_history.append_user_message(
+            PromptReflectUser(
+                query=query_text,
+                plan_response=response_to_be_refined).get_prompt_text(),
         )
 
         # Skip if exists
-        plan_response_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
-                                               mode,
-                                               constants.METHOD_MULTIAGENT_REFLECTION,
-                                               llm_provider.get_provider_name(),
-                                               semantic_map_basename,
-                                               query_id,
-                                               "plan_0.json")
+        self_reflection_response_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
+                                                          mode,
+                                                          constants.get_method_folder(constants.METHOD_MULTIAGENT_REFLECTION),
+                                                          llm_provider.get_provider_name(),
+                                                          semantic_map_basename,
+                                                          query_id,
+                                                          f"reflection_{reflection_iteration_idx}.txt")
         # Get response
-        if os.path.exists(plan_response_file_path):
-            print(f"Skipping {plan_response_file_path}...")
-            plan_response = text_utils.dict_to_json_str(
-                file_utils.load_json(plan_response_file_path))
+        if os.path.exists(self_reflection_response_file_path):
+            print(f"Skipping {self_reflection_response_file_path}...")
+            self_reflection_response = text_utils.dict_to_json_str(
+                file_utils.read_text_from_file(self_reflection_response_file_path))
         else:
-            plan_response = llm_provider.generate_json(
-                plan_conversation_history)
-            file_utils.create_directories_for_file(plan_response_file_path)
-            file_utils.save_json_str_to_file(json_str=plan_response,
-                                             output_path=plan_response_file_path)
-        # Append response (assistant)
-        plan_conversation_history.append_assistant_message(plan_response)
-
-        # Initial plan is response to be refined
-        response_to_be_refined = plan_response
-
-        # Set reflection and correction first prompts (system)
-        self_reflection_conversation_history.append_system_message(PromptReflectAgent(
-            semantic_map=semantic_map_object_str).get_prompt_text())
-        correction_conversation_history.append_system_message(PromptCorrectAgent(
-            semantic_map=semantic_map_object_str).get_prompt_text())
-
-        for reflection_iteration_idx in range(reflection_iterations):
-
-            ##########################################
-            ################ REFLECT #################
-            ##########################################
-            print("Reflecting...")
-            # Append query and plan (user)
-            self_reflection_conversation_history.append_user_message(
-                PromptReflectUser(
-                    query=query_text,
-                    plan_response=response_to_be_refined).get_prompt_text(),
-            )
-
-            # Skip if exists
-            self_reflection_response_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
-                                                              mode,
-                                                              constants.METHOD_MULTIAGENT_REFLECTION,
-                                                              llm_provider.get_provider_name(),
-                                                              semantic_map_basename,
-                                                              query_id,
-                                                              f"reflection_{reflection_iteration_idx}.txt")
-            # Get response
-            if os.path.exists(self_reflection_response_file_path):
-                print(f"Skipping {self_reflection_response_file_path}...")
-                self_reflection_response = text_utils.dict_to_json_str(
-                    file_utils.read_text_from_file(self_reflection_response_file_path))
-            else:
-                self_reflection_response = llm_provider.generate_text(
+            with telemetry.tag_calls(stage=telemetry.STAGE_REFLECT):
+                self_reflection_response = await llm_provider.agenerate_text(
                     self_reflection_conversation_history)
-                file_utils.create_directories_for_file(
-                    self_reflection_response_file_path)
-                file_utils.save_text_to_file(text=self_reflection_response,
-                                             output_path=self_reflection_response_file_path)
-            # Append response (assistant)
-            self_reflection_conversation_history.append_assistant_message(
+            file_utils.create_directories_for_file(
+                self_reflection_response_file_path)
+            file_utils.save_text_to_file(text=self_reflection_response,
+                                         output_path=self_reflection_response_file_path)
+        # Append response (assistant)
+        self_reflection_conversation_history.append_assistant_message(
+            self_reflection_response)
+
+        # The critic is satisfied with the response -> it is not corrected
+        if constants.CONVERGENCE_POLICY is not None:
+            stop_reason = constants.CONVERGENCE_POLICY.check_reflection(
                 self_reflection_response)
+            if stop_reason is not None:
+                break
 
-            ##########################################
-            ################ CORRECT #################
-            ##########################################
-            print("Correcting...")
-            # Append prompt (user)
-            correction_conversation_history.append_user_message(
-                PromptCorrectUser(
-                    plan_response=response_to_be_refined,
-                    self_reflection_response=self_reflection_response).get_prompt_text())
-
-            # Skip if exists
-            correction_response_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
-                                                         mode,
-                                                         constants.METHOD_MULTIAGENT_REFLECTION,
-                                                         llm_provider.get_provider_name(),
-                                                         semantic_map_basename,
-                                                         query_id,
-                                                         f"plan_{reflection_iteration_idx+1}.json")
-            if os.path.exists(correction_response_file_path):
-                print(f"Skipping {correction_response_file_path}...")
-                correction_response = text_utils.dict_to_json_str(
-                    file_utils.load_json(correction_response_file_path))
-            else:
-                # Get response
-                correction_response = llm_provider.generate_json(
-                    correction_conversation_history)
-                file_utils.create_directories_for_file(
-                    correction_response_file_path)
-                file_utils.save_json_str_to_file(json_str=correction_response,
-                                                 output_path=correction_response_file_path)
-            # Append response (assistant)
-            correction_conversation_history.append_assistant_message(
-                correction_response)
-
-            # New response to be refined
-            response_to_be_refined = correction_response
-
-        # Once reflection iterations finished, new set final plan
-        final_plan_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
-                                            mode,
-                                            constants.METHOD_SELF_REFLECTION,
-                                            llm_provider.get_provider_name(),
-                                            semantic_map_basename,
-                                            query_id,
-                                            f"final_plan.json")
-        file_utils.create_directories_for_file(
-            final_plan_file_path)
-        file_utils.save_json_str_to_file(json_str=correction_response,
-                                         output_path=final_plan_file_path)
-
-
-def plan_ensembling(mode: str, semantic_map, chooser_llm_provider: LargeLanguageModel, queries: list):
+        ##########################################
+        ################ CORRECT #################
+        ##########################################
+        print("Correcting...")
+        # Append prompt (user)
+        correction_conversation_history.append_user_message(
+            PromptCorrectUser(
+                plan_response=response_to_be_refined,
+                self_reflection_response=self_reflection_response).get_prompt_text())
 
-    semantic_map_basename = semantic_map[0]
-    semantic_map_object = semantic_map[1]
-    semantic_map_object_str = text_utils.dict_to_json_str(semantic_map_object)
+        # Skip if exists
+        correction_response_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
+                                                     mode,
+                                                     constants.get_method_folder(constants.METHOD_MULTIAGENT_REFLECTION),
+                                                     llm_provider.get_provider_name(),
+                                                     semantic_map_basename,
+                                                     query_id,
+                                                     f"plan_{reflection_iteration_idx+1}.json")
+        if os.path.exists(correction_response_file_path):
+            print(f"Skipping {correction_response_file_path}...")
+            correction_response = text_utils.dict_to_json_str(
+                file_utils.load_json(correction_response_file_path))
+        else:
+            # Get response
+            with telemetry.tag_calls(stage=telemetry.STAGE_CORRECT):
+                correction_response = await llm_provider.agenerate_json(
+                    correction_conversation_history, required_keys=constants.PLAN_KEYS)
+            file_utils.create_directories_for_file(
+                correction_response_file_path)
+            file_utils.save_json_str_to_file(json_str=correction_response,
+                                             output_path=correction_response_file_path)
+        # Append response (assistant)
+        correction_conversation_history.append_assistant_message(
+            correction_response)
 
-    for query_id, query_text in tqdm.tqdm(queries,
-                                          desc=f"Ex. {mode} {constants.METHOD_SELF_REFLECTION} {semantic_map_basename} {chooser_llm_provider.get_provider_name()}..."):
+        # The correction does not change the response -> no more iterations
+        if constants.CONVERGENCE_POLICY is not None:
+            stop_reason = constants.CONVERGENCE_POLICY.check_correction(
+                response_to_be_refined, correction_response)
 
-        plan_responses = list()
+        # New response to be refined
+        response_to_be_refined = correction_response
+        if stop_reason is not None:
+            break
 
-        # Create N LLMs
-        planner_llms = [chooser_llm_provider] * 6
-        planner_llms_labels = [f"{llm_provider.get_provider_name(
-        )}_{llm_index}" for llm_index, llm_provider in enumerate(planner_llms)]
+    # Once reflection iterations finished, new set final plan
+    final_plan_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
+                                        mode,
+                                        constants.get_method_folder(constants.METHOD_MULTIAGENT_REFLECTION),
+                                        llm_provider.get_provider_name(),
+                                        semantic_map_basename,
+                                        query_id,
+                                        f"final_plan.json")
+    file_utils.create_directories_for_file(
+        final_plan_file_path)
+    file_utils.save_json_str_to_file(json_str=response_to_be_refined,
+                                     output_path=final_plan_file_path)
+    save_convergence(final_plan_file_path, stop_reason,
+                     reflection_iteration_idx + 1 if reflection_iterations > 0 else 0)
 
-        # Unique conversation history
-        conversation_history = ConversationHistory()
 
-        for llm_label, llm_provider in zip(planner_llms_labels, planner_llms):
+async def plan_multiagent_reflection(mode: str, semantic_map: tuple, llm_provider: LargeLanguageModel, queries: list, reflection_iterations: int, max_concurrency: int = 1, max_calls: int = None):
 
-            ##########################################
-            ################## PLAN ##################
-            ##########################################
-            print(f"Planning {llm_label}...")
-            conversation_history.clear()
-            # Append prompt (user)
-            conversation_history.append_user_message(
-                PromptPlan(
-                    semantic_map=semantic_map_object_str,
-                    query=query_text).get_prompt_text())
+    semantic_map_basename = semantic_map[0]
 
-            # Get response
-            plan_response_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
-                                                   mode,
-                                                   constants.METHOD_ENSEMBLE,
-                                                   chooser_llm_provider.get_provider_name(),
-                                                   semantic_map_basename,
-                                                   query_id,
-                                                   f"plan_{llm_label}.json")
-            # Skip if exists
-            if os.path.exists(plan_response_file_path):
-                print(f"Skipping {plan_response_file_path}...")
-                # Load response
-                plan_response = text_utils.dict_to_json_str(
-                    file_utils.load_json(plan_response_file_path))
-            else:
-                # Get response
-                plan_response = llm_provider.generate_json(
-                    conversation_history)
-                # Save response
-                file_utils.create_directories_for_file(
-                    plan_response_file_path)
-                file_utils.save_json_str_to_file(json_str=plan_response,
-                                                 output_path=plan_response_file_path)
-
-            plan_responses.append(plan_response)
+    await executor.gather_with_concurrency(
+        [plan_query(constants.METHOD_MULTIAGENT_REFLECTION, mode, semantic_map, llm_provider, query_id, query_text, reflection_iterations)
+         for query_id, query_text in queries],
+        max_concurrency=max_concurrency,
+        max_calls=max_calls,
+        desc=f"Ex. {mode} {constants.METHOD_MULTIAGENT_REFLECTION} {semantic_map_basename} {llm_provider.get_provider_name()}...",
+        skipped_errors=(ProviderCallError,))
 
-        ##########################################
-        ################# CHOOSE #################
-        ##########################################
+
+async def plan_ensembling_planners(mode: str, semantic_map: tuple, chooser_llm_provider: LargeLanguageModel, llm_indices: list, query_id: str, query_text: str, get_n_kept_plans: Callable[[list], int] = None) -> list:
+    # get_n_kept_plans: if given, returns how many of the plans (the first ones) are
+    # kept, the rest are neither saved nor returned
+
+    semantic_map_basename = semantic_map[0]
+    semantic_map_object = semantic_map[1]
+    semantic_map_object_str = get_semantic_map_text(semantic_map_object, query_text)
+
+    # The planners are samples of the chooser LLM
+    llm_labels = {llm_index: f"{chooser_llm_provider.get_provider_name()}_{llm_index}"
+                  for llm_index in llm_indices}
+
+    ##########################################
+    ################## PLAN ##################
+    ##########################################
+    # Same conversation for every planner
+    conversation_history = ConversationHistory()
+    # Append prompt (user)
+    prompt_plan = PromptPlan(
+        semantic_map=semantic_map_object_str,
+        query=query_text)
+    prompt_plan_text = prompt_plan.get_prompt_text()
+    conversation_history.append_user_message(prompt_plan_text)
+    conversation_history.mark_cacheable_prefix(
+        prompt_plan.get_cacheable_prefix_length(prompt_plan_text))
+
+    plan_response_file_paths = {llm_index: os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
+                                                        mode,
+                                                        constants.get_method_folder(constants.METHOD_ENSEMBLE),
+                                                        chooser_llm_provider.get_provider_name(),
+                                                        semantic_map_basename,
+                                                        query_id,
+                                                        f"plan_{llm_labels[llm_index]}.json")
+                                for llm_index in llm_indices}
+    plan_responses = dict()
+    for llm_index, plan_response_file_path in plan_response_file_paths.items():
+        # Skip if exists
+        if os.path.exists(plan_response_file_path):
+            print(f"Skipping {plan_response_file_path}...")
+            # Load response
+            plan_response = text_utils.dict_to_json_str(
+                file_utils.load_json(plan_response_file_path))
+            plan_responses[llm_index] = plan_response
+
+    async def plan_samples(sample_indices: list):
+        print(f"Planning {', '.join(llm_labels[llm_index] for llm_index in sample_indices)}...")
+        # Get responses
+        # Same prompt for every planner -> sampled in as few calls as the LLM allows,
+        # the sample index tells their responses apart
+        with telemetry.tag_calls(stage=telemetry.STAGE_PLAN):
+            sampled_plan_responses = await chooser_llm_provider.agenerate_json_samples(
+                conversation_history, len(sample_indices), first_sample_index=sample_indices[0],
+                required_keys=constants.PLAN_KEYS)
+        new_plan_responses.update(zip(sample_indices, sampled_plan_responses))
+
+    async def plan_shared(llm_index: int):
+        print(f"Planning {llm_labels[llm_index]}...")
+        new_plan_responses[llm_index] = await generate_first_plan(chooser_llm_provider, conversation_history)
+
+    # Missing plans, sampled by runs of consecutive sample indices (a single run unless
+    # some plans were already saved). The first plan is shared with the other workflows,
+    # if plan sharing is enabled
+    missing_llm_indices = [llm_index for llm_index in llm_indices
+                           if llm_index not in plan_responses]
+    shared_llm_indices = [llm_index for llm_index in missing_llm_indices
+                          if constants.PLAN_STORE is not None and llm_index == PlanStore.SAMPLE_INDEX]
+    missing_llm_indices = [llm_index for llm_index in missing_llm_indices
+                           if llm_index not in shared_llm_indices]
+    new_plan_responses = dict()
+    await asyncio.gather(*[plan_shared(llm_index) for llm_index in shared_llm_indices],
+                         *[plan_samples([llm_index for _, llm_index in run])
+                           for _, run in itertools.groupby(enumerate(missing_llm_indices),
+                                                           key=lambda item: item[1] - item[0])])
+    plan_responses |= new_plan_responses
+
+    if get_n_kept_plans is not None:
+        llm_indices = llm_indices[:get_n_kept_plans([plan_responses[llm_index] for llm_index in llm_indices])]
+
+    # Save responses
+    for llm_index in llm_indices:
+        if llm_index in new_plan_responses:
+            file_utils.create_directories_for_file(
+                plan_response_file_paths[llm_index])
+            file_utils.save_json_str_to_file(json_str=new_plan_responses[llm_index],
+                                             output_path=plan_response_file_paths[llm_index])
+
+    return [plan_responses[llm_index] for llm_index in llm_indices]
+
+
+async def plan_ensembling_query(mode: str, semantic_map: tuple, chooser_llm_provider: LargeLanguageModel, query_id: str, query_text: str):
+
+    semantic_map_basename = semantic_map[0]
+    semantic_map_object = semantic_map[1]
+
+    # Plans are independent -> all planners are sampled at once (or the first ones, if
+    # sampled adaptively), the chooser starts as soon as the plans are sampled
+    adaptive_ensemble = constants.ADAPTIVE_ENSEMBLE
+    n_samples = constants.ENSEMBLE_SIZE if adaptive_ensemble is None else adaptive_ensemble.min_samples
+    plan_responses = await plan_ensembling_planners(mode, semantic_map, chooser_llm_provider,
+                                                    list(range(n_samples)), query_id, query_text)
+    if adaptive_ensemble is not None and chooser_llm_provider.MAX_SAMPLES_PER_CALL > 1:
+        # Every missing plan in a single call (the map is sent once), only the plans
+        # needed to agree are kept
+        if adaptive_ensemble.needs_more_samples(plan_responses):
+            extra_plan_responses = await plan_ensembling_planners(
+                mode, semantic_map, chooser_llm_provider,
+                list(range(len(plan_responses), adaptive_ensemble.max_samples)), query_id, query_text,
+                get_n_kept_plans=lambda extra_plan_responses: adaptive_ensemble.get_n_samples(
+                    plan_responses + extra_plan_responses) - len(plan_responses))
+            plan_responses += extra_plan_responses
+    # One more plan at a time until the plans agree
+    while adaptive_ensemble is not None and adaptive_ensemble.needs_more_samples(plan_responses):
+        plan_responses += await plan_ensembling_planners(mode, semantic_map, chooser_llm_provider,
+                                                         [len(plan_responses)], query_id, query_text)
+
+    ##########################################
+    ################# CHOOSE #################
+    ##########################################
+    if constants.ENSEMBLE_AGGREGATOR == ensemble.AGGREGATOR_CHOOSER:
         print("Choosing...")
-        conversation_history.clear()
-
-        choice_response_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
-                                                 mode,
-                                                 constants.METHOD_ENSEMBLE,
-                                                 chooser_llm_provider.get_provider_name(),
-                                                 semantic_map_basename,
-                                                 str(query_id),
-                                                 f"choice_{len(planner_llms)}.json")
+    else:
+        print(f"Aggregating ({constants.ENSEMBLE_AGGREGATOR})...")
+
+    choice_response_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
+                                             mode,
+                                             constants.get_method_folder(constants.METHOD_ENSEMBLE),
+                                             chooser_llm_provider.get_provider_name(),
+                                             semantic_map_basename,
+                                             str(query_id),
+                                             f"choice_{len(plan_responses)}.json")
+
+    # Every plan agrees -> nothing to choose
+    unanimous_choice = adaptive_ensemble.get_unanimous_choice(
+        plan_responses) if adaptive_ensemble is not None else None
+
+    if constants.ENSEMBLE_AGGREGATOR != ensemble.AGGREGATOR_CHOOSER:
+        # Local aggregation of the plans instead of the chooser
+        file_utils.save_dict_to_json_file(ensemble.aggregate_plans(plan_responses, constants.ENSEMBLE_AGGREGATOR),
+                                          os.path.join(os.path.dirname(choice_response_file_path),
+                                                       ensemble.get_aggregate_file_name(constants.ENSEMBLE_AGGREGATOR)))
+    elif os.path.exists(choice_response_file_path):
+        print(f"Skipping {choice_response_file_path}...")
+    elif unanimous_choice is not None:
+        file_utils.save_dict_to_json_file({"chosen_response": unanimous_choice,
+                                           "explaination": f"Every one of the {len(plan_responses)} responses has the same relevant objects, the chooser was not called."},
+                                          choice_response_file_path)
+    else:
+        conversation_history = ConversationHistory()
         # Append prompt (system)
         conversation_history.append_system_message(
             ChooserPrompt(llm_responses=plan_responses,
-                          semantic_map=semantic_map_object_str,
+                          semantic_map=get_semantic_map_text(semantic_map_object, query_text),
                           query=query_text).get_prompt_text())
-
-        if os.path.exists(choice_response_file_path):
-            print(f"Skipping {plan_response_file_path}...")
-        else:
-            # Get response
-            choice_response = chooser_llm_provider.generate_json(
+        # Get response
+        with telemetry.tag_calls(stage=telemetry.STAGE_CHOOSE):
+            choice_response = await chooser_llm_provider.agenerate_json(
                 conversation_history)
-            # Save response
-            file_utils.save_json_str_to_file(json_str=choice_response,
-                                             output_path=choice_response_file_path)
+        # Save response
+        file_utils.save_json_str_to_file(json_str=choice_response,
+                                         output_path=choice_response_file_path)
 
+    # Log the plans sampled and whether the chooser was skipped
+    if adaptive_ensemble is not None:
+        chooser_skipped = unanimous_choice is not None or constants.ENSEMBLE_AGGREGATOR != ensemble.AGGREGATOR_CHOOSER
+        adaptive_ensemble.record_query(len(plan_responses), chooser_skipped)
+        print(f"Ensemble of {query_id} on {semantic_map_basename}: {len(plan_responses)} plans sampled, "
+              f"chooser {'skipped' if chooser_skipped else 'called'}")
+        file_utils.save_dict_to_json_file({"samples": len(plan_responses),
+                                           "agreement": ensemble.get_agreement(plan_responses)[0],
+                                           "chooser_skipped": chooser_skipped},
+                                          os.path.join(os.path.dirname(choice_response_file_path), "ensemble.json"))
 
-def print_time_statistics(start_time: float, end_time: float, method: str, number_queries: int, reflection_iterations: int):
 
-    execution_time = end_time - start_time
-    number_llm_calls = 0
+async def plan_ensembling(mode: str, semantic_map: tuple, chooser_llm_provider: LargeLanguageModel, queries: list, max_concurrency: int = 1, max_calls: int = None):
 
-    if method == constants.METHOD_BASE:
-        number_llm_calls = number_queries
-    elif method == constants.METHOD_SELF_REFLECTION:
-        number_llm_calls = number_queries * (1 + 2 * reflection_iterations)
-    elif method == constants.METHOD_MULTIAGENT_REFLECTION:
-        number_llm_calls = number_queries * (1 + 2 * reflection_iterations)
-    elif method == constants.METHOD_ENSEMBLE:
-        number_llm_calls = number_queries * 7
+    semantic_map_basename = semantic_map[0]
 
-    print(f"Evaluation took {execution_time} s")
-    print(f"During evaluation {number_llm_calls} calls were executed, {
-          execution_time/number_llm_calls} s/call")
+    await executor.gather_with_concurrency(
+        [plan_query(constants.METHOD_ENSEMBLE, mode, semantic_map, chooser_llm_provider, query_id, query_text, 0)
+         for query_id, query_text in queries],
+        max_concurrency=max_concurrency,
+        max_calls=max_calls,
+        desc=f"Ex. {mode} {constants.METHOD_ENSEMBLE} {semantic_map_basename} {chooser_llm_provider.get_provider_name()}...",
+        skipped_errors=(ProviderCallError,))
 
 
-def main(args):
-    # Load llm
-    llm_provider = None
-    if args.llm == constants.LLM_GEMINI_1_0_PRO:
-        llm_provider = constants.GEMINI_1_0_PRO
-    elif args.llm == constants.LLM_GEMINI_1_5_PRO:
-        llm_provider = constants.GEMINI_1_5_PRO
+def get_llm_provider(llm: str) -> LargeLanguageModel:
+    return constants.LLM_REGISTRY.get(llm)
 
-    # Load and pre-process semantic map
+
+def load_semantic_maps() -> list:
     semantic_maps = list()
-    for semantic_map_file in os.listdir(constants.SEMANTIC_MAPS_FOLDER_PATH):
+    for semantic_map_file in sorted(os.listdir(constants.SEMANTIC_MAPS_FOLDER_PATH)):
 
         semantic_map_basename = file_utils.get_file_basename(semantic_map_file)
 
@@ -488,41 +787,259 @@ def main(args):
                                                              semantic_map_file))
 
         semantic_maps.append((semantic_map_basename, semantic_map_obj))
+    return semantic_maps
+
 
-    # Load queries
+def load_queries() -> list:
     queries = list()
     queries_dict = file_utils.load_yaml(constants.QUERIES_FILE_PATH)
     for query_id in queries_dict["queries"]:
         queries.append((query_id, queries_dict["queries"][query_id]))
+    return queries
+
+
+def create_response_cache(cache_dir: str, max_entries: int) -> ResponseCache:
+    if cache_dir is None:
+        return None
+    return ResponseCache(DiskCacheBackend(cache_dir), max_entries=max_entries)
+
+
+def print_cache_statistics(response_cache: ResponseCache):
+    if response_cache is None:
+        return
+    statistics = response_cache.get_statistics()
+    print(f"Response cache: {statistics['hits']} hits, {statistics['misses']} misses "
+          f"({100 * statistics['hit_rate']:.1f}% hit rate), "
+          f"{statistics['evictions']} evictions, {statistics['entries']} entries")
+
+
+def create_telemetry(telemetry_file: str) -> telemetry.Telemetry:
+    # One file per run by default
+    if telemetry_file is None:
+        telemetry_file = os.path.join(constants.TELEMETRY_FOLDER_PATH,
+                                      f"{time.strftime('%Y%m%d_%H%M%S')}.jsonl")
+    print(f"Writing telemetry of the LLM calls to {telemetry_file}")
+    return telemetry.Telemetry(telemetry_file)
+
+
+def create_tracer(trace_file: str) -> tracing.Tracer:
+    # Tracing is only enabled if a trace file is given
+    if trace_file is None:
+        return None
+    tracer = tracing.Tracer()
+    tracing.set_tracer(tracer)
+    return tracer
+
+
+def export_trace(tracer: tracing.Tracer, trace_file: str):
+    if tracer is None:
+        return
+    tracer.export(trace_file)
+    print(f"Trace written to {trace_file} (open it in chrome://tracing or https://ui.perfetto.dev)")
+
+
+def print_llm_statistics(llm_provider: LargeLanguageModel):
+    statistics = llm_provider.get_statistics()
+    if len(statistics) == 0:
+        return
+    print(f"{llm_provider.get_provider_name()} statistics: " +
+          ", ".join(f"{key}={value:.4g}" if isinstance(value, float) else f"{key}={value}"
+                    for key, value in statistics.items()))
+
+
+def print_pruning_statistics():
+    if constants.MAP_PRUNER is None:
+        return
+    statistics = constants.MAP_PRUNER.get_statistics()
+    print(f"Map pruning: {statistics['kept_objects']}/{statistics['objects']} objects kept in "
+          f"{statistics['queries']} queries ({100 * statistics['reduction_ratio']:.1f}% reduction), "
+          f"{statistics['fallbacks']} fallbacks to the whole map")
+
+
+def print_convergence_statistics():
+    if constants.CONVERGENCE_POLICY is None:
+        return
+    statistics = constants.CONVERGENCE_POLICY.get_statistics()
+    print(f"Early exit: {statistics['queries']} queries, {statistics['mean_iterations']:.2f} reflection iterations per query, "
+          f"stopped by score {statistics['stop_score']}, by fixpoint {statistics['stop_fixpoint']}, "
+          f"after every iteration {statistics['stop_iterations']}")
+
+
+def print_ensemble_statistics():
+    if constants.ADAPTIVE_ENSEMBLE is None:
+        return
+    statistics = constants.ADAPTIVE_ENSEMBLE.get_statistics()
+    print(f"Adaptive ensemble: {statistics['queries']} queries, {statistics['mean_samples']:.2f} plans sampled per query, "
+          f"chooser skipped in {100 * statistics['chooser_skip_rate']:.1f}% of the queries")
+
+
+def print_plan_sharing_statistics():
+    if constants.PLAN_STORE is None:
+        return
+    statistics = constants.PLAN_STORE.get_statistics()
+    print(f"Plan sharing: {statistics['generated']} first plans generated, "
+          f"{statistics['reused']} reused ({statistics['reuse_rate']:.1%})")
+
+
+def save_run_metadata(mode: str, method: str, llm_provider: LargeLanguageModel):
+    """
+    Saves the metadata of a run of a workflow in its results folder
+    ("run_metadata.json"): whether its first plans were shared with other workflows, and
+    how many were reused. Only saved if plan sharing is enabled and the run planned
+    queries (not only skipped them).
+    """
+    if constants.PLAN_STORE is None:
+        return
+    shared_plans_statistics = constants.PLAN_STORE.get_statistics(mode=mode,
+                                                                  workflow=method,
+                                                                  provider=llm_provider.get_provider_name())
+    if shared_plans_statistics["generated"] + shared_plans_statistics["reused"] == 0:
+        return
+    run_metadata_file_path = os.path.join(constants.LLM_RESULTS_FOLDER_PATH,
+                                          mode,
+                                          constants.get_method_folder(method),
+                                          llm_provider.get_provider_name(),
+                                          "run_metadata.json")
+    file_utils.create_directories_for_file(run_metadata_file_path)
+    file_utils.save_dict_to_json_file({"timestamp": time.time(),
+                                       "plan_sharing": True,
+                                       "shared_plans_folder": constants.PLAN_STORE.folder_path,
+                                       "shared_plans": shared_plans_statistics},
+                                      run_metadata_file_path)
+
+
+def get_max_workers(max_concurrency: int, methods: list, max_calls: int = None) -> int:
+    # Pipelined queries never have more calls in flight than call slots
+    if max_calls is not None:
+        return max_calls
+    # Every ensemble query dispatches all its planners at once
+    if constants.METHOD_ENSEMBLE in methods:
+        return max_concurrency * constants.ENSEMBLE_SIZE
+    return max_concurrency
+
+
+def plan_query(method: str, mode: str, semantic_map: tuple, llm_provider: LargeLanguageModel, query_id: str, query_text: str, reflection_iterations: int):
+    """
+    Creates the coroutine that executes a single query of a workflow. Every LLM call of
+    the query is tagged with the workflow, mode, semantic map and query in the telemetry.
+
+    Args:
+        method (str): Agentic workflow to be executed.
+        mode (str): Semantic maps input mode (with uncertainty or not).
+        semantic_map (tuple): Pre-processed semantic map (basename, object).
+        llm_provider (LargeLanguageModel): LLM used in the workflow (chooser LLM in ensembling).
+        query_id (str): Identifier of the query.
+        query_text (str): Natural language query.
+        reflection_iterations (int): Number of reflection iterations (reflection workflows only).
+
+    Returns:
+        Coroutine: The coroutine that plans the query when awaited.
+    """
+    if method == constants.METHOD_BASE:
+        coroutine = plan_base_query(mode, semantic_map, llm_provider, query_id, query_text)
+    elif method == constants.METHOD_SELF_REFLECTION:
+        coroutine = plan_self_reflection_query(mode, semantic_map, llm_provider, query_id, query_text, reflection_iterations)
+    elif method == constants.METHOD_MULTIAGENT_REFLECTION:
+        coroutine = plan_multiagent_reflection_query(mode, semantic_map, llm_provider, query_id, query_text, reflection_iterations)
+    elif method == constants.METHOD_ENSEMBLE:
+        coroutine = plan_ensembling_query(mode, semantic_map, llm_provider, query_id, query_text)
+    else:
+        raise ValueError(f"Method {method} not known")
+    return telemetry.tagged(coroutine,
+                            workflow=method,
+                            mode=mode,
+                            map=semantic_map[0],
+                            query=query_id)
+
+
+def plan_queries(method: str, mode: str, semantic_map: tuple, llm_provider: LargeLanguageModel, queries: list, reflection_iterations: int, batch_size: int = 1) -> list:
+    """
+    Creates the coroutines that execute the queries of a workflow on a semantic map: one
+    per query (see `plan_query`), or one per batch of queries in the base workflow if
+    `batch_size` is greater than 1 (see `plan_base_batches`).
+
+    Returns:
+        list: The coroutines.
+    """
+    if method == constants.METHOD_BASE and batch_size > 1:
+        return plan_base_batches(mode, semantic_map, llm_provider, queries, batch_size)
+    return [plan_query(method, mode, semantic_map, llm_provider, query_id, query_text, reflection_iterations)
+            for query_id, query_text in queries]
+
+
+def plan_semantic_map(args, s_m_b: str, s_m_o: dict, llm_provider: LargeLanguageModel, queries: list):
+    start_time = time.time()
+    # Pre-process semantic map
+    pre_processed_semantic_map = (s_m_b, preprocess.preprocess_semantic_map(s_m_o,
+                                                                            class_uncertainty=(args.mode == constants.MODE_UNCERTAINTY)))
+    # Size of the semantic map in the prompts, in every encoding
+    map_tokens = serialization.count_tokens_by_encoding(pre_processed_semantic_map[1],
+                                                        llm_provider.count_tokens)
+    print(f"Semantic map {s_m_b} ({constants.MAP_ENCODING} encoding): " +
+          ", ".join(f"{tokens} tokens in {encoding}" for encoding, tokens in map_tokens.items()))
+
+    # Plan actions for every method
+    if args.method == constants.METHOD_BASE:
+        workflow = plan_base(args.mode, pre_processed_semantic_map,
+                             llm_provider, queries, args.max_concurrency, args.batch_size, args.max_calls)
+    elif args.method == constants.METHOD_SELF_REFLECTION:
+        workflow = plan_self_reflection(
+            args.mode, pre_processed_semantic_map, llm_provider, queries, args.reflection_iterations, args.max_concurrency, args.max_calls)
+    elif args.method == constants.METHOD_MULTIAGENT_REFLECTION:
+        workflow = plan_multiagent_reflection(
+            args.mode, pre_processed_semantic_map, llm_provider, queries, args.reflection_iterations, args.max_concurrency, args.max_calls)
+    elif args.method == constants.METHOD_ENSEMBLE:
+        workflow = plan_ensembling(args.mode, pre_processed_semantic_map,
+                                   llm_provider, queries, args.max_concurrency, args.max_calls)
+
+    executor.run(workflow, max_workers=get_max_workers(
+        args.max_concurrency, [args.method], args.max_calls))
+
+    end_time = time.time()
+
+    print(f"Semantic map {s_m_b} took {end_time - start_time} s")
+
+
+def main(args):
+    constants.set_map_encoding(args.map_encoding)
+    constants.set_map_pruning(args.prune_maps)
+    constants.set_convergence_policy(args.early_exit, args.convergence_score)
+    constants.set_adaptive_ensemble(args.adaptive_ensemble, args.agreement_threshold, args.min_samples)
+    constants.set_ensemble_aggregator(args.aggregator)
+    constants.set_plan_sharing(args.share_plans)
+    # Load llm
+    llm_provider = get_llm_provider(args.llm)
+    response_cache = create_response_cache(args.cache_dir,
+                                           args.cache_max_entries)
+    llm_provider.set_response_cache(response_cache)
+    llm_provider.set_streaming(args.streaming)
+    llm_provider.set_context_caching(args.context_caching)
+    run_telemetry = create_telemetry(args.telemetry_file)
+    llm_provider.set_telemetry(run_telemetry)
+    tracer = create_tracer(args.trace_file)
+
+    # Load semantic maps and queries
+    semantic_maps = load_semantic_maps()
+    queries = load_queries()
 
     # MAIN LOOP
-    for (s_m_b, s_m_o) in semantic_maps[:args.number_maps]:
-
-        start_time = time.time()
-        # Pre-process semantic map
-        pre_processed_semantic_map = (s_m_b, preprocess.preprocess_semantic_map(s_m_o,
-                                                                                class_uncertainty=(args.mode == constants.MODE_UNCERTAINTY)))
-
-        # Plan actions for every method
-        if args.method == constants.METHOD_BASE:
-            plan_base(args.mode, pre_processed_semantic_map,
-                      llm_provider, queries)
-        elif args.method == constants.METHOD_SELF_REFLECTION:
-            plan_self_reflection(
-                args.mode, pre_processed_semantic_map, llm_provider, queries, args.reflection_iterations)
-        elif args.method == constants.METHOD_MULTIAGENT_REFLECTION:
-            plan_multiagent_reflection(
-                args.mode, pre_processed_semantic_map, llm_provider, queries, args.reflection_iterations)
-        elif args.method == constants.METHOD_ENSEMBLE:
-            plan_ensembling(args.mode, pre_processed_semantic_map,
-                            llm_provider, queries)
-
-        end_time = time.time()
-
-        print_time_statistics(start_time, end_time,
-                              number_queries=len(queries),
-                              method=args.method,
-                              reflection_iterations=args.reflection_iterations)
+    with tracing.span("run", "run", method=args.method, llm=args.llm, mode=args.mode):
+        for (s_m_b, s_m_o) in semantic_maps[:args.number_maps]:
+            with tracing.span(s_m_b, "map"):
+                plan_semantic_map(args, s_m_b, s_m_o, llm_provider, queries)
+            # The prefixes with this semantic map are not sent again
+            llm_provider.clear_context_caches()
+
+    export_trace(tracer, args.trace_file)
+    save_run_metadata(args.mode, args.method, llm_provider)
+    run_telemetry.print_summary()
+    run_telemetry.print_summary(group_keys=("workflow", "map"))
+    print_cache_statistics(response_cache)
+    print_pruning_statistics()
+    print_convergence_statistics()
+    print_ensemble_statistics()
+    print_plan_sharing_statistics()
+    print_llm_statistics(llm_provider)
 
 
 if __name__ == "__main__":
@@ -552,7 +1069,7 @@ if __name__ == "__main__":
     parser.add_argument("-l", "--llm",
                         type=str,
                         help="Which LLM to use in the workflow?",
-                        choices=[constants.LLM_GEMINI_1_0_PRO, constants.LLM_GEMINI_1_5_PRO])
+                        choices=constants.LLM_REGISTRY.get_constants())
 
     # only for METHODs self_reflection and multiagent_reflection
     parser.add_argument("-i", "--reflection-iterations",
@@ -560,6 +1077,94 @@ if __name__ == "__main__":
                         type=int,
                         default=2)
 
+    parser.add_argument("-c", "--max-concurrency",
+                        help="Maximum number of queries processed concurrently. Calls are network-bound, so values higher than 1 reduce wall-clock time at the cost of hitting the provider quota faster.",
+                        type=int,
+                        default=1)
+
+    parser.add_argument("--max-calls",
+                        help="Maximum number of LLM calls in flight. If given, queries are pipelined: up to --max-concurrency queries are admitted at the same time (e.g. every query of a map) and their calls share the call slots, oldest query first, so the planning of a query overlaps the reflection of another.",
+                        type=int,
+                        default=None)
+
+    parser.add_argument("--early-exit",
+                        help="Stop the reflection iterations of a query when the reflection scores reach --convergence-score (the response is not corrected) or when a correction does not change the relevant objects. The stop reason is saved in convergence.json, and the responses in their own results folder.",
+                        action="store_true")
+
+    parser.add_argument("--convergence-score",
+                        help="Minimum score (out of 10) of every section of a reflection to stop with --early-exit.",
+                        type=float,
+                        default=9)
+
+    parser.add_argument("--aggregator",
+                        help="Final step of the LLM Ensemble workflow: the chooser LLM call, or a local aggregation of the relevant objects of the plans (majority vote, Borda count or reciprocal-rank fusion) with no extra LLM call, saved in aggregate_<aggregator>.json.",
+                        type=str,
+                        choices=constants.ENSEMBLE_AGGREGATORS,
+                        default=constants.ENSEMBLE_AGGREGATOR)
+
+    parser.add_argument("--share-plans",
+                        help="Share the first plan of every query between the Base, Self-Reflection and LLM Ensemble workflows (first planner), which start with the same prompt: a workflow reuses the plan of another one with the same LLM and sampling settings instead of planning again. Shared plans are kept in results/shared_plans, and the plans reused are saved in run_metadata.json.",
+                        action="store_true")
+
+    parser.add_argument("--adaptive-ensemble",
+                        help="Sample the planners of the LLM Ensemble workflow incrementally: --min-samples plans first, then one more at a time (all the missing ones in a single request, with LLMs that return several candidates per request) until --agreement-threshold of them have the same ranked relevant objects. If every plan agrees, the chooser is not called. The plans sampled and whether the chooser was skipped are saved in ensemble.json, and the responses in their own results folder.",
+                        action="store_true")
+
+    parser.add_argument("--agreement-threshold",
+                        help="Fraction of the plans with the same ranked relevant objects at which --adaptive-ensemble stops sampling.",
+                        type=float,
+                        default=0.6)
+
+    parser.add_argument("--min-samples",
+                        help="Plans sampled at once by --adaptive-ensemble before measuring their agreement.",
+                        type=int,
+                        default=3)
+
+    parser.add_argument("-b", "--batch-size",
+                        help="Number of queries planned in a single LLM call in the base workflow (keyed JSON response per query id). Queries missing or malformed in the response are planned individually. Defaults to 1 (one call per query).",
+                        type=int,
+                        default=1)
+
+    parser.add_argument("--cache-dir",
+                        help="Folder of the LLM response cache, keyed on the whole conversation sent to the LLM. If given without value, the default folder is used. Disabled by default.",
+                        type=str,
+                        nargs="?",
+                        const=constants.LLM_CACHE_FOLDER_PATH,
+                        default=None)
+
+    parser.add_argument("--cache-max-entries",
+                        help="Maximum number of responses kept in the cache, the least recently used ones are evicted first.",
+                        type=int,
+                        default=None)
+
+    parser.add_argument("--streaming",
+                        help="Stream JSON responses, resolving them as soon as the JSON object is closed and cancelling the trailing text.",
+                        action="store_true")
+
+    parser.add_argument("--telemetry-file",
+                        help="JSON Lines file to which a record of every LLM call (latency, workflow, stage, semantic map, query, attempt, cache hit...) is written. Defaults to a new file in results/telemetry. Latency percentiles by workflow and stage are printed at the end.",
+                        type=str,
+                        default=None)
+
+    parser.add_argument("--map-encoding",
+                        help="Encoding of the semantic maps in the prompts: the original JSON, a compact JSON (short keys and centimetre integers) or a table (one object per row). Responses of other encodings than JSON are saved in their own results folder.",
+                        type=str,
+                        choices=constants.MAP_ENCODINGS,
+                        default=constants.MAP_ENCODING)
+
+    parser.add_argument("--prune-maps",
+                        help="Prune the semantic map of every query to the objects matching it (by category name, alias or supercategory, and certainty) and their spatial neighbours, keeping the whole map if the query has no confident match. Responses are saved in their own results folder.",
+                        action="store_true")
+
+    parser.add_argument("--context-caching",
+                        help="Cache the prompt prefix with the semantic map in the LLM provider. Gemini only caches prefixes of at least 32768 tokens with contents besides the system instruction, so it is a no-op (with a warning) for the semantic map prompts (about 2k tokens) and the agent workflows; OpenAI caches prefixes automatically and only the cached tokens are accounted.",
+                        action="store_true")
+
+    parser.add_argument("--trace-file",
+                        help="Chrome trace JSON file to which the spans of the run (run, semantic map, query, workflow stage and provider attempt) are written, to be opened in chrome://tracing or Perfetto. Tracing is disabled by default.",
+                        type=str,
+                        default=None)
+
     args = parser.parse_args()
 
     main(args)
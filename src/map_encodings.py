@@ -0,0 +1,48 @@
+import argparse
+import copy
+
+import constants
+import main
+from voxelad import preprocess, serialization
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Reports the tokens of the semantic maps in every prompt encoding, counted with the tokenizer of an LLM")
+
+    parser.add_argument("-n", "--number-maps",
+                        help="Number of semantic maps to measure. Semantic maps are processed in alphabetical order.",
+                        type=int,
+                        default=None)
+
+    parser.add_argument("--mode",
+                        help="Semantic maps input mode to LLMs, with uncertainty or not.",
+                        type=str,
+                        choices=[constants.MODE_CERTAINTY,
+                                 constants.MODE_UNCERTAINTY],
+                        default=constants.MODE_CERTAINTY)
+
+    parser.add_argument("-l", "--llm",
+                        help="LLM whose tokenizer counts the tokens.",
+                        type=str,
+                        choices=constants.LLM_REGISTRY.get_constants(),
+                        default=constants.LLM_GPT_4_O)
+
+    args = parser.parse_args()
+
+    llm_provider = main.get_llm_provider(args.llm)
+
+    total_tokens = {encoding: 0 for encoding in serialization.ENCODINGS}
+    print(f"{'semantic map':<32}" + "".join(f"{encoding:>10}" for encoding in serialization.ENCODINGS))
+    for s_m_b, s_m_o in main.load_semantic_maps()[:args.number_maps]:
+        pre_processed_semantic_map = preprocess.preprocess_semantic_map(copy.deepcopy(s_m_o),
+                                                                        class_uncertainty=(args.mode == constants.MODE_UNCERTAINTY))
+        map_tokens = serialization.count_tokens_by_encoding(pre_processed_semantic_map,
+                                                            llm_provider.count_tokens)
+        print(f"{s_m_b:<32}" + "".join(f"{map_tokens[encoding]:>10}" for encoding in serialization.ENCODINGS))
+        for encoding, tokens in map_tokens.items():
+            total_tokens[encoding] += tokens
+
+    print(f"{'total':<32}" + "".join(f"{total_tokens[encoding]:>10}" for encoding in serialization.ENCODINGS))
+    json_tokens = max(1, total_tokens[serialization.ENCODING_JSON])
+    print(f"{'size vs json':<32}" + "".join(f"{total_tokens[encoding] / json_tokens:>10.0%}" for encoding in serialization.ENCODINGS))
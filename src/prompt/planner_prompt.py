@@ -138,6 +138,66 @@ The semantic map in JSON format is the following:
         return prompt_text
 
 
+class PromptPlanBatch (Prompt):
+
+    QUERY_TAG = "<USER_QUERIES>"
+
+    SYSTEM_PROMPT = """
+<INSTRUCTION>
+The input to the model is a 3D SEMANTIC_MAP in a JSON format (<SEMANTIC_MAP>). Each entry of the "instances" JSON object describes one object in the scene, with the following fields:
+
+1 "bbox": 3D bounding box of the object
+    1.1 "bbox.center": Center of the bounding box of the object
+    1.2 "bbox.size": Size of the bounding box of the object
+2 "n_observations": Number of observations of the object in the scene
+3 "results": Results of the classification of the object, indicating a category and the certainty that the object belongs to that category
+
+Analyze this SEMANTIC_MAP and respond to each of the user's QUERIES independently by identifying and listing the objects most relevant to perform the specified task.
+Each list should be ordered by relevance, from the most relevant to the least relevant.
+In determining relevance, you should consider both the classification data of each object and their spatial arrangements within the scene, such as which objects are next to, above, or below others.
+Although explicit relationships are not provided in the semantic map, you can infer relevance from the scene layout to best answer the queries.
+</INSTRUCTION>
+
+<OUTPUT_FORMAT>
+The user queries are given as a JSON dictionary, whose keys are the query ids and whose values are the queries.
+Respond with a JSON dictionary with one entry per query, whose key is the query id and whose value is a JSON dictionary with the following fields:
+1 "inferred_query": (String) Your interpretation of the user query in summary form
+2 "query_achievable": (Boolean) Whether or not the user-specified query is achievable using the objects and descriptions provided in the semantic map
+3 "relevant_objects": (List of String) List of objects relevant to the user's query (ordered by relevance, most relevant first, least relevant last); or empty list in case there is no relevant object. Objects must be represented here by their ids.
+4 "explanation": (String) A brief explanation of what the most relevant objects are, and how they achieve the user-specified task
+Every query id must be answered. The response should only be a JSON object, no explanations, titles or additional information required.
+</OUTPUT_FORMAT>
+
+<EXAMPLES>
+Here are some examples of the process for a single query (the expected response is the value of its query id):
+{{examples}}
+</EXAMPLES>
+
+Now respond to the user queries following the INSTRUCTION and the OUTPUT_FORMAT, based on the input SEMANTIC_MAP.
+
+<SEMANTIC_MAP>
+The semantic map in JSON format is the following:
+{{semantic_map}}
+</SEMANTIC_MAP>
+
+<USER_QUERIES>
+{{queries}}
+</USER_QUERIES>
+"""
+
+    def get_system_prompt(self) -> str:
+        return self.SYSTEM_PROMPT
+
+    def replace_examples(self, prompt_text):
+        return prompt_text.replace("{{examples}}", PLAN_EXAMPLES)
+
+    def global_replace(self, prompt_text: str) -> str:
+        prompt_text = self.replace_prompt_data_dict(
+            self.prompt_data_dict, prompt_text)
+        prompt_text = self.replace_examples(prompt_text)
+        return prompt_text
+
+
 class PromptPlanAgent (Prompt):
 
     SYSTEM_PROMPT = """
@@ -2,9 +2,15 @@
 
 from abc import ABC, abstractmethod
 
+# Tag of the section of the prompts with the user query
+USER_QUERY_TAG = "<USER_QUERY>"
+
 
 class Prompt(ABC):
 
+    # Tag of the section of the prompt with the user query
+    QUERY_TAG = USER_QUERY_TAG
+
     def __init__(self, **prompt_data_dict):
         """
         Initializes the Prompt instance with a dictionary of prompt data.
@@ -70,3 +76,19 @@ class Prompt(ABC):
             str: The final prompt text after all replacements.
         """
         return self.global_replace(self.get_system_prompt())
+
+    def get_cacheable_prefix_length(self, prompt_text: str) -> int:
+        """
+        Returns the number of characters at the start of the prompt text that do not
+        depend on the user query (instructions, examples and semantic map), so they can
+        be cached and shared by every query on the same semantic map.
+
+        Args:
+            prompt_text (str): The prompt text, as returned by `get_prompt_text`.
+
+        Returns:
+            int: Length of the prefix before the user query section (QUERY_TAG), or the
+                whole length if there is no such section.
+        """
+        user_query_index = prompt_text.find(self.QUERY_TAG)
+        return user_query_index if user_query_index >= 0 else len(prompt_text)
@@ -0,0 +1,244 @@
+import argparse
+import copy
+import time
+
+import constants
+import main
+from llm import tracing
+from llm.retry_policy import ProviderCallError
+from voxelad import preprocess
+from workflow import executor, matrix
+
+
+def get_setting(args, experiment_spec: dict, key: str, default):
+    # Command line arguments take precedence over the experiment specification
+    value = getattr(args, key)
+    if value is not None:
+        return value
+    return experiment_spec.get(key, default)
+
+
+def run_matrix(args):
+    constants.set_map_encoding(args.map_encoding)
+    constants.set_map_pruning(args.prune_maps)
+    constants.set_convergence_policy(args.early_exit, args.convergence_score)
+    constants.set_adaptive_ensemble(args.adaptive_ensemble, args.agreement_threshold, args.min_samples)
+    constants.set_ensemble_aggregator(args.aggregator)
+    constants.set_plan_sharing(args.share_plans)
+    # Load experiment specification
+    experiment_spec = dict()
+    if args.spec is not None:
+        experiment_spec = matrix.load_experiment_spec(args.spec)
+
+    modes = get_setting(args, experiment_spec, matrix.KEY_MODES,
+                        [constants.MODE_CERTAINTY])
+    methods = get_setting(args, experiment_spec, matrix.KEY_METHODS,
+                          constants.METHODS)
+    llms = get_setting(args, experiment_spec, matrix.KEY_LLMS,
+                       [constants.LLM_GEMINI_1_5_PRO])
+    number_maps = get_setting(args, experiment_spec, matrix.KEY_NUMBER_MAPS,
+                              10)
+    reflection_iterations = get_setting(args, experiment_spec, matrix.KEY_REFLECTION_ITERATIONS,
+                                        2)
+    max_concurrency = get_setting(args, experiment_spec, matrix.KEY_MAX_CONCURRENCY,
+                                  1)
+    max_calls = get_setting(args, experiment_spec, matrix.KEY_MAX_CALLS,
+                            None)
+
+    cells = matrix.build_cells(modes, methods, llms)
+    print(f"Executing {len(cells)} experiment cells: {cells}")
+
+    # Load semantic maps and queries (only once for the whole grid)
+    semantic_maps = main.load_semantic_maps()[:number_maps]
+    queries = main.load_queries()
+
+    # Pre-process every semantic map once per mode (pre-processing modifies the map in place)
+    pre_processed_semantic_maps = dict()
+    for mode in modes:
+        pre_processed_semantic_maps[mode] = [
+            (s_m_b, preprocess.preprocess_semantic_map(copy.deepcopy(s_m_o),
+                                                       class_uncertainty=(mode == constants.MODE_UNCERTAINTY)))
+            for s_m_b, s_m_o in semantic_maps]
+
+    response_cache = main.create_response_cache(args.cache_dir,
+                                                args.cache_max_entries)
+    run_telemetry = main.create_telemetry(args.telemetry_file)
+    tracer = main.create_tracer(args.trace_file)
+
+    # One list of queries to plan per cell
+    cells_coroutines = list()
+    for cell in cells:
+        llm_provider = main.get_llm_provider(cell.llm)
+        llm_provider.set_response_cache(response_cache)
+        llm_provider.set_streaming(args.streaming)
+        llm_provider.set_context_caching(args.context_caching)
+        llm_provider.set_telemetry(run_telemetry)
+        cells_coroutines.append([
+            coroutine
+            for semantic_map in pre_processed_semantic_maps[cell.mode]
+            for coroutine in main.plan_queries(cell.method, cell.mode, semantic_map, llm_provider,
+                                               queries, reflection_iterations, args.batch_size)])
+
+    # Mix the work of every cell, so the providers are kept busy during the whole run
+    coroutines = matrix.interleave(cells_coroutines)
+
+    start_time = time.time()
+    # Cells are interleaved, so query spans are children of the run span directly
+    with tracing.span("run", "run", cells=len(cells)):
+        executor.run(executor.gather_with_concurrency(coroutines,
+                                                      max_concurrency=max_concurrency,
+                                                      desc=f"Ex. matrix of {len(cells)} cells...",
+                                                      skipped_errors=(ProviderCallError,),
+                                                      max_calls=max_calls),
+                     max_workers=main.get_max_workers(max_concurrency, methods, max_calls))
+    end_time = time.time()
+
+    print(f"Experiment matrix took {end_time - start_time} s")
+    main.export_trace(tracer, args.trace_file)
+    for cell in cells:
+        main.save_run_metadata(cell.mode, cell.method, main.get_llm_provider(cell.llm))
+    for llm in llms:
+        main.get_llm_provider(llm).clear_context_caches()
+    run_telemetry.print_summary()
+    main.print_cache_statistics(response_cache)
+    main.print_pruning_statistics()
+    main.print_convergence_statistics()
+    main.print_ensemble_statistics()
+    main.print_plan_sharing_statistics()
+    for llm in llms:
+        main.print_llm_statistics(main.get_llm_provider(llm))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Executes a whole grid of experiments (modes x methods x LLMs) on a set of semantic maps in a single process")
+
+    parser.add_argument("-s", "--spec",
+                        help="YAML file with the experiment specification. Command line arguments override its values.",
+                        type=str,
+                        default=None)
+
+    parser.add_argument("-n", "--number-maps",
+                        dest=matrix.KEY_NUMBER_MAPS,
+                        help="Number of semantic maps on which the queries will be evaluated. Semantic maps are processed in alphabetical order.",
+                        type=int)
+
+    parser.add_argument("--modes",
+                        dest=matrix.KEY_MODES,
+                        help="Semantic maps input modes to LLMs.",
+                        type=str,
+                        nargs="+",
+                        choices=[constants.MODE_CERTAINTY,
+                                 constants.MODE_UNCERTAINTY])
+
+    parser.add_argument("--methods",
+                        dest=matrix.KEY_METHODS,
+                        help="Agentic workflows to execute.",
+                        type=str,
+                        nargs="+",
+                        choices=constants.METHODS)
+
+    parser.add_argument("-l", "--llms",
+                        dest=matrix.KEY_LLMS,
+                        help="LLMs to use in the workflows.",
+                        type=str,
+                        nargs="+",
+                        choices=constants.LLM_REGISTRY.get_constants())
+
+    parser.add_argument("-i", "--reflection-iterations",
+                        dest=matrix.KEY_REFLECTION_ITERATIONS,
+                        help="Number of reflection iterations",
+                        type=int)
+
+    parser.add_argument("-c", "--max-concurrency",
+                        dest=matrix.KEY_MAX_CONCURRENCY,
+                        help="Maximum number of queries (of any cell) processed concurrently.",
+                        type=int)
+
+    parser.add_argument("--max-calls",
+                        dest=matrix.KEY_MAX_CALLS,
+                        help="Maximum number of LLM calls in flight. If given, queries are pipelined: up to --max-concurrency queries are admitted and their calls share the call slots, oldest query first.",
+                        type=int)
+
+    parser.add_argument("--early-exit",
+                        help="Stop the reflection iterations of a query when the critic is satisfied or a correction does not change the plan.",
+                        action="store_true")
+
+    parser.add_argument("--convergence-score",
+                        help="Minimum score (out of 10) of every section of a reflection to stop with --early-exit.",
+                        type=float,
+                        default=9)
+
+    parser.add_argument("--aggregator",
+                        help="Final step of the LLM Ensemble workflow: the chooser LLM call or a local aggregator of the plans.",
+                        type=str,
+                        choices=constants.ENSEMBLE_AGGREGATORS,
+                        default=constants.ENSEMBLE_AGGREGATOR)
+
+    parser.add_argument("--share-plans",
+                        help="Share the first plan of every query between the Base, Self-Reflection and LLM Ensemble workflows.",
+                        action="store_true")
+
+    parser.add_argument("--adaptive-ensemble",
+                        help="Sample the ensemble planners incrementally until they agree, skipping the chooser if they are unanimous.",
+                        action="store_true")
+
+    parser.add_argument("--agreement-threshold",
+                        help="Fraction of the plans with the same ranked relevant objects at which --adaptive-ensemble stops sampling.",
+                        type=float,
+                        default=0.6)
+
+    parser.add_argument("--min-samples",
+                        help="Plans sampled at once by --adaptive-ensemble before measuring their agreement.",
+                        type=int,
+                        default=3)
+
+    parser.add_argument("-b", "--batch-size",
+                        help="Number of queries planned in a single LLM call in the base workflow.",
+                        type=int,
+                        default=1)
+
+    parser.add_argument("--cache-dir",
+                        help="Folder of the LLM response cache. If given without value, the default folder is used. Disabled by default.",
+                        type=str,
+                        nargs="?",
+                        const=constants.LLM_CACHE_FOLDER_PATH,
+                        default=None)
+
+    parser.add_argument("--cache-max-entries",
+                        help="Maximum number of responses kept in the cache.",
+                        type=int,
+                        default=None)
+
+    parser.add_argument("--streaming",
+                        help="Stream JSON responses, resolving them as soon as the JSON object is closed.",
+                        action="store_true")
+
+    parser.add_argument("--telemetry-file",
+                        help="JSON Lines file to which a record of every LLM call is written. Defaults to a new file in results/telemetry.",
+                        type=str,
+                        default=None)
+
+    parser.add_argument("--map-encoding",
+                        help="Encoding of the semantic maps in the prompts.",
+                        type=str,
+                        choices=constants.MAP_ENCODINGS,
+                        default=constants.MAP_ENCODING)
+
+    parser.add_argument("--prune-maps",
+                        help="Prune the semantic map of every query to the objects relevant to it and their neighbours.",
+                        action="store_true")
+
+    parser.add_argument("--context-caching",
+                        help="Cache the prompt prefix with the semantic map in the LLM provider. Gemini only caches prefixes of at least 32768 tokens with contents besides the system instruction, so it is a no-op (with a warning) for the semantic map prompts (about 2k tokens) and the agent workflows; OpenAI caches prefixes automatically and only the cached tokens are accounted.",
+                        action="store_true")
+
+    parser.add_argument("--trace-file",
+                        help="Chrome trace JSON file to which the spans of the run are written. Tracing is disabled by default.",
+                        type=str,
+                        default=None)
+
+    args = parser.parse_args()
+
+    run_matrix(args)
@@ -0,0 +1,110 @@
+import argparse
+
+import constants
+from llm.fake_provider import LATENCY_DISTRIBUTIONS
+from llm.stand_in_server import StandInServer
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Serves a local stand-in of the OpenAI chat-completions and Gemini REST APIs, to benchmark the real LLM clients offline. Point the providers to it with the OPENAI_BASE_URL (http://HOST:PORT/v1) and GOOGLE_GEMINI_BASE_URL (http://HOST:PORT) environment variables.")
+
+    parser.add_argument("--host",
+                        help="Host to listen on.",
+                        type=str,
+                        default="127.0.0.1")
+
+    parser.add_argument("-p", "--port",
+                        help="Port to listen on.",
+                        type=int,
+                        default=8080)
+
+    parser.add_argument("--latency-distribution",
+                        help="Distribution of the latency of the responses.",
+                        type=str,
+                        choices=LATENCY_DISTRIBUTIONS,
+                        default=constants.FAKE_LLM_SETTINGS["latency_distribution"])
+
+    parser.add_argument("--latency-mean",
+                        help="Mean latency of the responses in seconds.",
+                        type=float,
+                        default=constants.FAKE_LLM_SETTINGS["latency_mean"])
+
+    parser.add_argument("--latency-stddev",
+                        help="Standard deviation of the latency of the responses in seconds.",
+                        type=float,
+                        default=constants.FAKE_LLM_SETTINGS["latency_stddev"])
+
+    parser.add_argument("--malformed-json-rate",
+                        help="Probability of a JSON response being malformed.",
+                        type=float,
+                        default=0.0)
+
+    parser.add_argument("--plan-agreement-rate",
+                        help="Probability of a sample of a fake plan (e.g. an ensemble planner) being the same plan as the first sample.",
+                        type=float,
+                        default=constants.FAKE_LLM_SETTINGS["plan_agreement_rate"])
+
+    parser.add_argument("--correction-fixpoint-rate",
+                        help="Probability of a fake correction keeping the relevant objects of the plan it corrects.",
+                        type=float,
+                        default=constants.FAKE_LLM_SETTINGS["correction_fixpoint_rate"])
+
+    parser.add_argument("--corrected-pass-rate",
+                        help="Probability of a fake reflection on a corrected plan scoring every section 9 or more.",
+                        type=float,
+                        default=constants.FAKE_LLM_SETTINGS["corrected_pass_rate"])
+
+    parser.add_argument("--rate-limit-rate",
+                        help="Probability of answering a request with 429 (too many requests).",
+                        type=float,
+                        default=0.0)
+
+    parser.add_argument("--timeout-rate",
+                        help="Probability of not answering a request (the connection is dropped after --timeout-seconds).",
+                        type=float,
+                        default=0.0)
+
+    parser.add_argument("--timeout-seconds",
+                        help="Time the connection hangs on a timeout.",
+                        type=float,
+                        default=30.0)
+
+    parser.add_argument("--truncated-body-rate",
+                        help="Probability of dropping the connection in the middle of the response body.",
+                        type=float,
+                        default=0.0)
+
+    parser.add_argument("--seed",
+                        help="Seed of the latencies and injected faults.",
+                        type=int,
+                        default=0)
+
+    args = parser.parse_args()
+
+    responder = constants.create_fake_provider(latency_distribution=args.latency_distribution,
+                                               latency_mean=args.latency_mean,
+                                               latency_stddev=args.latency_stddev,
+                                               failure_rate=0.0,
+                                               malformed_json_rate=args.malformed_json_rate,
+                                               seed=args.seed,
+                                               plan_agreement_rate=args.plan_agreement_rate,
+                                               correction_fixpoint_rate=args.correction_fixpoint_rate,
+                                               corrected_pass_rate=args.corrected_pass_rate)
+    server = StandInServer(host=args.host,
+                           port=args.port,
+                           responder=responder,
+                           rate_limit_rate=args.rate_limit_rate,
+                           timeout_rate=args.timeout_rate,
+                           timeout_seconds=args.timeout_seconds,
+                           truncated_body_rate=args.truncated_body_rate,
+                           seed=args.seed)
+
+    print(f"Serving LLM stand-in on {server.get_base_url()}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Stand-in statistics: {server.get_statistics()}")
@@ -0,0 +1,27 @@
+import argparse
+
+from llm.telemetry import Telemetry
+
+# Tags by which the records can be grouped
+GROUP_KEYS = ["provider", "workflow", "mode", "map", "query", "stage", "kind"]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Summarizes the telemetry of a run (calls, tokens, estimated cost and latency percentiles) by any combination of tags")
+
+    parser.add_argument("-f", "--telemetry-file",
+                        help="JSON Lines telemetry file written by main.py or run_matrix.py.",
+                        type=str,
+                        required=True)
+
+    parser.add_argument("-g", "--group-by",
+                        help="Tags by which the calls are grouped.",
+                        type=str,
+                        nargs="+",
+                        choices=GROUP_KEYS,
+                        default=["workflow", "map", "query"])
+
+    args = parser.parse_args()
+
+    Telemetry.load(args.telemetry_file).print_summary(group_keys=tuple(args.group_by))
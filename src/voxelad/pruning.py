@@ -0,0 +1,241 @@
+import math
+import re
+import threading
+
+# Other names of the categories of the Voxeland semantic maps (COCO), matched as if the
+# query named the category
+CATEGORY_ALIASES = {
+    "bike": ["bicycle"],
+    "bag": ["backpack", "handbag", "suitcase"],
+    "purse": ["handbag"],
+    "luggage": ["suitcase"],
+    "fridge": ["refrigerator"],
+    "sofa": ["couch"],
+    "television": ["tv"],
+    "mobile": ["cell phone"],
+    "smartphone": ["cell phone"],
+    "computer": ["laptop"],
+    "mug": ["cup"],
+    "ball": ["sports ball"],
+}
+
+# Supercategories of the COCO categories, matched as if the query named all of their
+# categories (e.g. "an appliance")
+SUPERCATEGORIES = {
+    "vehicle": ["bicycle", "car", "motorcycle", "airplane", "bus", "train", "truck", "boat"],
+    "animal": ["bird", "cat", "dog", "horse", "sheep", "cow", "elephant", "bear", "zebra", "giraffe"],
+    "accessory": ["backpack", "umbrella", "handbag", "tie", "suitcase"],
+    "sports": ["frisbee", "skis", "snowboard", "sports ball", "kite", "baseball bat", "baseball glove",
+               "skateboard", "surfboard", "tennis racket"],
+    "kitchen": ["bottle", "wine glass", "cup", "fork", "knife", "spoon", "bowl"],
+    "food": ["banana", "apple", "sandwich", "orange", "broccoli", "carrot", "hot dog", "pizza", "donut", "cake"],
+    "furniture": ["chair", "couch", "potted plant", "bed", "dining table", "toilet"],
+    "electronic": ["tv", "laptop", "mouse", "remote", "keyboard", "cell phone"],
+    "appliance": ["microwave", "oven", "toaster", "sink", "refrigerator"],
+}
+
+# Words that exclude the categories named by a query ("something to sit on that is not a
+# chair"), so the named categories are not the relevant objects
+NEGATION_WORDS = {"not", "no", "isn", "aren", "don", "doesn", "except", "other", "without", "instead"}
+
+WORD_PATTERN = re.compile(r"[a-z]+")
+
+
+def get_query_words(query_text: str) -> set:
+    """
+    Returns the words of a query, with their singular forms.
+    """
+    words = set()
+    for word in WORD_PATTERN.findall(query_text.lower()):
+        words.add(word)
+        # Simple singular forms ("dishes" -> "dish", "books" -> "book")
+        if word.endswith("es"):
+            words.add(word[:-2])
+        if word.endswith("s"):
+            words.add(word[:-1])
+    return words
+
+
+def get_query_terms(query_text: str) -> set:
+    """
+    Returns the words of a query (with their singular forms) and the categories named by
+    them through an alias or a supercategory.
+    """
+    terms = get_query_words(query_text)
+    for term in list(terms):
+        terms.update(CATEGORY_ALIASES.get(term, list()))
+        terms.update(SUPERCATEGORIES.get(term, list()))
+    return terms
+
+
+def is_negated(query_text: str) -> bool:
+    """
+    Returns whether a query excludes some objects (e.g. "not a couch", "other than the table").
+    """
+    return len(get_query_words(query_text) & NEGATION_WORDS) > 0
+
+
+def get_box_gap(object_a: dict, object_b: dict) -> float:
+    """
+    Returns the distance between the bounding boxes of two objects (0 if they overlap).
+    """
+    gaps = [max(0.0, abs(center_a - center_b) - (size_a + size_b) / 2)
+            for center_a, center_b, size_a, size_b in zip(object_a["bbox"]["center"], object_b["bbox"]["center"],
+                                                          object_a["bbox"]["size"], object_b["bbox"]["size"])]
+    return math.sqrt(sum(gap ** 2 for gap in gaps))
+
+
+class MapPruner:
+    """
+    Prunes a (pre-processed) semantic map to the objects that can be relevant to a query,
+    so the prompts do not carry the whole map.
+
+    Candidate objects are those with a category (of certainty at least a ratio of their
+    most certain one) named by a word of the query, by an alias of the category or by its
+    supercategory. The candidates are expanded with their spatial neighbours (objects
+    whose bounding box is close to theirs), which give the context of queries such as "a
+    chair close to a table". The vocabulary only names categories, so queries about
+    affordances or activities ("where can I sit?") have no candidates. The whole map is
+    kept when the query has no confident match: no candidates, or a negated query ("not a
+    couch"), whose named categories are the objects excluded.
+
+    Given the ground truth of the queries, the pruner also counts the relevant objects
+    that are pruned away (`count_pruned_gold_objects`).
+
+    Pruned maps are memoized by map and query, so the calls of a query (e.g. the
+    planners and the chooser of an ensemble) share them and are counted once in the
+    statistics.
+    """
+
+    # Pruned maps memoized before the memo is cleared
+    MEMO_SIZE = 1024
+
+    def __init__(self, min_score_ratio: float = 0.5, neighbour_distance: float = 0.5, min_objects: int = 1):
+        """
+        Initializes the MapPruner.
+
+        Args:
+            min_score_ratio (float, optional): Minimum certainty of a matching category,
+                relative to the most certain category of the object. Defaults to 0.5.
+            neighbour_distance (float, optional): Maximum distance (in metres) between the
+                bounding boxes of a candidate and its neighbours. Defaults to 0.5.
+            min_objects (int, optional): Minimum number of objects of a pruned map, the
+                whole map is kept otherwise. Defaults to 1.
+        """
+        self.min_score_ratio = min_score_ratio
+        self.neighbour_distance = neighbour_distance
+        self.min_objects = min_objects
+
+        self.lock = threading.Lock()
+        self.memo = dict()
+        self.n_queries = 0
+        self.n_fallbacks = 0
+        self.n_objects = 0
+        self.n_kept_objects = 0
+        self.n_gold_objects = 0
+        self.n_pruned_gold_objects = 0
+        self.n_gold_queries = 0
+        self.n_pruned_gold_queries = 0
+
+    def is_candidate(self, object_value: dict, query_terms: set) -> bool:
+        results = object_value.get("results", dict())
+        if len(results) == 0:
+            return False
+        max_score = max(results.values())
+        for category, score in results.items():
+            if score < self.min_score_ratio * max_score:
+                continue
+            if category in query_terms or any(word in query_terms for word in category.split()):
+                return True
+        return False
+
+    def prune(self, semantic_map: dict, query_text: str) -> dict:
+        """
+        Prunes a semantic map to the objects that can be relevant to a query.
+
+        Args:
+            semantic_map (dict): The (pre-processed) semantic map.
+            query_text (str): The natural language query.
+
+        Returns:
+            dict: The pruned semantic map (with the same structure), or the whole map if
+                the query has no confident match.
+        """
+        memo_key = (id(semantic_map), query_text)
+        with self.lock:
+            if memo_key in self.memo and self.memo[memo_key][0] is semantic_map:
+                return self.memo[memo_key][1]
+
+        instances = semantic_map["instances"]
+        query_terms = get_query_terms(query_text)
+        candidate_ids = [object_id for object_id, object_value in instances.items()
+                         if self.is_candidate(object_value, query_terms)]
+        kept_ids = set(candidate_ids)
+        for object_id, object_value in instances.items():
+            if object_id not in kept_ids and any(
+                    get_box_gap(object_value, instances[candidate_id]) <= self.neighbour_distance
+                    for candidate_id in candidate_ids):
+                kept_ids.add(object_id)
+
+        fallback = len(candidate_ids) == 0 or len(kept_ids) < self.min_objects or is_negated(query_text)
+        if fallback:
+            pruned_semantic_map = semantic_map
+        else:
+            pruned_semantic_map = {"instances": {object_id: object_value for object_id, object_value in instances.items()
+                                                 if object_id in kept_ids}}
+
+        with self.lock:
+            if len(self.memo) >= self.MEMO_SIZE:
+                self.memo = dict()
+            # The map is kept in the memo, so its id is not reused by another map
+            self.memo[memo_key] = (semantic_map, pruned_semantic_map)
+            self.n_queries += 1
+            self.n_fallbacks += int(fallback)
+            self.n_objects += len(instances)
+            self.n_kept_objects += len(pruned_semantic_map["instances"])
+        return pruned_semantic_map
+
+    def count_pruned_gold_objects(self, semantic_map: dict, query_text: str, gold_object_ids: list) -> list:
+        """
+        Counts the relevant objects of a query (its ground truth) that its pruned map does
+        not keep, so no plan with the pruned map can find them.
+
+        Args:
+            semantic_map (dict): The (pre-processed) semantic map.
+            query_text (str): The natural language query.
+            gold_object_ids (list): Ids of the relevant objects of the query.
+
+        Returns:
+            list: Ids of the relevant objects pruned away.
+        """
+        pruned_semantic_map = self.prune(semantic_map, query_text)
+        # Relevant objects missing from the pre-processed map are not lost by pruning
+        gold_object_ids = [object_id for object_id in gold_object_ids if object_id in semantic_map["instances"]]
+        pruned_gold_object_ids = [object_id for object_id in gold_object_ids
+                                  if object_id not in pruned_semantic_map["instances"]]
+        with self.lock:
+            self.n_gold_objects += len(gold_object_ids)
+            self.n_pruned_gold_objects += len(pruned_gold_object_ids)
+            self.n_gold_queries += int(len(gold_object_ids) > 0)
+            self.n_pruned_gold_queries += int(len(pruned_gold_object_ids) > 0)
+        return pruned_gold_object_ids
+
+    def get_statistics(self) -> dict:
+        """
+        Returns the number of pruned queries and fallbacks to the whole map, the objects
+        before and after pruning, the reduction ratio (fraction of objects removed) and,
+        if the ground truth was given, the relevant objects (and queries with some
+        relevant object) pruned away.
+        """
+        with self.lock:
+            return {
+                "queries": self.n_queries,
+                "fallbacks": self.n_fallbacks,
+                "objects": self.n_objects,
+                "kept_objects": self.n_kept_objects,
+                "reduction_ratio": 1 - self.n_kept_objects / self.n_objects if self.n_objects > 0 else 0.0,
+                "gold_objects": self.n_gold_objects,
+                "pruned_gold_objects": self.n_pruned_gold_objects,
+                "gold_queries": self.n_gold_queries,
+                "pruned_gold_queries": self.n_pruned_gold_queries,
+            }
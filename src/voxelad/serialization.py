@@ -0,0 +1,116 @@
+import json
+from typing import Callable
+
+# Encodings of the semantic maps in the prompts
+ENCODING_JSON = "json"
+ENCODING_COMPACT = "compact"
+ENCODING_TABLE = "table"
+ENCODINGS = [ENCODING_JSON, ENCODING_COMPACT, ENCODING_TABLE]
+
+# Columns of the table encoding
+TABLE_COLUMNS = ["id", "cx", "cy", "cz", "sx", "sy", "sz", "n", "results"]
+
+# Explanation of the encodings, written before the map, since the prompts describe (and
+# give examples of) the JSON encoding
+ENCODING_DESCRIPTIONS = {
+    ENCODING_JSON: "",
+    ENCODING_COMPACT: ("The semantic map is written in a compact JSON encoding, equivalent to the one described: "
+                       "\"c\" is bbox.center and \"s\" is bbox.size, both in centimetres, "
+                       "\"n\" is n_observations and \"r\" are the results (certainties rounded to integers).\n"),
+    ENCODING_TABLE: ("The semantic map is written as a table equivalent to the JSON described, one object per row, "
+                     f"with columns {','.join(TABLE_COLUMNS)}: (cx,cy,cz) is bbox.center and (sx,sy,sz) is bbox.size, "
+                     "both in centimetres, n is n_observations and results are category:certainty pairs "
+                     "(certainties rounded to integers) separated by \"|\", most certain first.\n"),
+}
+
+
+def to_centimetres(values: list) -> list:
+    """
+    Converts a list of coordinates or sizes from metres to integer centimetres.
+    """
+    return [round(value * 100) for value in values]
+
+
+def get_sorted_results(results: dict) -> list:
+    """
+    Returns the classification results of an object as (category, integer certainty)
+    pairs, most certain first.
+    """
+    return [(category, round(certainty))
+            for category, certainty in sorted(results.items(), key=lambda item: item[1], reverse=True)]
+
+
+def encode_compact(semantic_map: dict) -> str:
+    """
+    Encodes a semantic map as JSON with short keys, centimetre integers and no spaces.
+
+    Example:
+        {"instances":{"obj1":{"c":[100,150,50],"s":[50,50,20],"n":90,"r":{"notebook":92}}}}
+    """
+    instances = dict()
+    for object_id, object_value in semantic_map["instances"].items():
+        instances[object_id] = {
+            "c": to_centimetres(object_value["bbox"]["center"]),
+            "s": to_centimetres(object_value["bbox"]["size"]),
+            "n": object_value["n_observations"],
+            "r": dict(get_sorted_results(object_value["results"])),
+        }
+    return json.dumps({"instances": instances}, separators=(",", ":"))
+
+
+def encode_table(semantic_map: dict) -> str:
+    """
+    Encodes a semantic map as a CSV-like table, one object per row, with centimetre
+    integers.
+
+    Example:
+        id,cx,cy,cz,sx,sy,sz,n,results
+        obj1,100,150,50,50,50,20,90,notebook:92|desk:5
+    """
+    rows = [",".join(TABLE_COLUMNS)]
+    for object_id, object_value in semantic_map["instances"].items():
+        results = "|".join(f"{category}:{certainty}"
+                           for category, certainty in get_sorted_results(object_value["results"]))
+        rows.append(",".join([object_id] +
+                             [str(value) for value in to_centimetres(object_value["bbox"]["center"])] +
+                             [str(value) for value in to_centimetres(object_value["bbox"]["size"])] +
+                             [str(object_value["n_observations"]), results]))
+    return "\n".join(rows)
+
+
+def serialize_semantic_map(semantic_map: dict, encoding: str = ENCODING_JSON) -> str:
+    """
+    Serializes a (pre-processed) semantic map for the prompts.
+
+    Args:
+        semantic_map (dict): The semantic map.
+        encoding (str, optional): Encoding of the map: "json" (the original JSON),
+            "compact" (JSON with short keys and centimetre integers) or "table" (one object
+            per row). Defaults to "json".
+
+    Returns:
+        str: The encoded semantic map, preceded by the explanation of the encoding if it
+            is not the JSON one.
+    """
+    if encoding == ENCODING_JSON:
+        return json.dumps(semantic_map)
+    elif encoding == ENCODING_COMPACT:
+        return ENCODING_DESCRIPTIONS[encoding] + encode_compact(semantic_map)
+    elif encoding == ENCODING_TABLE:
+        return ENCODING_DESCRIPTIONS[encoding] + encode_table(semantic_map)
+    raise ValueError(f"Semantic map encoding {encoding} not known")
+
+
+def count_tokens_by_encoding(semantic_map: dict, count_tokens: Callable[[str], int]) -> dict:
+    """
+    Counts the tokens of a semantic map in every encoding.
+
+    Args:
+        semantic_map (dict): The semantic map.
+        count_tokens (Callable[[str], int]): Tokenizer (e.g. `count_tokens` of a provider).
+
+    Returns:
+        dict: Number of tokens, by encoding.
+    """
+    return {encoding: count_tokens(serialize_semantic_map(semantic_map, encoding))
+            for encoding in ENCODINGS}
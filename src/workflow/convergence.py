@@ -0,0 +1,110 @@
+import json
+import re
+import threading
+
+# Reasons to stop the reflection iterations of a query
+STOP_ITERATIONS = "iterations"
+STOP_FIXPOINT = "fixpoint"
+STOP_SCORE = "score"
+STOP_REASONS = [STOP_ITERATIONS, STOP_FIXPOINT, STOP_SCORE]
+
+# Scores of the reflection responses (e.g. "Comments on Correctness. Score: 9/10")
+SCORE_PATTERN = re.compile(r"(\d+(?:\.\d+)?)\s*/\s*10\b")
+
+
+def get_reflection_scores(reflection_response: str) -> list:
+    """
+    Returns the scores (out of 10) given in a reflection response, in order.
+    """
+    return [float(score) for score in SCORE_PATTERN.findall(reflection_response)]
+
+
+def get_relevant_objects(plan_response: str) -> list:
+    """
+    Returns the relevant objects of a plan response, or None if it has none (e.g. a
+    failed response, "{}").
+    """
+    try:
+        plan = json.loads(plan_response)
+    except json.decoder.JSONDecodeError:
+        return None
+    if not isinstance(plan, dict) or not isinstance(plan.get("relevant_objects"), list):
+        return None
+    return plan["relevant_objects"]
+
+
+class ConvergencePolicy:
+    """
+    Decides when the reflection iterations of a query (reflect + correct) can stop before
+    the configured number of iterations:
+
+    - "score": every score of the reflection is at least the score threshold, so the
+      response is not corrected.
+    - "fixpoint": the correction has the same relevant objects (in the same order) as
+      the response it corrects, so further iterations would reflect on the same plan.
+
+    Queries that run every iteration stop with reason "iterations". The stop reasons and
+    iterations of the queries are counted in the statistics.
+    """
+
+    def __init__(self, score_threshold: float = 9, fixpoint: bool = True):
+        """
+        Initializes the ConvergencePolicy.
+
+        Args:
+            score_threshold (float, optional): Minimum score (out of 10) of every section
+                of a reflection to stop without correcting. None to never stop on scores.
+                Defaults to 9.
+            fixpoint (bool, optional): Whether to stop when a correction does not change
+                the relevant objects. Defaults to True.
+        """
+        self.score_threshold = score_threshold
+        self.fixpoint = fixpoint
+
+        self.lock = threading.Lock()
+        self.stop_reasons = {stop_reason: 0 for stop_reason in STOP_REASONS}
+        self.n_iterations = 0
+
+    def check_reflection(self, reflection_response: str) -> str:
+        """
+        Returns STOP_SCORE if the reflection scores reach the threshold, None otherwise.
+        """
+        if self.score_threshold is None:
+            return None
+        scores = get_reflection_scores(reflection_response)
+        if len(scores) > 0 and min(scores) >= self.score_threshold:
+            return STOP_SCORE
+        return None
+
+    def check_correction(self, plan_response: str, correction_response: str) -> str:
+        """
+        Returns STOP_FIXPOINT if the correction keeps the relevant objects of the plan,
+        None otherwise.
+        """
+        if not self.fixpoint:
+            return None
+        relevant_objects = get_relevant_objects(plan_response)
+        if relevant_objects is not None and relevant_objects == get_relevant_objects(correction_response):
+            return STOP_FIXPOINT
+        return None
+
+    def record_stop(self, stop_reason: str, n_iterations: int):
+        """
+        Counts why and after how many reflection iterations a query stopped.
+        """
+        with self.lock:
+            self.stop_reasons[stop_reason] += 1
+            self.n_iterations += n_iterations
+
+    def get_statistics(self) -> dict:
+        """
+        Returns the number of queries stopped by every reason and the average reflection
+        iterations per query.
+        """
+        with self.lock:
+            n_queries = sum(self.stop_reasons.values())
+            return {
+                "queries": n_queries,
+                **{f"stop_{stop_reason}": count for stop_reason, count in self.stop_reasons.items()},
+                "mean_iterations": self.n_iterations / n_queries if n_queries > 0 else 0.0,
+            }
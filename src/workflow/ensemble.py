@@ -0,0 +1,232 @@
+import json
+import statistics
+import threading
+from collections import Counter
+
+from workflow.convergence import get_relevant_objects
+
+# Final steps of the LLM Ensemble workflow: the chooser LLM call, or a local aggregator
+AGGREGATOR_CHOOSER = "chooser"
+AGGREGATOR_MAJORITY = "majority"
+AGGREGATOR_BORDA = "borda"
+AGGREGATOR_RRF = "rrf"
+
+# Constant of the reciprocal-rank fusion (the usual value of the literature)
+RRF_K = 60
+
+
+def get_agreement(plan_responses: list) -> tuple:
+    """
+    Measures the agreement of the plans of an ensemble: the fraction of the plans whose
+    ranked relevant objects are the same as the most common ones (failed plans, without
+    relevant objects, never agree).
+
+    Args:
+        plan_responses (list): The plan responses (JSON strings).
+
+    Returns:
+        tuple: The agreement (0 to 1) and the index of the first plan with the most common
+            relevant objects (None if every plan failed).
+    """
+    rankings = [get_relevant_objects(plan_response) for plan_response in plan_responses]
+    counts = Counter(tuple(ranking) for ranking in rankings if ranking is not None)
+    if len(counts) == 0:
+        return 0.0, None
+    most_common_ranking, count = counts.most_common(1)[0]
+    index = next(index for index, ranking in enumerate(rankings)
+                 if ranking is not None and tuple(ranking) == most_common_ranking)
+    return count / len(plan_responses), index
+
+
+class AdaptiveEnsemblePolicy:
+    """
+    Samples the planners of the LLM Ensemble workflow incrementally: `min_samples` plans
+    first, then one more at a time until the agreement of the plans (see
+    `get_agreement`) reaches the threshold or `max_samples` plans are sampled. If every
+    plan agrees, the choice is the (unanimous) plan and the chooser is not called.
+
+    Every extra plan sampled on its own costs a request with the whole semantic map.
+    LLMs that return several candidates per request are instead asked for all the
+    missing plans in a single request, and only the shortest prefix of the plans that
+    reaches the threshold is kept (see `get_n_samples`): the extra plans then cost their
+    output tokens, at most one request more than sampling every planner at once.
+
+    The samples and chooser skips of every query are counted in the statistics.
+    """
+
+    def __init__(self, agreement_threshold: float = 0.6, min_samples: int = 3, max_samples: int = 6):
+        """
+        Initializes the AdaptiveEnsemblePolicy.
+
+        Args:
+            agreement_threshold (float, optional): Agreement (fraction of plans with the
+                same ranked relevant objects) at which no more plans are sampled.
+                Defaults to 0.6.
+            min_samples (int, optional): Plans sampled at once before measuring their
+                agreement. Defaults to 3.
+            max_samples (int, optional): Maximum number of plans (the ensemble size).
+                Defaults to 6.
+        """
+        self.agreement_threshold = agreement_threshold
+        self.max_samples = max_samples
+        self.min_samples = min(min_samples, max_samples)
+
+        self.lock = threading.Lock()
+        self.n_queries = 0
+        self.n_samples = 0
+        self.n_chooser_skips = 0
+
+    def needs_more_samples(self, plan_responses: list) -> bool:
+        """
+        Returns whether another plan has to be sampled.
+        """
+        if len(plan_responses) >= self.max_samples:
+            return False
+        agreement, _ = get_agreement(plan_responses)
+        return agreement < self.agreement_threshold
+
+    def get_n_samples(self, plan_responses: list) -> int:
+        """
+        Returns the number of plans of the shortest prefix of the plans (from
+        `min_samples` plans on) that needs no more samples.
+        """
+        for n_samples in range(self.min_samples, len(plan_responses)):
+            if not self.needs_more_samples(plan_responses[:n_samples]):
+                return n_samples
+        return len(plan_responses)
+
+    def get_unanimous_choice(self, plan_responses: list) -> int:
+        """
+        Returns the index of the chosen plan if every plan agrees, None otherwise.
+        """
+        agreement, index = get_agreement(plan_responses)
+        return index if agreement == 1 else None
+
+    def record_query(self, n_samples: int, chooser_skipped: bool):
+        """
+        Counts the plans sampled for a query and whether its chooser was skipped.
+        """
+        with self.lock:
+            self.n_queries += 1
+            self.n_samples += n_samples
+            self.n_chooser_skips += int(chooser_skipped)
+
+    def get_statistics(self) -> dict:
+        """
+        Returns the number of queries, the mean plans sampled per query and the rate of
+        queries whose chooser was skipped.
+        """
+        with self.lock:
+            return {
+                "queries": self.n_queries,
+                "mean_samples": self.n_samples / self.n_queries if self.n_queries > 0 else 0.0,
+                "chooser_skip_rate": self.n_chooser_skips / self.n_queries if self.n_queries > 0 else 0.0,
+            }
+
+
+def get_ranked_objects(rankings: list, scores: dict) -> list:
+    """
+    Returns the objects of the rankings sorted by score (highest first), ties broken by
+    their first appearance in the rankings.
+    """
+    first_appearances = dict()
+    for ranking in rankings:
+        for object_id in ranking:
+            first_appearances.setdefault(object_id, len(first_appearances))
+    return sorted(scores, key=lambda object_id: (-scores[object_id], first_appearances[object_id]))
+
+
+def aggregate_majority_vote(rankings: list) -> list:
+    """
+    Aggregates rankings by majority vote: the objects ranked by more than half of the
+    plans, most voted first (ties broken by mean rank). If no object has a majority, the
+    most voted one.
+    """
+    votes = Counter(object_id for ranking in rankings for object_id in dict.fromkeys(ranking))
+    mean_ranks = {object_id: statistics.mean(ranking.index(object_id) for ranking in rankings if object_id in ranking)
+                  for object_id in votes}
+    ranked_objects = sorted(votes, key=lambda object_id: (-votes[object_id], mean_ranks[object_id]))
+    majority_objects = [object_id for object_id in ranked_objects
+                        if votes[object_id] > len(rankings) / 2]
+    return majority_objects if majority_objects else ranked_objects[:1]
+
+
+def aggregate_borda_count(rankings: list) -> list:
+    """
+    Aggregates rankings by Borda count: an object at rank r (from 0) of a plan gets
+    L - r points, L being the length of the longest ranking.
+    """
+    max_length = max(len(ranking) for ranking in rankings)
+    scores = dict()
+    for ranking in rankings:
+        for rank, object_id in enumerate(dict.fromkeys(ranking)):
+            scores[object_id] = scores.get(object_id, 0) + max_length - rank
+    return get_ranked_objects(rankings, scores)
+
+
+def aggregate_reciprocal_rank_fusion(rankings: list) -> list:
+    """
+    Aggregates rankings by reciprocal-rank fusion: an object at rank r (from 1) of a plan
+    gets 1 / (RRF_K + r) points.
+    """
+    scores = dict()
+    for ranking in rankings:
+        for rank, object_id in enumerate(dict.fromkeys(ranking), start=1):
+            scores[object_id] = scores.get(object_id, 0) + 1 / (RRF_K + rank)
+    return get_ranked_objects(rankings, scores)
+
+
+AGGREGATORS = {
+    AGGREGATOR_MAJORITY: aggregate_majority_vote,
+    AGGREGATOR_BORDA: aggregate_borda_count,
+    AGGREGATOR_RRF: aggregate_reciprocal_rank_fusion,
+}
+
+
+def get_aggregate_file_name(aggregator: str) -> str:
+    """
+    Returns the name of the file with the final plan of a local aggregator, saved next to
+    the plans of the query.
+    """
+    return f"aggregate_{aggregator}.json"
+
+
+def aggregate_plans(plan_responses: list, aggregator: str) -> dict:
+    """
+    Aggregates the plans of an ensemble into a final plan locally, without calling the
+    chooser LLM.
+
+    Failed plans (without relevant objects) are ignored. If most plans have no relevant
+    objects, neither has the final plan. Borda count and reciprocal-rank fusion rank
+    every object of the plans, so their ranking is cut to the median length of the
+    plans.
+
+    Args:
+        plan_responses (list): The plan responses (JSON strings).
+        aggregator (str): The aggregator (one of AGGREGATORS).
+
+    Returns:
+        dict: The final plan, with the fields of a plan.
+    """
+    plans = list()
+    for plan_response in plan_responses:
+        if get_relevant_objects(plan_response) is not None:
+            plans.append(json.loads(plan_response))
+    # Object ids only (plans sometimes list objects as dictionaries)
+    rankings = [[object_id for object_id in plan["relevant_objects"] if isinstance(object_id, str)]
+                for plan in plans]
+    non_empty_rankings = [ranking for ranking in rankings if len(ranking) > 0]
+
+    if len(non_empty_rankings) == 0 or len(non_empty_rankings) < len(rankings) / 2:
+        relevant_objects = list()
+    else:
+        relevant_objects = AGGREGATORS[aggregator](non_empty_rankings)
+        if aggregator != AGGREGATOR_MAJORITY:
+            relevant_objects = relevant_objects[:round(statistics.median(len(ranking) for ranking in non_empty_rankings))]
+
+    return {
+        "inferred_query": plans[0].get("inferred_query", "") if plans else "",
+        "query_achievable": len(relevant_objects) > 0,
+        "relevant_objects": relevant_objects,
+        "explanation": f"Relevant objects aggregated by {aggregator} from {len(plans)} of {len(plan_responses)} plans.",
+    }
@@ -0,0 +1,88 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Coroutine, Tuple
+
+import tqdm
+
+from llm import call_scheduler
+
+
+def run(main_coroutine: Coroutine, max_workers: int):
+    """
+    Runs a coroutine in a new event loop whose default executor has room for
+    `max_workers` blocking LLM calls at the same time.
+
+    Provider calls are offloaded to threads by `LargeLanguageModel.agenerate_text`,
+    so the size of the default executor is the upper bound of calls in flight.
+
+    Args:
+        main_coroutine (Coroutine): The coroutine to be executed.
+        max_workers (int): Number of threads available for blocking provider calls.
+
+    Returns:
+        Any: The value returned by the coroutine.
+    """
+    async def main_with_executor():
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=max(1, max_workers)))
+        return await main_coroutine
+
+    return asyncio.run(main_with_executor())
+
+
+async def gather_with_concurrency(coroutines: list, max_concurrency: int, desc: str = None, skipped_errors: Tuple[type, ...] = (), max_calls: int = None) -> list:
+    """
+    Awaits a list of independent coroutines, keeping at most `max_concurrency` of them
+    running at the same time, and shows their progress.
+
+    If `max_calls` is given, the coroutines are pipelined: the LLM calls they await share
+    `max_calls` call slots (see `call_scheduler.CallScheduler`), so many coroutines can
+    be admitted (`max_concurrency`) while the calls in flight stay bounded.
+
+    Args:
+        coroutines (list): Coroutines to be awaited (e.g. one per query).
+        max_concurrency (int): Maximum number of coroutines running concurrently.
+        desc (str, optional): Description of the progress bar. Defaults to None.
+        skipped_errors (Tuple[type, ...], optional): Errors that only make their own
+            coroutine fail (its result is None), any other error cancels the rest.
+            Defaults to ().
+        max_calls (int, optional): Maximum number of LLM calls in flight, or None to
+            only limit the coroutines. Defaults to None.
+
+    Returns:
+        list: Results of the coroutines, in the same order they were received.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    scheduler = call_scheduler.CallScheduler(max_calls) if max_calls is not None else None
+
+    async def run_with_semaphore(index: int, coroutine: Coroutine):
+        async with semaphore:
+            try:
+                if scheduler is not None:
+                    return index, await call_scheduler.run_query(scheduler, coroutine)
+                return index, await coroutine
+            except skipped_errors as e:
+                print(f"WARNING: skipping failed task: {str(e)}")
+                return index, None
+
+    tasks = [asyncio.ensure_future(run_with_semaphore(index, coroutine))
+             for index, coroutine in enumerate(coroutines)]
+
+    results = [None] * len(tasks)
+    try:
+        for task in tqdm.tqdm(asyncio.as_completed(tasks), total=len(tasks), desc=desc):
+            index, result = await task
+            results[index] = result
+    finally:
+        # Do not leave orphan tasks if one of them failed
+        for task in tasks:
+            task.cancel()
+
+    if scheduler is not None:
+        statistics = scheduler.get_statistics()
+        print(f"Pipeline: {statistics['queries']} queries, {statistics['calls']} calls, "
+              f"{statistics['max_calls_in_flight']} calls in flight at most, "
+              f"{statistics['mean_query_time']:.2f} s per query on average")
+
+    return results
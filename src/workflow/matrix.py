@@ -0,0 +1,92 @@
+import itertools
+
+from utils import file_utils
+
+KEY_MODES = "modes"
+KEY_METHODS = "methods"
+KEY_LLMS = "llms"
+KEY_NUMBER_MAPS = "number_maps"
+KEY_REFLECTION_ITERATIONS = "reflection_iterations"
+KEY_MAX_CONCURRENCY = "max_concurrency"
+KEY_MAX_CALLS = "max_calls"
+
+
+class ExperimentCell:
+    """
+    A cell of the experiment grid: an agentic workflow executed with a specific LLM
+    on the semantic maps pre-processed in a specific input mode.
+    """
+
+    def __init__(self, mode: str, method: str, llm: str):
+        self.mode = mode
+        self.method = method
+        self.llm = llm
+
+    def __repr__(self):
+        return (f"ExperimentCell(mode={self.mode}, "
+                f"method={self.method}, "
+                f"llm={self.llm})")
+
+
+def load_experiment_spec(file_path: str) -> dict:
+    """
+    Loads an experiment specification from a YAML file.
+
+    The file may contain any of the keys `modes`, `methods`, `llms` (lists) and
+    `number_maps`, `reflection_iterations`, `max_concurrency`, `max_calls` (integers), e.g.:
+
+        modes: [certainty, uncertainty]
+        methods: [base, self_reflection, multiagent_reflection, ensemble]
+        llms: [g15p]
+        number_maps: 10
+
+    Args:
+        file_path (str): Path to the YAML file.
+
+    Returns:
+        dict: The experiment specification.
+    """
+    experiment_spec = file_utils.load_yaml(file_path)
+    if experiment_spec is None:
+        return dict()
+    if not isinstance(experiment_spec, dict):
+        raise ValueError(
+            f"Experiment specification {file_path} is not a dictionary")
+    return experiment_spec
+
+
+def build_cells(modes: list, methods: list, llms: list) -> list:
+    """
+    Builds every cell of the experiment grid (modes x methods x LLMs).
+
+    Args:
+        modes (list): Semantic maps input modes.
+        methods (list): Agentic workflows.
+        llms (list): LLM constants (e.g. "g15p").
+
+    Returns:
+        list: A list of ExperimentCell objects.
+    """
+    return [ExperimentCell(mode, method, llm)
+            for mode, method, llm in itertools.product(modes, methods, llms)]
+
+
+def interleave(sequences: list) -> list:
+    """
+    Merges several sequences taking one element of each of them in turns
+    (round-robin), e.g. [[a1, a2, a3], [b1]] -> [a1, b1, a2, a3].
+
+    Used to mix the work of the different cells of the experiment grid, so calls
+    to every provider are issued during the whole run instead of cell after cell.
+
+    Args:
+        sequences (list): A list of sequences.
+
+    Returns:
+        list: The interleaved elements.
+    """
+    sentinel = object()
+    return [element
+            for elements in itertools.zip_longest(*sequences, fillvalue=sentinel)
+            for element in elements
+            if element is not sentinel]
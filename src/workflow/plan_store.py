@@ -0,0 +1,134 @@
+import asyncio
+import json
+import os
+import threading
+from typing import Callable, Coroutine
+
+from llm import telemetry
+from llm.conversation_history import ConversationHistory
+from llm.large_language_model import LargeLanguageModel
+from llm.response_cache import CACHE_KIND_JSON, ResponseCache
+from utils import file_utils, text_utils
+from workflow.convergence import get_relevant_objects
+
+
+class PlanStore:
+    """
+    Store of the first plans of the queries (the `PromptPlan` conversation, first
+    sample), shared by the workflows that start with it: the Base workflow, the first
+    plan of the Self-Reflection workflow and the first planner of the LLM Ensemble
+    workflow. A workflow reuses the plan of another one instead of planning again.
+
+    Plans are addressed as the responses of the response cache: by a hash of the
+    provider and model, the generation parameters, the sample index and the whole
+    conversation, so a plan is only reused if the prompt, model and sampling settings
+    match. Every plan is saved in a JSON file of its own ("<provider>/<key>.json") with
+    the workflow that generated it. Failed plans (without relevant objects) are not
+    shared.
+
+    The plans generated and reused by every (mode, workflow, provider) are counted in
+    the statistics.
+    """
+
+    # Sample index of the shared plans (the first sample of the conversation)
+    SAMPLE_INDEX = 0
+
+    def __init__(self, folder_path: str):
+        """
+        Initializes the PlanStore.
+
+        Args:
+            folder_path (str): Folder of the shared plans.
+        """
+        self.folder_path = folder_path
+
+        # Plans being generated, by key, so concurrent workflows wait for them instead
+        # of generating them again
+        self.pending_plans = dict()
+
+        self.lock = threading.Lock()
+        self.counters = dict()
+
+    def get_plan_file_path(self, llm_provider: LargeLanguageModel, key: str) -> str:
+        return os.path.join(self.folder_path, llm_provider.get_provider_name(), f"{key}.json")
+
+    def _count(self, llm_provider: LargeLanguageModel, counter: str):
+        call_tags = telemetry.get_call_tags()
+        group = (call_tags.get("mode"), call_tags.get("workflow"), llm_provider.get_provider_name())
+        with self.lock:
+            group_counters = self.counters.setdefault(group, {"generated": 0, "reused": 0})
+            group_counters[counter] += 1
+
+    def _load_plan(self, plan_file_path: str) -> str:
+        if not os.path.exists(plan_file_path):
+            return None
+        return text_utils.dict_to_json_str(file_utils.load_json(plan_file_path)["plan"])
+
+    def _save_plan(self, llm_provider: LargeLanguageModel, plan_file_path: str, plan_response: str):
+        file_utils.create_directories_for_file(plan_file_path)
+        file_utils.save_dict_to_json_file({"provider": llm_provider.get_provider_name(),
+                                           "generation_parameters": llm_provider.get_generation_parameters(),
+                                           "sample_index": self.SAMPLE_INDEX,
+                                           "workflow": telemetry.get_call_tags().get("workflow"),
+                                           "plan": json.loads(plan_response)},
+                                          plan_file_path)
+
+    async def aget_plan(self, llm_provider: LargeLanguageModel, conversation_history: ConversationHistory, generate_plan: Callable[[], Coroutine]) -> str:
+        """
+        Returns the shared plan of a conversation, generating (and storing) it if no
+        workflow has planned it yet. If another workflow is generating it, waits for it.
+
+        Args:
+            llm_provider (LargeLanguageModel): LLM of the plan.
+            conversation_history (ConversationHistory): The conversation of the plan.
+            generate_plan (Callable[[], Coroutine]): Generates the plan (JSON string) if it
+                is not stored.
+
+        Returns:
+            str: The plan (JSON string).
+        """
+        key = ResponseCache.get_key(provider_name=llm_provider.get_provider_name(),
+                                    generation_parameters=llm_provider.get_generation_parameters(),
+                                    sample_index=self.SAMPLE_INDEX,
+                                    conversation_history=conversation_history,
+                                    kind=CACHE_KIND_JSON)
+        plan_file_path = self.get_plan_file_path(llm_provider, key)
+
+        # Generated by another workflow of the run, in progress or stored
+        pending_plan = self.pending_plans.get(key)
+        plan_response = await pending_plan if pending_plan is not None else self._load_plan(plan_file_path)
+        if plan_response is not None:
+            self._count(llm_provider, "reused")
+            return plan_response
+
+        pending_plan = asyncio.get_running_loop().create_future()
+        self.pending_plans[key] = pending_plan
+        shared_plan_response = None
+        try:
+            plan_response = await generate_plan()
+            if get_relevant_objects(plan_response) is not None:
+                self._save_plan(llm_provider, plan_file_path, plan_response)
+                shared_plan_response = plan_response
+        finally:
+            # Workflows waiting for a failed plan generate their own
+            self.pending_plans.pop(key, None)
+            pending_plan.set_result(shared_plan_response)
+        self._count(llm_provider, "generated")
+        return plan_response
+
+    def get_statistics(self, mode: str = None, workflow: str = None, provider: str = None) -> dict:
+        """
+        Returns the number of plans generated and reused, and the rate of reused plans,
+        of the given mode, workflow and provider (all of them if None).
+        """
+        with self.lock:
+            groups = [group_counters for (group_mode, group_workflow, group_provider), group_counters in self.counters.items()
+                      if mode in (None, group_mode) and workflow in (None, group_workflow) and provider in (None, group_provider)]
+            n_generated = sum(group_counters["generated"] for group_counters in groups)
+            n_reused = sum(group_counters["reused"] for group_counters in groups)
+        n_plans = n_generated + n_reused
+        return {
+            "generated": n_generated,
+            "reused": n_reused,
+            "reuse_rate": n_reused / n_plans if n_plans > 0 else 0.0,
+        }
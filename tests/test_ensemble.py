@@ -0,0 +1,133 @@
+import json
+
+import pytest
+
+from workflow.ensemble import (AGGREGATOR_BORDA, AGGREGATOR_MAJORITY,
+                               AGGREGATOR_RRF, AdaptiveEnsemblePolicy,
+                               aggregate_borda_count,
+                               aggregate_majority_vote, aggregate_plans,
+                               aggregate_reciprocal_rank_fusion)
+
+
+def get_plan_response(relevant_objects: list, inferred_query: str = "Find a cup.") -> str:
+    return json.dumps({"inferred_query": inferred_query,
+                       "query_achievable": len(relevant_objects) > 0,
+                       "relevant_objects": relevant_objects,
+                       "explanation": ""})
+
+
+def test_majority_vote_keeps_the_objects_of_most_plans():
+    rankings = [["a", "b"], ["b", "c"], ["b", "a"]]
+
+    assert aggregate_majority_vote(rankings) == ["b", "a"]
+
+
+def test_majority_vote_breaks_ties_by_mean_rank():
+    rankings = [["a", "b"], ["b", "a"], ["b", "a", "c"]]
+
+    assert aggregate_majority_vote(rankings) == ["b", "a"]
+
+
+def test_majority_vote_without_majority_returns_the_most_voted_object():
+    rankings = [["a", "b"], ["c", "b"], ["d"], ["e"]]
+
+    assert aggregate_majority_vote(rankings) == ["b"]
+
+
+def test_majority_vote_counts_repeated_objects_once():
+    rankings = [["a", "a"], ["b"]]
+
+    assert aggregate_majority_vote(rankings) == ["a"]
+
+
+def test_borda_count_ranks_by_points():
+    # a: 2, b: 1 + 2 + 2, c: 1
+    rankings = [["a", "b"], ["b", "c"], ["b"]]
+
+    assert aggregate_borda_count(rankings) == ["b", "a", "c"]
+
+
+def test_borda_count_breaks_ties_by_first_appearance():
+    rankings = [["c", "b", "a", "d"], ["d", "a", "b", "c"]]
+
+    assert aggregate_borda_count(rankings) == ["c", "b", "a", "d"]
+
+
+def test_reciprocal_rank_fusion_favours_top_ranks():
+    # Same Borda points, but the first ranks weigh more
+    rankings = [["a", "b", "c", "d"], ["d", "c", "b", "a"]]
+
+    assert aggregate_borda_count(rankings) == ["a", "b", "c", "d"]
+    assert aggregate_reciprocal_rank_fusion(rankings) == ["a", "d", "b", "c"]
+
+
+def test_reciprocal_rank_fusion_breaks_ties_by_first_appearance():
+    rankings = [["a", "b"], ["b", "a"]]
+
+    assert aggregate_reciprocal_rank_fusion(rankings) == ["a", "b"]
+
+
+@pytest.mark.parametrize("aggregator, relevant_objects", [
+    (AGGREGATOR_MAJORITY, ["b", "a"]),
+    # Cut to the median length of the plans
+    (AGGREGATOR_BORDA, ["b", "a"]),
+    (AGGREGATOR_RRF, ["b", "a"]),
+])
+def test_aggregate_plans(aggregator, relevant_objects):
+    plan_responses = [get_plan_response(["a", "b", "c"]),
+                      get_plan_response(["b", "a"]),
+                      get_plan_response(["b"])]
+
+    final_plan = aggregate_plans(plan_responses, aggregator)
+
+    assert final_plan["relevant_objects"] == relevant_objects
+    assert final_plan["query_achievable"]
+    assert final_plan["inferred_query"] == "Find a cup."
+
+
+def test_aggregate_plans_ignores_failed_plans_and_object_dictionaries():
+    plan_responses = ["{}",
+                      "Not a plan",
+                      get_plan_response([{"id": "b"}], inferred_query="Find a book."),
+                      get_plan_response(["a", {"id": "b"}])]
+
+    final_plan = aggregate_plans(plan_responses, AGGREGATOR_BORDA)
+
+    assert final_plan["relevant_objects"] == ["a"]
+    assert final_plan["inferred_query"] == "Find a book."
+    assert final_plan["explanation"] == "Relevant objects aggregated by borda from 2 of 4 plans."
+
+
+def test_aggregate_plans_without_objects_in_most_plans():
+    plan_responses = [get_plan_response(["a"]),
+                      get_plan_response([]),
+                      get_plan_response([])]
+
+    final_plan = aggregate_plans(plan_responses, AGGREGATOR_MAJORITY)
+
+    assert final_plan["relevant_objects"] == []
+    assert not final_plan["query_achievable"]
+
+
+def test_aggregate_plans_of_failed_plans():
+    final_plan = aggregate_plans(["{}", "Not a plan"], AGGREGATOR_RRF)
+
+    assert final_plan["relevant_objects"] == []
+    assert final_plan["inferred_query"] == ""
+    assert not final_plan["query_achievable"]
+
+
+@pytest.mark.parametrize("rankings, n_samples", [
+    # Agreement of 2/3 with the first plans
+    ([["a"], ["a"], ["b"], ["c"], ["d"], ["e"]], 3),
+    # Agreement of 3/5 with five plans
+    ([["a"], ["b"], ["c"], ["a"], ["a"], ["e"]], 5),
+    # No agreement, every plan
+    ([["a"], ["b"], ["c"], ["d"], ["e"], ["f"]], 6),
+    # Plans missing (e.g. dropped by the provider)
+    ([["a"], ["b"], ["c"], ["d"]], 4),
+])
+def test_adaptive_ensemble_keeps_the_plans_needed_to_agree(rankings, n_samples):
+    policy = AdaptiveEnsemblePolicy(agreement_threshold=0.6, min_samples=3, max_samples=6)
+
+    assert policy.get_n_samples([get_plan_response(ranking) for ranking in rankings]) == n_samples
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+from llm.conversation_history import ConversationHistory
+from llm.fake_provider import PASS_SCORE, FakeLlmProvider
+from workflow.convergence import get_reflection_scores, get_relevant_objects
+
+SEMANTIC_MAP = json.dumps({"instances": {f"obj{index}": {"results": {"chair": 0.9}} for index in range(20)}})
+
+PLAN = json.dumps({"inferred_query": "Sit down.", "query_achievable": True,
+                   "relevant_objects": ["obj7", "obj3"], "explanation": ""})
+
+
+def get_plan_conversation() -> ConversationHistory:
+    conversation_history = ConversationHistory()
+    conversation_history.append_user_message(f"{SEMANTIC_MAP}\n<USER_QUERY>Sit down.</USER_QUERY>")
+    return conversation_history
+
+
+def get_reflection_message(plan_response: str) -> str:
+    return (f"<PRELIMINARY_RESPONSE>\nThe preliminary response was:\n{plan_response}\n</PRELIMINARY_RESPONSE>\n\n"
+            "Now generate feedback on the PRELIMINARY_RESPONSE (that is the response to the QUERY).")
+
+
+def get_correction_conversation() -> ConversationHistory:
+    conversation_history = ConversationHistory()
+    conversation_history.append_user_message(SEMANTIC_MAP)
+    conversation_history.append_user_message(
+        f"<PRELIMINARY_RESPONSE>\nThe prelimiary response was:\n{PLAN}\n</PRELIMINARY_RESPONSE>\n\n"
+        "<FEEDBACK>\nThe reflection response was:\n5/10.\n</FEEDBACK>")
+    return conversation_history
+
+
+@pytest.mark.parametrize("plan_agreement_rate, n_plans", [(1.0, 1), (0.0, 6)])
+def test_plan_agreement_rate(plan_agreement_rate, n_plans):
+    llm_provider = FakeLlmProvider(plan_agreement_rate=plan_agreement_rate)
+
+    plan_responses = llm_provider.generate_json_samples(get_plan_conversation(), 6)
+
+    assert len({tuple(get_relevant_objects(plan_response)) for plan_response in plan_responses}) == n_plans
+
+
+def test_correction_fixpoint_rate():
+    keeping_llm_provider = FakeLlmProvider(correction_fixpoint_rate=1.0)
+    changing_llm_provider = FakeLlmProvider(correction_fixpoint_rate=0.0)
+
+    assert get_relevant_objects(keeping_llm_provider.generate_json(get_correction_conversation())) == ["obj7", "obj3"]
+    assert get_relevant_objects(changing_llm_provider.generate_json(get_correction_conversation())) != ["obj7", "obj3"]
+
+
+def test_reflection_scores_depend_on_the_plan():
+    llm_provider = FakeLlmProvider()
+    conversation_history = ConversationHistory()
+    conversation_history.append_user_message(get_reflection_message(PLAN))
+    other_conversation_history = ConversationHistory()
+    other_conversation_history.append_user_message("Another system prompt.")
+    other_conversation_history.append_user_message(get_reflection_message(PLAN))
+
+    assert llm_provider.generate_text(conversation_history) == llm_provider.generate_text(other_conversation_history)
+
+
+def test_corrected_pass_rate():
+    llm_provider = FakeLlmProvider(corrected_pass_rate=1.0)
+    conversation_history = ConversationHistory()
+    conversation_history.append_user_message(get_reflection_message(PLAN))
+    conversation_history.append_assistant_message("0/10.")
+    conversation_history.append_user_message(get_reflection_message(PLAN.replace("obj3", "obj4")))
+
+    assert min(get_reflection_scores(llm_provider.generate_text(conversation_history))) >= PASS_SCORE
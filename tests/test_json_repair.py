@@ -0,0 +1,111 @@
+import json
+
+import pytest
+
+from llm.fake_provider import FakeLlmProvider
+from llm.json_repair import has_keys, repair_json
+
+PLAN_KEYS = ["inferred_query", "query_achievable", "relevant_objects", "explanation"]
+
+PLAN = '{"inferred_query": "Find a cup.", "query_achievable": true, "relevant_objects": ["obj1", "obj2"], "explanation": "Cups."'
+
+
+@pytest.mark.parametrize("text, expected_value", [
+    # Valid JSON is kept
+    ('{"relevant_objects": ["obj1"]}', {"relevant_objects": ["obj1"]}),
+    # Code fences and surrounding prose
+    ('```json\n{"relevant_objects": ["obj1"]}\n```', {"relevant_objects": ["obj1"]}),
+    ('Sure! Here it is: {"a": 1} Hope it helps.', {"a": 1}),
+    # Trailing commas
+    ('{"relevant_objects": ["obj1", "obj2",], }', {"relevant_objects": ["obj1", "obj2"]}),
+    # Single-quoted strings, with an apostrophe inside
+    ("{'explanation': 'the user's cup'}", {"explanation": "the user's cup"}),
+    # Python literals
+    ('{"a": True, "b": False, "c": None}', {"a": True, "b": False, "c": None}),
+    # Raw control characters inside strings
+    ('{"explanation": "first\nsecond\tthird"}', {"explanation": "first\nsecond\tthird"}),
+    # Unescaped quotes inside strings
+    ('{"explanation": "the "red" cup"}', {"explanation": 'the "red" cup'}),
+    # Bracket left open inside the response
+    ('{"relevant_objects": ["obj1", "obj2"}', {"relevant_objects": ["obj1", "obj2"]}),
+    # Arrays
+    ("['obj1', 'obj2']", ["obj1", "obj2"]),
+])
+def test_repairs_without_losses(text, expected_value):
+    repaired_text = repair_json(text)
+
+    assert repaired_text is not None
+    assert json.loads(repaired_text) == expected_value
+
+
+@pytest.mark.parametrize("text", [
+    # No JSON at all
+    "I cannot help with that.",
+    "",
+    # Truncated responses: closing them would lose content
+    "Sure! {",
+    '{"relevant_objects": ["obj1", "obj2',
+    '{"a": 1',
+    '{"relevant_objects": ["obj1"], "explanation": "The cup is',
+    # Empty objects and arrays
+    "{}",
+    "Here: [] done",
+    # Not repairable
+    '{"a" 1}',
+])
+def test_does_not_repair_with_losses(text):
+    assert repair_json(text) is None
+
+
+@pytest.mark.parametrize("text, expected_value", [
+    # Only the closers are missing
+    ('{"relevant_objects": ["obj1", "obj2"]', {"relevant_objects": ["obj1", "obj2"]}),
+    ('{"a": {"b": true', {"a": {"b": True}}),
+    ('{"a": [null', {"a": [None]}),
+    # Elements may be missing, the caller checks the fields
+    ('{"relevant_objects": ["obj1", "obj2"', {"relevant_objects": ["obj1", "obj2"]}),
+])
+def test_closes_truncated_responses_after_a_complete_value(text, expected_value):
+    assert repair_json(text) is None
+    assert json.loads(repair_json(text, close_truncated=True)) == expected_value
+
+
+@pytest.mark.parametrize("text", [
+    # Inside a string, after a separator, a key or a number
+    '{"relevant_objects": ["obj1", "obj2',
+    '{"relevant_objects": ["obj1",',
+    '{"relevant_objects":',
+    '{"a": 1, "relevant_objects"',
+    '{"a": 1',
+    "Sure! {",
+])
+def test_does_not_close_responses_truncated_in_a_value(text):
+    assert repair_json(text, close_truncated=True) is None
+
+
+def test_truncated_response_is_only_accepted_with_every_required_key():
+    llm_provider = FakeLlmProvider()
+
+    assert json.loads(llm_provider._parse_json_response(PLAN, PLAN_KEYS))["explanation"] == "Cups."
+    with pytest.raises(json.decoder.JSONDecodeError):
+        llm_provider._parse_json_response(PLAN)
+    with pytest.raises(json.decoder.JSONDecodeError):
+        llm_provider._parse_json_response(PLAN[:PLAN.index(', "explanation"')], PLAN_KEYS)
+
+
+def test_repair_keeps_escaped_characters():
+    repaired_text = repair_json('{"explanation": "a \\"quoted\\" \\\\ path",}')
+
+    assert json.loads(repaired_text) == {"explanation": 'a "quoted" \\ path'}
+
+
+def test_repair_keeps_commas_and_brackets_inside_strings():
+    repaired_text = repair_json('{"explanation": "obj1, ] and }, ",}')
+
+    assert json.loads(repaired_text) == {"explanation": "obj1, ] and }, "}
+
+
+def test_has_keys():
+    assert has_keys('{"relevant_objects": [], "explanation": ""}', ["relevant_objects", "explanation"])
+    assert not has_keys('{"relevant_objects": []}', ["relevant_objects", "explanation"])
+    assert not has_keys('["relevant_objects", "explanation"]', ["relevant_objects", "explanation"])
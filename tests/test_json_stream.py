@@ -0,0 +1,79 @@
+import pytest
+
+from llm.json_stream import JsonCompletionDetector
+
+RESPONSE = 'Here is the plan:\n{"relevant_objects": ["obj1", "obj2"], "explanation": "A {cup} is \\"near\\"."}\nHope it helps!'
+
+
+def feed_chunks(detector: JsonCompletionDetector, text: str, chunk_size: int) -> list:
+    completed_fields = []
+    for start in range(0, len(text), chunk_size):
+        completed_fields += detector.feed(text[start:start + chunk_size])
+    return completed_fields
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, len(RESPONSE)])
+def test_detects_the_json_object_in_any_chunking(chunk_size):
+    detector = JsonCompletionDetector()
+
+    completed_fields = feed_chunks(detector, RESPONSE, chunk_size)
+
+    assert detector.is_complete()
+    assert detector.get_json_text() == RESPONSE[RESPONSE.index("{"):RESPONSE.index("\nHope")]
+    assert completed_fields == [("relevant_objects", ["obj1", "obj2"]),
+                                ("explanation", 'A {cup} is "near".')]
+
+
+def test_reports_a_field_as_soon_as_its_value_is_closed():
+    detector = JsonCompletionDetector()
+
+    assert detector.feed('{"relevant_objects": ["obj1", ') == []
+    assert detector.feed('"obj2"], "expla') == [("relevant_objects", ["obj1", "obj2"])]
+    assert not detector.is_complete()
+    assert detector.get_json_text() is None
+    assert detector.feed('nation": "none"}') == [("explanation", "none")]
+    assert detector.is_complete()
+
+
+def test_ignores_the_stream_after_the_json_object():
+    detector = JsonCompletionDetector()
+    detector.feed('{"a": 1} trailing')
+
+    assert detector.feed(' {"b": 2}') == []
+    assert detector.get_json_text() == '{"a": 1}'
+    assert detector.get_text() == '{"a": 1} trailing'
+
+
+def test_nested_fields_are_not_top_level_fields():
+    detector = JsonCompletionDetector()
+
+    completed_fields = detector.feed('{"plan": {"step": 1, "objects": ["obj1"]}, "n": 2}')
+
+    assert completed_fields == [("plan", {"step": 1, "objects": ["obj1"]}), ("n", 2)]
+
+
+def test_detects_a_json_array_without_fields():
+    detector = JsonCompletionDetector()
+
+    completed_fields = detector.feed('```json\n["obj1", ["obj2"]]\n```')
+
+    assert completed_fields == []
+    assert detector.get_json_text() == '["obj1", ["obj2"]]'
+
+
+def test_malformed_field_is_skipped():
+    detector = JsonCompletionDetector()
+
+    completed_fields = detector.feed("{\"a\": 'single', \"b\": true}")
+
+    assert completed_fields == [("b", True)]
+    assert detector.is_complete()
+
+
+def test_unclosed_json_object_is_not_complete():
+    detector = JsonCompletionDetector()
+
+    detector.feed('Sure! {"relevant_objects": ["obj1"')
+
+    assert not detector.is_complete()
+    assert detector.get_json_text() is None
@@ -0,0 +1,97 @@
+import pytest
+
+from llm import rate_limiter
+from llm.rate_limiter import RateLimiter, TokenBucket
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(rate_limiter.time, "monotonic", fake_clock.monotonic)
+    monkeypatch.setattr(rate_limiter.time, "sleep", fake_clock.sleep)
+    return fake_clock
+
+
+def test_bucket_starts_full(clock):
+    bucket = TokenBucket(rate_per_minute=600, burst_seconds=2.0)
+
+    assert bucket.capacity == 20
+    assert bucket.time_until_available(20) == 0.0
+
+
+def test_bucket_capacity_is_at_least_one(clock):
+    bucket = TokenBucket(rate_per_minute=6)
+
+    assert bucket.capacity == 1.0
+
+
+def test_bucket_waits_for_refill(clock):
+    bucket = TokenBucket(rate_per_minute=60)
+    bucket.consume(1)
+
+    assert bucket.time_until_available(1) == pytest.approx(1.0)
+    clock.now += 0.5
+    assert bucket.time_until_available(1) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.time_until_available(1) == 0.0
+
+
+def test_bucket_does_not_refill_over_capacity(clock):
+    bucket = TokenBucket(rate_per_minute=60, burst_seconds=2.0)
+    clock.now += 100
+    bucket.consume(2)
+
+    assert bucket.time_until_available(1) == pytest.approx(1.0)
+
+
+def test_bucket_admits_amounts_over_capacity_into_debt(clock):
+    bucket = TokenBucket(rate_per_minute=60)
+
+    # Bigger than the capacity, admitted once the bucket is full
+    assert bucket.time_until_available(5) == 0.0
+    bucket.consume(5)
+    # The debt (4) and the next amount (1) are refilled first
+    assert bucket.time_until_available(1) == pytest.approx(5.0)
+
+
+def test_rate_limiter_waits_for_requests_budget(clock):
+    limiter = RateLimiter(requests_per_minute=60)
+
+    limiter.acquire()
+    limiter.acquire()
+
+    assert clock.now == pytest.approx(1.0)
+    assert limiter.total_wait_time == pytest.approx(1.0)
+
+
+def test_rate_limiter_charges_response_tokens(clock):
+    limiter = RateLimiter(tokens_per_minute=600)
+
+    limiter.acquire(10)
+    limiter.consume_tokens(10)
+    limiter.acquire(10)
+
+    # 10 tokens of debt and the 10 of the request, at 10 tokens per second
+    assert clock.now == pytest.approx(2.0)
+
+
+def test_rate_limiter_without_limits_never_waits(clock):
+    limiter = RateLimiter()
+
+    for _ in range(100):
+        limiter.acquire(1000)
+    limiter.consume_tokens(1000)
+
+    assert clock.now == 0.0
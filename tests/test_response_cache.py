@@ -0,0 +1,118 @@
+import pytest
+
+from llm.conversation_history import ConversationHistory
+from llm.response_cache import (CACHE_KIND_JSON, CACHE_KIND_TEXT,
+                                DiskCacheBackend, MemoryCacheBackend,
+                                ResponseCache)
+
+
+def get_conversation(user_text: str) -> ConversationHistory:
+    conversation_history = ConversationHistory()
+    conversation_history.append_system_message("You are a planner.")
+    conversation_history.append_user_message(user_text)
+    return conversation_history
+
+
+def get_key(user_text: str = "Find a cup.", provider_name: str = "gemini", temperature: float = 0.0,
+            sample_index: int = 0, kind: str = CACHE_KIND_JSON) -> str:
+    return ResponseCache.get_key(provider_name=provider_name,
+                                 generation_parameters={"temperature": temperature},
+                                 sample_index=sample_index,
+                                 conversation_history=get_conversation(user_text),
+                                 kind=kind)
+
+
+def test_key_is_deterministic():
+    assert get_key() == get_key()
+
+
+@pytest.mark.parametrize("changes", [{"user_text": "Find a book."},
+                                     {"provider_name": "gpt"},
+                                     {"temperature": 1.0},
+                                     {"sample_index": 1},
+                                     {"kind": CACHE_KIND_TEXT}])
+def test_key_changes_with_the_request(changes):
+    assert get_key(**changes) != get_key()
+
+
+def test_miss_then_hit():
+    cache = ResponseCache(MemoryCacheBackend())
+    key = get_key()
+
+    assert cache.get(key) is None
+    cache.set(key, '{"relevant_objects": ["obj1"]}')
+    assert cache.get(key) == '{"relevant_objects": ["obj1"]}'
+
+    statistics = cache.get_statistics()
+    assert statistics["hits"] == 1
+    assert statistics["misses"] == 1
+    assert statistics["hit_rate"] == 0.5
+    assert statistics["entries"] == 1
+
+
+def test_set_overwrites_the_response():
+    cache = ResponseCache(MemoryCacheBackend())
+
+    cache.set("a", "first")
+    cache.set("a", "second")
+
+    assert cache.get("a") == "second"
+    assert cache.get_statistics()["entries"] == 1
+
+
+def test_evicts_the_least_recently_used_response():
+    backend = MemoryCacheBackend()
+    cache = ResponseCache(backend, max_entries=2)
+    cache.set("a", "1")
+    cache.set("b", "2")
+
+    # Reading "a" makes "b" the least recently used one
+    assert cache.get("a") == "1"
+    cache.set("c", "3")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+    assert backend.keys() == ["a", "c"]
+    assert cache.get_statistics()["evictions"] == 1
+
+
+def test_evicts_the_stored_responses_over_the_limit():
+    backend = MemoryCacheBackend()
+    for key in ["a", "b", "c"]:
+        backend.set(key, key)
+
+    cache = ResponseCache(backend, max_entries=1)
+
+    assert backend.keys() == ["c"]
+    assert cache.get_statistics()["evictions"] == 2
+
+
+def test_response_deleted_from_the_backend_is_a_miss():
+    backend = MemoryCacheBackend()
+    cache = ResponseCache(backend)
+    cache.set("a", "1")
+
+    backend.delete("a")
+
+    assert cache.get("a") is None
+    assert cache.get_statistics()["entries"] == 0
+
+
+def test_disk_backend_persists_the_responses(tmp_path):
+    key = get_key()
+    ResponseCache(DiskCacheBackend(str(tmp_path))).set(key, "ñandú")
+
+    cache = ResponseCache(DiskCacheBackend(str(tmp_path)))
+
+    assert cache.get(key) == "ñandú"
+    assert cache.get_statistics()["entries"] == 1
+
+
+def test_disk_backend_ignores_corrupted_responses(tmp_path):
+    backend = DiskCacheBackend(str(tmp_path))
+    backend.set("abcd", "1")
+    with open(tmp_path / "ab" / "abcd.json", "w", encoding="utf-8") as file:
+        file.write('{"value": ')
+
+    assert backend.get("abcd") is None
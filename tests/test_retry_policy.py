@@ -0,0 +1,206 @@
+import json
+
+import pytest
+
+from llm import retry_policy
+from llm.retry_policy import (ERROR_CONTENT_BLOCK, ERROR_PARSE,
+                              ERROR_PERMANENT, ERROR_RATE_LIMIT,
+                              ERROR_TRANSIENT, ProviderCallError, RetryPolicy,
+                              classify_error, is_run_error)
+
+
+class StatusError(Exception):
+
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class CodeError(Exception):
+
+    def __init__(self, code: int):
+        super().__init__(f"code {code}")
+        self.code = code
+
+
+# SDK exceptions are classified by name
+class RateLimitError(Exception):
+    pass
+
+
+class ServiceUnavailable(Exception):
+    pass
+
+
+class DefaultCredentialsError(Exception):
+    pass
+
+
+class FailingFunction:
+    """
+    Raises the given errors in its first calls, then returns "ok".
+    """
+
+    def __init__(self, errors: list):
+        self.errors = list(errors)
+        self.n_calls = 0
+
+    def __call__(self):
+        self.n_calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleep_delays = []
+    monkeypatch.setattr(retry_policy.time, "sleep", sleep_delays.append)
+    # Largest delay of the full jitter
+    monkeypatch.setattr(retry_policy.random, "uniform", lambda low, high: high)
+    return sleep_delays
+
+
+@pytest.mark.parametrize("error, error_class", [
+    (json.decoder.JSONDecodeError("Expecting value", "", 0), ERROR_PARSE),
+    (IndexError("list index out of range"), ERROR_CONTENT_BLOCK),
+    (ValueError("Response was blocked by the SAFETY filters"), ERROR_CONTENT_BLOCK),
+    (StatusError(429), ERROR_RATE_LIMIT),
+    (CodeError(429), ERROR_RATE_LIMIT),
+    (RateLimitError(), ERROR_RATE_LIMIT),
+    (StatusError(503), ERROR_TRANSIENT),
+    (CodeError(408), ERROR_TRANSIENT),
+    (ServiceUnavailable(), ERROR_TRANSIENT),
+    (ConnectionResetError(), ERROR_TRANSIENT),
+    (TimeoutError(), ERROR_TRANSIENT),
+    (StatusError(401), ERROR_PERMANENT),
+    (CodeError(400), ERROR_PERMANENT),
+    (ValueError("invalid argument"), ERROR_PERMANENT),
+    (KeyError("relevant_objects"), ERROR_PERMANENT),
+])
+def test_classify_error(error, error_class):
+    assert classify_error(error) == error_class
+
+
+def test_delay_grows_exponentially_up_to_the_maximum(sleeps):
+    policy = RetryPolicy(max_delay=10.0)
+
+    assert [policy.get_delay(ERROR_TRANSIENT, attempt) for attempt in range(1, 6)] == [1.0, 2.0, 4.0, 8.0, 10.0]
+    assert policy.get_delay(ERROR_RATE_LIMIT, 1) == 2.0
+    assert policy.get_delay(ERROR_PARSE, 3) == 0.0
+
+
+def test_delay_is_jittered_below_the_backoff():
+    policy = RetryPolicy()
+
+    delays = [policy.get_delay(ERROR_RATE_LIMIT, 3) for _ in range(100)]
+
+    assert all(0.0 <= delay <= 8.0 for delay in delays)
+
+
+def test_should_retry_up_to_the_attempts_of_the_error_class():
+    policy = RetryPolicy(max_attempts={ERROR_TRANSIENT: 3})
+
+    assert policy.should_retry(ERROR_TRANSIENT, 1)
+    assert policy.should_retry(ERROR_TRANSIENT, 2)
+    assert not policy.should_retry(ERROR_TRANSIENT, 3)
+    assert not policy.should_retry(ERROR_PERMANENT, 1)
+
+    statistics = policy.get_statistics()
+    assert statistics["retries_transient"] == 2
+    assert statistics["failures_transient"] == 1
+    assert statistics["failures_permanent"] == 1
+
+
+def test_should_retry_within_the_retry_budget():
+    policy = RetryPolicy(budget_ratio=0.5, min_retries=1)
+
+    assert policy.should_retry(ERROR_RATE_LIMIT, 1)
+    assert not policy.should_retry(ERROR_RATE_LIMIT, 2)
+
+    # Every call earns half a retry
+    policy.n_calls = 2
+    assert policy.should_retry(ERROR_RATE_LIMIT, 2)
+    assert not policy.should_retry(ERROR_RATE_LIMIT, 3)
+
+    statistics = policy.get_statistics()
+    assert statistics["retries_rate_limit"] == 2
+    assert statistics["retry_budget_exhaustions"] == 2
+
+
+def test_call_retries_until_success(sleeps):
+    policy = RetryPolicy()
+    function = FailingFunction([StatusError(503), StatusError(503), RateLimitError()])
+
+    assert policy.call(function) == "ok"
+
+    assert function.n_calls == 4
+    # Every error class has its own backoff
+    assert sleeps == [1.0, 2.0, 2.0]
+    statistics = policy.get_statistics()
+    assert statistics["retries_transient"] == 2
+    assert statistics["retries_rate_limit"] == 1
+    assert statistics["backoff_time"] == 5.0
+
+
+def test_call_does_not_wait_before_retrying_parse_errors(sleeps):
+    policy = RetryPolicy()
+    function = FailingFunction([json.decoder.JSONDecodeError("Expecting value", "", 0)])
+
+    assert policy.call(function) == "ok"
+
+    assert sleeps == []
+
+
+def test_call_gives_up_after_the_attempts_of_the_error_class(sleeps):
+    policy = RetryPolicy(max_attempts={ERROR_CONTENT_BLOCK: 2})
+    cause = IndexError("list index out of range")
+    function = FailingFunction([IndexError(), cause, IndexError()])
+
+    with pytest.raises(ProviderCallError) as error_info:
+        policy.call(function)
+
+    assert error_info.value.error_class == ERROR_CONTENT_BLOCK
+    assert error_info.value.attempts == 2
+    assert error_info.value.cause is cause
+    assert function.n_calls == 2
+
+
+@pytest.mark.parametrize("error, run_error", [
+    (StatusError(401), True),
+    (CodeError(403), True),
+    (StatusError(404), True),
+    (DefaultCredentialsError(), True),
+    (StatusError(400), False),
+    (CodeError(413), False),
+    (ValueError("invalid argument"), False),
+    (KeyError("candidates"), False),
+])
+def test_is_run_error(error, run_error):
+    assert is_run_error(error) == run_error
+
+
+def test_call_raises_permanent_errors_of_the_run_at_once(sleeps):
+    policy = RetryPolicy()
+    function = FailingFunction([StatusError(401)])
+
+    with pytest.raises(StatusError):
+        policy.call(function)
+
+    assert function.n_calls == 1
+    assert policy.get_statistics()["failures_permanent"] == 1
+
+
+@pytest.mark.parametrize("cause", [StatusError(400), KeyError("candidates"), ValueError("invalid argument")])
+def test_call_gives_up_permanent_errors_of_the_request_at_once(sleeps, cause):
+    policy = RetryPolicy()
+    function = FailingFunction([cause])
+
+    with pytest.raises(ProviderCallError) as error_info:
+        policy.call(function)
+
+    assert error_info.value.error_class == ERROR_PERMANENT
+    assert error_info.value.attempts == 1
+    assert error_info.value.cause is cause
+    assert function.n_calls == 1
+    assert sleeps == []